@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Measures the per-call overhead of running a shared function through
+# run_as_user, without the cost of the function itself:
+#
+#   manager    the old one-shot path: a new interpreter per call and a
+#              multiprocessing.Manager with two queues in parent and child
+#   oneshot    run_as_user_oneshot: a new interpreter per call, events as
+#              JSON lines on stdout
+#   persistent run_as_user: one long-lived worker, framed requests over a
+#              socketpair
+#
+# The real shared_functions imports GI/Flatpak, which would dominate every
+# number here, so the script builds a throwaway nobara_updater package
+# with this tree's run_as.py / run_as_user_target.py and a shared_functions
+# that only has a no-op. It calls as the current user, so no root needed.
+#
+# Usage: python3 benchmarks/run_as_overhead.py [iterations]
+
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+SHARED_FUNCTIONS = """
+def noop(uid, gid, log_queue, update_queue, option="", *args):
+    log_queue.put("noop")
+    return []
+"""
+
+# What run_as_user_target.py did per call before the Manager was removed
+LEGACY_TARGET = """
+import json, multiprocessing, sys
+
+def noop(log_queue):
+    log_queue.put("noop")
+    return []
+
+if __name__ == "__main__":
+    manager = multiprocessing.Manager()
+    log_queue = manager.Queue()
+    update_queue = manager.Queue()
+    result = noop(log_queue)
+    log_data = []
+    while not log_queue.empty():
+        log_data.append(log_queue.get())
+    update_data = []
+    while not update_queue.empty():
+        update_data.append(update_queue.get())
+    sys.stdout.write(json.dumps({"result": result, "log_queue": log_data, "update_queue": update_data}) + "\\n")
+"""
+
+
+def legacy_call(script: Path) -> None:
+    manager = multiprocessing.Manager()
+    log_queue = manager.Queue()
+    manager.Queue()
+    result = subprocess.run([sys.executable, script], capture_output=True, text=True)
+    for item in json.loads(result.stdout)["log_queue"]:
+        log_queue.put(item)
+    while not log_queue.empty():
+        log_queue.get()
+    manager.shutdown()
+
+
+def measure(name: str, call, iterations: int) -> None:
+    call()  # warm up, and start the persistent worker
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{name:<11} median {statistics.median(timings):8.2f} ms  "
+        f"mean {statistics.mean(timings):8.2f} ms  min {min(timings):8.2f} ms"
+    )
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tmp_dir = Path(tempfile.mkdtemp(prefix="run-as-bench-"))
+    try:
+        package = tmp_dir / "nobara_updater"
+        package.mkdir()
+        (package / "__init__.py").write_text("")
+        (package / "shared_functions.py").write_text(SHARED_FUNCTIONS)
+        for name in ("run_as.py", "run_as_user_target.py"):
+            shutil.copy(SRC_DIR / name, package / name)
+        legacy_script = tmp_dir / "legacy_target.py"
+        legacy_script.write_text(LEGACY_TARGET)
+
+        # Children inherit this, the worker needs it to import the package
+        os.environ["PYTHONPATH"] = f"{tmp_dir}:{os.environ.get('PYTHONPATH', '')}"
+        sys.path.insert(0, str(tmp_dir))
+        from nobara_updater import run_as  # type: ignore[import]
+
+        uid, gid = os.getuid(), os.getgid()
+        print(f"{iterations} calls each")
+        measure("manager", lambda: legacy_call(legacy_script), iterations)
+        measure("oneshot", lambda: run_as.run_as_user_oneshot(uid, gid, "noop"), iterations)
+        measure("persistent", lambda: run_as.run_as_user(uid, gid, "noop"), iterations)
+        run_as.shutdown_user_workers()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
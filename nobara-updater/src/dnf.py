@@ -1,21 +1,25 @@
 import logging
 import libdnf5.base as dnf5_base
+import libdnf5.conf as dnf5_conf
 import libdnf5.repo as dnf5_repo
 import libdnf5.rpm as dnf5_rpm
 import libdnf5.transaction as dnf5_trans
 from libdnf5.exception import OptionValueNotSetError
-import queue
 import threading
 import time
 import sys
-from logging.handlers import QueueHandler
-from typing import Any, List
+from typing import Any
 import inspect
-import dnf  # type: ignore[import]
 import gi  # type: ignore[import]
-import subprocess
 import os
 import contextlib
+import fnmatch
+import hashlib
+import json
+import shutil
+from pathlib import Path
+import rpm  # type: ignore[import]
+from nobara_updater.mirrors import MirrorRanking, ranking_key
 
 gi.require_version("Gtk", "3.0")
 
@@ -23,6 +27,39 @@ from gi.repository import Gtk  # type: ignore[import]
 
 logger = logging.getLogger()
 
+CACHE_DIR = Path("/var/cache/nobara-updater")
+# Parallel downloads used when dnf.conf does not set max_parallel_downloads.
+# librepo additionally caps the connections opened to any single mirror.
+PARALLEL_DOWNLOADS = 10
+# Cached packages not used for this many days are pruned
+PACKAGE_CACHE_MAX_AGE_DAYS = 14
+# Downloads kept for a later transaction are capped at this size, the least
+# recently used go first. Packages are dropped as soon as their transaction
+# committed, so this only bounds prefetched and leftover ones.
+PACKAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Filled by the repository check, read whenever the dnf session is loaded
+mirror_ranking = MirrorRanking(CACHE_DIR / "mirrors.json")
+
+
+def prefer_ranked_mirrors(base: dnf5_base.Base) -> None:
+    # Put the fastest measured mirrors of each repo ahead of the ones dnf
+    # would pick from the metalink/mirrorlist. librepo still falls back to
+    # those, and metalink repos keep verifying repomd.xml against it.
+    variables = base.get_vars()
+    releasever = variables.get_value("releasever")
+    basearch = variables.get_value("basearch")
+    query = dnf5_repo.RepoQuery(base)
+    query.filter_enabled(True)
+    for repo in query:
+        best = mirror_ranking.best(ranking_key(repo.get_id(), releasever, basearch))
+        if not best:
+            continue
+        option = repo.get_config().get_baseurl_option()
+        urls = best + [url for url in option.get_value() if url not in best]
+        option.set(dnf5_conf.Option.Priority_RUNTIME, urls)
+        logger.debug("Preferring mirrors for %s: %s", repo.get_id(), ", ".join(best))
+
 class AttributeDict(dict[str, Any]):
     def __init__(self, id: str, metalink: Any, mirrorlist: Any, baseurl: Any) -> None:
         super().__init__()
@@ -71,6 +108,297 @@ def mute_loggers(names: list[str], level: int = logging.WARNING):
             lg.propagate = old_propagate
             lg.handlers = old_handlers
 
+def rpmdb_cookie() -> str:
+    # Changes whenever anything (us, rpm -e, a dnf subprocess) modifies the rpmdb
+    try:
+        return str(rpm.TransactionSet().dbCookie())
+    except Exception:
+        # Older rpm without dbCookie(), fall back to the database file itself
+        for db in ("/usr/lib/sysimage/rpm/rpmdb.sqlite", "/var/lib/rpm/rpmdb.sqlite"):
+            if os.path.exists(db):
+                st = os.stat(db)
+                return f"{st.st_mtime_ns}:{st.st_size}"
+    return ""
+
+
+def rpmdb_stamp() -> tuple:
+    # Cheap change detector for the rpmdb, the sqlite files are rewritten by
+    # every rpm transaction no matter who runs it.
+    stamp = []
+    for db in (
+        "/usr/lib/sysimage/rpm/rpmdb.sqlite",
+        "/usr/lib/sysimage/rpm/rpmdb.sqlite-wal",
+        "/var/lib/rpm/rpmdb.sqlite",
+        "/var/lib/rpm/rpmdb.sqlite-wal",
+    ):
+        try:
+            st = os.stat(db)
+            stamp.append((db, st.st_mtime_ns, st.st_size))
+        except OSError:
+            pass
+    return tuple(stamp)
+
+
+class InstalledPackage:
+    def __init__(
+        self, name: str, epoch: int, version: str, release: str, arch: str, from_repo: str = ""
+    ) -> None:
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
+        # Id of the repo the package was installed from, empty if unknown
+        self.from_repo = from_repo
+
+    @property
+    def evr(self) -> str:
+        prefix = f"{self.epoch}:" if self.epoch else ""
+        return f"{prefix}{self.version}-{self.release}"
+
+    @property
+    def nevra(self) -> str:
+        return f"{self.name}-{self.evr}.{self.arch}"
+
+    @property
+    def name_arch(self) -> str:
+        return f"{self.name}.{self.arch}"
+
+    def has_release_tag(self, tag: str) -> bool:
+        # "fc41" matches 1.fc41 and 0.3.rc2.fc41 but not fc410
+        return tag in self.release.split(".")
+
+    def spellings(self) -> list[str]:
+        # Every way rpm -q accepts to name this package
+        nvr = f"{self.name}-{self.version}-{self.release}"
+        return [
+            self.name,
+            f"{self.name}.{self.arch}",
+            f"{self.name}-{self.version}",
+            nvr,
+            f"{nvr}.{self.arch}",
+            f"{self.name}-{self.epoch}:{self.version}-{self.release}.{self.arch}",
+        ]
+
+    def __repr__(self) -> str:
+        return self.nevra
+
+
+class InstalledPackageIndex:
+    # Snapshot of the installed package set, answering the questions the
+    # quirks used to ask through one `rpm -q` subprocess per package.
+    def __init__(self, packages: list[InstalledPackage]) -> None:
+        self.packages = packages
+        self.by_spelling: dict[str, list[InstalledPackage]] = {}
+        for pkg in packages:
+            for spelling in set(pkg.spellings()):
+                self.by_spelling.setdefault(spelling, []).append(pkg)
+
+    @classmethod
+    def from_base(cls, base: dnf5_base.Base) -> "InstalledPackageIndex":
+        query = dnf5_rpm.PackageQuery(base)
+        query.filter_installed()
+        return cls(
+            [
+                InstalledPackage(
+                    pkg.get_name(),
+                    int(pkg.get_epoch() or 0),
+                    pkg.get_version(),
+                    pkg.get_release(),
+                    pkg.get_arch(),
+                    pkg.get_from_repo_id(),
+                )
+                for pkg in query
+            ]
+        )
+
+    def find(self, spec: str) -> list[InstalledPackage]:
+        # Accepts name, name.arch, N-V, N-V-R, N-V-R.A, N-E:V-R.A and globs of those
+        if any(c in spec for c in "*?["):
+            matches = []
+            for spelling, pkgs in self.by_spelling.items():
+                if fnmatch.fnmatchcase(spelling, spec):
+                    matches.extend(pkg for pkg in pkgs if pkg not in matches)
+            return matches
+        return list(self.by_spelling.get(spec, []))
+
+    def is_installed(self, spec: str) -> bool:
+        return bool(self.find(spec))
+
+    def installed_of(self, specs: list[str]) -> list[str]:
+        return [spec for spec in specs if self.is_installed(spec)]
+
+    def missing_of(self, specs: list[str]) -> list[str]:
+        return [spec for spec in specs if not self.is_installed(spec)]
+
+    def epochs(self, name: str) -> set[int]:
+        return {pkg.epoch for pkg in self.find(name)}
+
+    def query(
+        self,
+        name: str | None = None,
+        epoch: int | None = None,
+        release: str | None = None,
+        arch: str | None = None,
+        from_repo: str | None = None,
+    ) -> list[InstalledPackage]:
+        # Filters the installed set the way the quirks used to grep the output
+        # of `dnf list --installed`. name is a glob over package names, release
+        # a dist tag such as "fc41", every given filter has to match.
+        return [
+            pkg
+            for pkg in self.packages
+            if (name is None or fnmatch.fnmatchcase(pkg.name, name))
+            and (epoch is None or pkg.epoch == epoch)
+            and (release is None or pkg.has_release_tag(release))
+            and (arch is None or pkg.arch == arch)
+            and (from_repo is None or pkg.from_repo == from_repo)
+        ]
+
+
+class DnfSession:
+    # Holds one libdnf5 Base with the repo sack loaded for the whole process.
+    # Loading the sack is the most expensive part of any dnf operation, so
+    # every caller shares this instance. It is reloaded when invalidated after
+    # a repo configuration change, or when the rpmdb changed underneath it.
+    def __init__(self) -> None:
+        self._base: dnf5_base.Base | None = None
+        self._installed: InstalledPackageIndex | None = None
+        self._rpmdb_stamp: tuple = ()
+        self._refresh_metadata = True
+        self._lock = threading.RLock()
+
+    def _load_base(self) -> dnf5_base.Base:
+        base = dnf5_base.Base()
+        config = base.get_config()
+        if self._refresh_metadata:
+            # Check for fresh metadata on the first load of a run, later
+            # reloads in the same process reuse what was just downloaded.
+            config.get_metadata_expire_option().from_string("0")
+        config.get_obsoletes_option().from_string("true")
+
+        base.load_config()
+        parallel_option = config.get_max_parallel_downloads_option()
+        if parallel_option.get_priority() == dnf5_conf.Option.Priority_DEFAULT:
+            parallel_option.set(dnf5_conf.Option.Priority_RUNTIME, PARALLEL_DOWNLOADS)
+        base.setup()
+
+        sack = base.get_repo_sack()
+        sack.create_repos_from_system_configuration()
+        prefer_ranked_mirrors(base)
+        # Before load_repos, repo_gpgcheck repos ask for keys while loading
+        accept_repo_keys(base)
+        sack.load_repos()
+        self._refresh_metadata = False
+        return base
+
+    @contextlib.contextmanager
+    def base(self):
+        # Base objects are not thread safe, hold the lock for the whole use.
+        with self._lock:
+            self._check_rpmdb()
+            if self._base is None:
+                self._base = self._load_base()
+            yield self._base
+
+    def _check_rpmdb(self) -> None:
+        stamp = rpmdb_stamp()
+        if self._base is not None and stamp != self._rpmdb_stamp:
+            logger.debug("rpmdb changed outside of the shared dnf session, reloading")
+            self._base = None
+            self._installed = None
+        self._rpmdb_stamp = stamp
+
+    def installed(self) -> InstalledPackageIndex:
+        # Built once per rpmdb state, dropped together with the base
+        with self.base() as base:
+            if self._installed is None:
+                self._installed = InstalledPackageIndex.from_base(base)
+            return self._installed
+
+    def invalidate(self, refresh_metadata: bool = False) -> None:
+        with self._lock:
+            if self._base is not None:
+                logger.debug("Invalidating shared dnf session")
+            self._base = None
+            self._installed = None
+            if refresh_metadata:
+                self._refresh_metadata = True
+
+
+dnf_session = DnfSession()
+
+
+def installed_packages() -> InstalledPackageIndex:
+    return dnf_session.installed()
+
+
+class UpdateCheckCache:
+    # Persists the last resolved upgrade list together with the repo metadata
+    # and rpmdb state it was computed from. If neither changed since, the
+    # result is still valid and the depsolve can be skipped. The key is only
+    # as fresh as the metadata on disk, so explicit checks refresh the
+    # metadata first (updatechecker(refresh_metadata=True)) and a newly
+    # published repomd.xml invalidates the cached result by itself.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def repo_checksums(base: dnf5_base.Base) -> dict[str, str]:
+        checksums = {}
+        query = dnf5_repo.RepoQuery(base)
+        query.filter_enabled(True)
+        for repo in query:
+            repomd = Path(repo.get_cachedir()) / "repodata" / "repomd.xml"
+            try:
+                checksums[repo.get_id()] = hashlib.sha256(repomd.read_bytes()).hexdigest()
+            except OSError:
+                checksums[repo.get_id()] = ""
+        return checksums
+
+    def key(self, base: dnf5_base.Base) -> str:
+        state = {
+            "repos": self.repo_checksums(base),
+            "rpmdb": rpmdb_cookie(),
+        }
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key: str) -> list[str] | None:
+        with self._lock:
+            try:
+                with self.path.open() as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if data.get("key") != key:
+            return None
+        return list(data.get("updates", []))
+
+    def store(self, key: str, updates: list[str]) -> None:
+        with self._lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                with tmp_path.open("w") as f:
+                    json.dump({"key": key, "timestamp": time.time(), "updates": updates}, f)
+                tmp_path.replace(self.path)
+            except OSError as e:
+                logger.warning("Could not write update check cache: %s", e)
+
+    def clear(self) -> None:
+        with self._lock:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not clear update check cache: %s", e)
+
+
+update_cache = UpdateCheckCache(CACHE_DIR / "updatecheck.json")
+
+
 def repoindex(retries: int = 3, delay: int = 5) -> list[AttributeDict]:
     def get_safe_value(option):
         try:
@@ -80,157 +408,776 @@ def repoindex(retries: int = 3, delay: int = 5) -> list[AttributeDict]:
 
     attempt = 0
     while attempt < retries:
-        base = dnf5_base.Base()
         try:
-            base.load_config()
-            base.setup()
-
-            sack = base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos()
-            
-            enabled_repos = []
-            query = dnf5_repo.RepoQuery(base)
-
-            for repo in query:
-                config = repo.get_config()
-                enabled = get_safe_value(config.get_enabled_option())
-                if enabled:
-                    repo_id = repo.get_id()
-                    metalink = get_safe_value(config.get_metalink_option())
-                    mirrorlist = get_safe_value(config.get_mirrorlist_option())
-                    raw_baseurl = get_safe_value(config.get_baseurl_option())
-                    baseurl = list(raw_baseurl) if raw_baseurl is not None else None
-                    enabled_repos.append(AttributeDict(repo_id, metalink, mirrorlist, baseurl))
-
-            return enabled_repos
+            with dnf_session.base() as base:
+                enabled_repos = []
+                query = dnf5_repo.RepoQuery(base)
+
+                for repo in query:
+                    config = repo.get_config()
+                    enabled = get_safe_value(config.get_enabled_option())
+                    if enabled:
+                        repo_id = repo.get_id()
+                        metalink = get_safe_value(config.get_metalink_option())
+                        mirrorlist = get_safe_value(config.get_mirrorlist_option())
+                        raw_baseurl = get_safe_value(config.get_baseurl_option())
+                        baseurl = list(raw_baseurl) if raw_baseurl is not None else None
+                        enabled_repos.append(AttributeDict(repo_id, metalink, mirrorlist, baseurl))
+
+                return enabled_repos
 
         except Exception as e:
             attempt += 1
+            dnf_session.invalidate()
             logger.error("Attempt %d failed with error: %s. Retrying...", attempt, e)
             if attempt < retries:
                 time.sleep(delay)
             else:
                 raise Exception(f"Failed to complete operation after {retries} attempts")
-        finally:
-            del base
 
-def updatechecker(retries: int = 3, delay: int = 5) -> list[str]:
+def updatechecker(
+    retries: int = 3, delay: int = 5, force_refresh: bool = False, refresh_metadata: bool = False
+) -> list[str]:
+    # refresh_metadata reloads the sack with metadata_expire=0, for checks the
+    # user asked for. A long running window would otherwise keep using what
+    # was on disk until the repos' own expiry.
+    if force_refresh:
+        # Drop both the cached result and the loaded sack so metadata is re-fetched
+        update_cache.clear()
+        dnf_session.invalidate(refresh_metadata=True)
+    elif refresh_metadata:
+        dnf_session.invalidate(refresh_metadata=True)
+
     attempt = 0
     while attempt < retries:
-        base = dnf5_base.Base()
         try:
-            config = base.get_config()
-            config.get_metadata_expire_option().from_string("0")
-            config.get_obsoletes_option().from_string("true")
-
-            base.load_config()
-            base.setup()
+            with dnf_session.base() as base:
+                cache_key = update_cache.key(base)
+                cached = update_cache.load(cache_key)
+                if cached is not None:
+                    return cached
 
-            sack = base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos()
+                config = base.get_config()
+                goal = dnf5_base.Goal(base)
+                goal.add_upgrade("*")
 
-            goal = dnf5_base.Goal(base)
-            goal.add_upgrade("*")
-
-            try:
-                install_only_names = config.installonlypkgs
-            except AttributeError:
-                install_only_names = []
+                try:
+                    install_only_names = config.installonlypkgs
+                except AttributeError:
+                    install_only_names = []
 
-            for name in install_only_names:
-                goal.add_upgrade(name)
+                for name in install_only_names:
+                    goal.add_upgrade(name)
 
-            transaction = goal.resolve()
-            upgrades = []
-            t_pkgs = transaction.get_transaction_packages()
-            for t_pkg in t_pkgs:
-                action = t_pkg.get_action()
-                valid_actions = [
-                    dnf5_trans.TransactionItemAction_UPGRADE,
-                    dnf5_trans.TransactionItemAction_INSTALL
-                ]
+                transaction = goal.resolve()
+                upgrades = []
+                t_pkgs = transaction.get_transaction_packages()
+                for t_pkg in t_pkgs:
+                    action = t_pkg.get_action()
+                    valid_actions = [
+                        dnf5_trans.TransactionItemAction_UPGRADE,
+                        dnf5_trans.TransactionItemAction_INSTALL
+                    ]
 
-                if action in valid_actions:
-                    upgrades.append(t_pkg.get_package().get_name())
+                    if action in valid_actions:
+                        upgrades.append(t_pkg.get_package().get_name())
 
-            return list(set(upgrades))
+                upgrades = list(set(upgrades))
+                update_cache.store(cache_key, upgrades)
+                return upgrades
 
         except Exception as e:
             attempt += 1
+            dnf_session.invalidate()
             logger.error(f"Update check attempt {attempt} failed: {e}")
             if attempt >= retries:
                 raise
             time.sleep(delay)
-        finally:
-            del base
 
-class CustomTransactionDisplay(dnf.yum.rpmtrans.LoggingTransactionDisplay):
-    def __init__(self, total_packages):
+class ProgressEvent:
+    # A single structured progress report from TransactionEngine.
+    #   kind: "download", "download-end", "install", "remove", "scriptlet",
+    #         "scriptlet-error" or "transaction"
+    def __init__(
+        self,
+        kind: str,
+        package: str = "",
+        done: int = 0,
+        total: int = 0,
+        detail: str = "",
+    ) -> None:
+        self.kind = kind
+        self.package = package
+        self.done = done
+        self.total = total
+        self.detail = detail
+
+    def fraction(self) -> float:
+        if self.total <= 0:
+            return 0.0
+        return min(1.0, self.done / self.total)
+
+
+class DownloadProgress(dnf5_repo.DownloadCallbacks):
+    def __init__(self, report) -> None:
+        super().__init__()
+        self.report = report
+        self.descriptions: list[str] = []
+        self.last_percent: dict[int, int] = {}
+
+    def add_new_download(self, user_data, description, total_to_download):
+        self.descriptions.append(description)
+        index = len(self.descriptions) - 1
+        self.report(ProgressEvent("download", description, 0, int(total_to_download)))
+        return index
+
+    def progress(self, user_cb_data, total_to_download, downloaded):
+        # librepo calls this very often, only report whole percent steps
+        percent = int(downloaded * 100 / total_to_download) if total_to_download > 0 else 0
+        if self.last_percent.get(user_cb_data) != percent:
+            self.last_percent[user_cb_data] = percent
+            self.report(
+                ProgressEvent(
+                    "download",
+                    self.descriptions[user_cb_data],
+                    int(downloaded),
+                    int(total_to_download),
+                )
+            )
+        return 0
+
+    def end(self, user_cb_data, status, msg):
+        self.report(
+            ProgressEvent(
+                "download-end",
+                self.descriptions[user_cb_data],
+                detail=msg or "",
+            )
+        )
+        return 0
+
+    def mirror_failure(self, user_cb_data, msg, url, metadata):
+        logger.warning("Mirror failure for %s: %s", url, msg)
+        return 0
+
+
+class RepoKeyImport(dnf5_repo.RepoCallbacks):
+    # The dnf5 command this replaced ran with -y, which imports a repo's new
+    # signing key without asking. Without callbacks libdnf5 declines the
+    # import, and the first update after a repo adds or rotates its key
+    # fails the signature check. Both Transaction.check_gpg_signatures() and
+    # load_repos() (for repo_gpgcheck) ask through here. Only keys from the
+    # repo's configured gpgkey URLs are offered, a package signed with any
+    # other key still fails.
+    def repokey_import(self, key_info):
+        logger.info(
+            "Importing signing key %s (%s) from %s",
+            key_info.get_short_key_id(),
+            ", ".join(key_info.get_user_ids()),
+            key_info.get_url(),
+        )
+        return True
+
+
+def accept_repo_keys(base: dnf5_base.Base) -> None:
+    # Each repo owns its callbacks, so every one gets its own instance
+    query = dnf5_repo.RepoQuery(base)
+    for repo in query:
+        repo.set_callbacks(dnf5_repo.RepoCallbacksUniquePtr(RepoKeyImport()))
+
+
+class InstallProgress(dnf5_rpm.TransactionCallbacks):
+    def __init__(self, report, total_packages: int) -> None:
         super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.scriptlet_progress = {}
-        self.performing_cleanup = 0
-        self.performing_upgrade = 0
-        self.starting_line = 0
+        self.report = report
         self.total_packages = total_packages
+        self.current = 0
         self.package = ""
 
-    def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
-        super().progress(package, action, ti_done, ti_total, ts_done, ts_total)
-        action_str = self._get_action_str(action)
-        package_name = str(package)
+    def _step(self, kind: str, item) -> None:
+        package_name = item.get_package().get_full_nevra() if item is not None else ""
+        if package_name and package_name != self.package:
+            self.package = package_name
+            self.current += 1
+            self.report(ProgressEvent(kind, package_name, self.current, self.total_packages))
 
-        match action_str:
-            case "Upgraded:" | "Preparing:" | "Reinstalled:" | "Downgraded:" | "Obsoleted:" | "Cleanup:":
-                return  # Skip logging for these actions
+    def transaction_start(self, total):
+        self.report(ProgressEvent("transaction", detail="Running transaction", total=int(total)))
 
-        if action_str == "Running scriptlet:":
-            if self.performing_cleanup == 0:
-                self.logger.info("Cleanup...")
-                self.performing_cleanup = 1
-            else:
-                return
-        else:
-            if self.performing_upgrade == 0:
-                if action_str == "Upgrading:":
-                    self.logger.info("Upgrading...")
-                if action_str == "Removing:":
-                    self.logger.info("Removing...")
-                if action_str == "Downgrading:":
-                    self.logger.info("Downgrading...")
-                if action_str == "Installing:":
-                    self.logger.info("Installing...")
-
-                self.performing_upgrade = 1
-
-            if self.package != package_name:
-                self.starting_line += 1
-                if self.starting_line <= self.total_packages:
-                    self.package = package_name
-                    self.logger.info(f"    ({self.starting_line}/{self.total_packages}) {action_str} {package_name}")
+    def install_start(self, item, total):
+        self._step("install", item)
+
+    def uninstall_start(self, item, total):
+        self._step("remove", item)
+
+    def script_start(self, item, nevra, type):
+        self.report(
+            ProgressEvent(
+                "scriptlet",
+                dnf5_rpm.to_full_nevra_string(nevra),
+                detail=dnf5_rpm.TransactionCallbacks.script_type_to_string(type),
+            )
+        )
+
+    def script_error(self, item, nevra, type, return_code):
+        self.report(
+            ProgressEvent(
+                "scriptlet-error",
+                dnf5_rpm.to_full_nevra_string(nevra),
+                detail=f"{dnf5_rpm.TransactionCallbacks.script_type_to_string(type)} returned {return_code}",
+            )
+        )
+
+    def unpack_error(self, item):
+        self.report(ProgressEvent("scriptlet-error", item.get_package().get_full_nevra(), detail="unpack error"))
+
+
+INBOUND_ACTIONS = (
+    dnf5_trans.TransactionItemAction_INSTALL,
+    dnf5_trans.TransactionItemAction_UPGRADE,
+    dnf5_trans.TransactionItemAction_DOWNGRADE,
+    dnf5_trans.TransactionItemAction_REINSTALL,
+)
+
+
+class PackageCache:
+    # Content-addressed store of downloaded rpms, keyed on the package checksum
+    # from the repo metadata. The same rpm needed by several transactions
+    # (quirks, media fixup, system updates) is only downloaded once, partial
+    # downloads are resumed on the next attempt and transactions install from
+    # hardlinks into libdnf5's package directory without touching the network.
+    # Like dnf's keepcache=False, an rpm is deleted once the transaction that
+    # installed it committed, only downloads not used yet are kept.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.partial_path = path / "partial"
+        self._lock = threading.Lock()
+        # Entries whose content was hashed this run, with the inode and size
+        # they had then, so each rpm is only read once per run
+        self._verified: dict[Path, tuple[int, int]] = {}
+
+    @staticmethod
+    def checksum(pkg) -> str:
+        return pkg.get_checksum().get_checksum()
+
+    def entry(self, pkg) -> Path:
+        return self.path / f"{self.checksum(pkg)}.rpm"
+
+    @staticmethod
+    def matches_checksum(path: Path, pkg) -> bool:
+        # Hashes the file with the algorithm the repo metadata uses for pkg
+        checksum = pkg.get_checksum()
+        try:
+            digest = hashlib.new(checksum.get_type_str().lower())
+        except ValueError:
+            logger.warning("Unknown checksum type %s for %s", checksum.get_type_str(), pkg.get_full_nevra())
+            return False
+        try:
+            with path.open("rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except OSError:
+            return False
+        return digest.hexdigest() == checksum.get_checksum()
+
+    def is_cached(self, pkg) -> bool:
+        # The size rules out partial files cheaply, the checksum catches
+        # corrupted or truncated-and-padded ones before they are installed
+        entry = self.entry(pkg)
+        try:
+            st = entry.stat()
+        except OSError:
+            return False
+        if st.st_size != pkg.get_download_size():
+            return False
+        if self._verified.get(entry) == (st.st_ino, st.st_size):
+            return True
+        if not self.matches_checksum(entry, pkg):
+            logger.warning("Cached %s doesn't match its checksum, downloading it again", pkg.get_full_nevra())
+            entry.unlink(missing_ok=True)
+            return False
+        self._verified[entry] = (st.st_ino, st.st_size)
+        return True
+
+    def prune(
+        self,
+        max_age_days: int = PACKAGE_CACHE_MAX_AGE_DAYS,
+        max_bytes: int = PACKAGE_CACHE_MAX_BYTES,
+    ) -> None:
+        cutoff = time.time() - max_age_days * 86400
+        entries = []
+        for entry in self.path.glob("*.rpm"):
+            try:
+                st = entry.stat()
+                if st.st_mtime < cutoff:
+                    entry.unlink()
                 else:
-                    return
+                    entries.append((st.st_mtime, st.st_size, entry))
+            except OSError:
+                pass
+        # Abandoned partial downloads age out the same way
+        for partial in self.partial_path.glob("*"):
+            try:
+                if partial.stat().st_mtime < cutoff:
+                    shutil.rmtree(partial, ignore_errors=True)
+            except OSError:
+                pass
+
+        # Least recently used first (link_into_place touches entries). What
+        # was fetched in this run is waiting for its transaction, keep it.
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda item: item[0]):
+            if total <= max_bytes:
+                break
+            if entry in self._verified:
+                continue
+            entry.unlink(missing_ok=True)
+            total -= size
+
+    def release(self, packages: list) -> None:
+        # The transaction that needed these committed, they are installed now
+        with self._lock:
+            for pkg in packages:
+                if pkg.is_available_locally():
+                    continue
+                entry = self.entry(pkg)
+                self._verified.pop(entry, None)
+                entry.unlink(missing_ok=True)
+
+    def fetch(self, base: dnf5_base.Base, packages: list, report=None) -> None:
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.prune()
+
+            missing = {}
+            for pkg in packages:
+                # Local repos are already on disk, nothing to cache
+                if pkg.is_available_locally():
+                    continue
+                if not self.is_cached(pkg):
+                    missing.setdefault(self.checksum(pkg), pkg)
+
+            if missing:
+                logger.info("Downloading %d package(s)...", len(missing))
+                if report is not None:
+                    base.set_download_callbacks(dnf5_repo.DownloadCallbacksUniquePtr(DownloadProgress(report)))
+                downloader = dnf5_repo.PackageDownloader(base)
+                downloader.set_resume(True)
+                downloader.set_fail_fast(False)
+                for checksum, pkg in missing.items():
+                    # One directory per checksum keeps equally named rpms apart
+                    destination = self.partial_path / checksum
+                    destination.mkdir(parents=True, exist_ok=True)
+                    downloader.add(pkg, str(destination))
+                try:
+                    downloader.download()
+                finally:
+                    # Keep whatever completed even if some downloads failed
+                    for checksum, pkg in missing.items():
+                        destination = self.partial_path / checksum
+                        downloaded = destination / Path(pkg.get_location()).name
+                        if not downloaded.exists() or downloaded.stat().st_size != pkg.get_download_size():
+                            continue
+                        if not self.matches_checksum(downloaded, pkg):
+                            # Resuming from this would only keep the bad bytes
+                            logger.warning("Download of %s doesn't match its checksum", pkg.get_full_nevra())
+                            shutil.rmtree(destination, ignore_errors=True)
+                            continue
+                        entry = self.entry(pkg)
+                        downloaded.replace(entry)
+                        st = entry.stat()
+                        self._verified[entry] = (st.st_ino, st.st_size)
+                        shutil.rmtree(destination, ignore_errors=True)
+
+            for pkg in packages:
+                if pkg.is_available_locally():
+                    continue
+                if not self.entry(pkg).exists():
+                    raise Exception(f"No verified download of {pkg.get_full_nevra()}")
+                self.link_into_place(pkg)
+
+    def link_into_place(self, pkg) -> None:
+        entry = self.entry(pkg)
+        target = Path(pkg.get_package_path())
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.unlink(missing_ok=True)
+        try:
+            os.link(entry, target)
+        except OSError:
+            # Cache and libdnf5 cachedir on different filesystems
+            shutil.copy2(entry, target)
+        # Mark the entry as recently used for prune()
+        os.utime(entry)
+
+
+package_cache = PackageCache(CACHE_DIR / "packages")
+
+
+def prefetch_packages(
+    install: list[str] | None = None,
+    upgrade: list[str] | None = None,
+    report=None,
+) -> None:
+    # Download everything a later transaction will need up front, so that the
+    # transaction itself (often run after packages were already removed) does
+    # not depend on the network.
+    try:
+        with dnf_session.base() as base:
+            goal = dnf5_base.Goal(base)
+            # Only the package set matters here, not whether it installs cleanly
+            # on top of what is installed right now.
+            goal.set_allow_erasing(True)
+            for spec in install or []:
+                goal.add_install(spec)
+            for spec in upgrade or []:
+                goal.add_upgrade(spec)
+            transaction = goal.resolve()
+            packages = [
+                t_pkg.get_package()
+                for t_pkg in transaction.get_transaction_packages()
+                if t_pkg.get_action() in INBOUND_ACTIONS
+            ]
+            if packages:
+                package_cache.fetch(base, packages, report)
+    except Exception as e:
+        logger.warning("Could not prefetch packages: %s", e)
+
+
+class TransactionEngine:
+    # Resolves and runs package transactions in-process on the shared dnf
+    # session, reporting ProgressEvents instead of scraping dnf5 output.
+    def __init__(self, report=None, logger: logging.Logger | None = None) -> None:
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.report = report if report is not None else self.log_event
+        # Set by run() when the goal didn't resolve, as opposed to failing later
+        self.unresolved = False
+
+    def log_event(self, event: ProgressEvent) -> None:
+        match event.kind:
+            case "download":
+                # Only log the start of a download, the byte counts are for listeners
+                if event.done == 0:
+                    self.logger.info(
+                        "    Downloading %s (%d KiB)",
+                        event.package,
+                        event.total // 1024,
+                        extra={"package": event.package, "action": "download"},
+                    )
+            case "install" | "remove":
+                verb = "Installing" if event.kind == "install" else "Removing"
+                self.logger.info(
+                    "    (%d/%d) %s %s",
+                    event.done,
+                    event.total,
+                    verb,
+                    event.package,
+                    extra={"package": event.package, "action": event.kind},
+                )
+            case "scriptlet":
+                self.logger.debug("    Running %s scriptlet: %s", event.detail, event.package)
+            case "scriptlet-error":
+                self.logger.warning("    Scriptlet failed for %s: %s", event.package, event.detail)
+            case "transaction":
+                self.logger.info("%s...", event.detail)
+
+    def log_transaction_summary(self, t_pkgs) -> None:
+        self.logger.info("Transaction summary:")
+        for t_pkg in t_pkgs:
+            self.logger.info(
+                "    %-12s %s",
+                dnf5_trans.transaction_item_action_to_string(t_pkg.get_action()),
+                t_pkg.get_package().get_full_nevra(),
+            )
+
+    def _resolve(self, base, install, remove, upgrade, reinstall, allow_erasing):
+        # The resolved transaction, or None after logging why it didn't resolve
+        goal = dnf5_base.Goal(base)
+        goal.set_allow_erasing(allow_erasing)
+        for spec in install or []:
+            goal.add_install(spec)
+        for spec in remove or []:
+            goal.add_remove(spec)
+        for spec in upgrade or []:
+            goal.add_upgrade(spec)
+        for spec in reinstall or []:
+            goal.add_reinstall(spec)
+
+        transaction = goal.resolve()
+        if transaction.get_problems() != dnf5_base.GoalProblem_NO_PROBLEM:
+            for problem in transaction.get_resolve_logs_as_strings():
+                self.logger.error(problem)
+            return None
+        return transaction
+
+    def resolves(
+        self,
+        install: list[str] | None = None,
+        remove: list[str] | None = None,
+        upgrade: list[str] | None = None,
+        reinstall: list[str] | None = None,
+        allow_erasing: bool = False,
+    ) -> bool:
+        # Only depsolves, nothing is downloaded or logged unless it fails
+        with dnf_session.base() as base:
+            return self._resolve(base, install, remove, upgrade, reinstall, allow_erasing) is not None
+
+    def run(
+        self,
+        install: list[str] | None = None,
+        remove: list[str] | None = None,
+        upgrade: list[str] | None = None,
+        reinstall: list[str] | None = None,
+        allow_erasing: bool = False,
+        description: str = "nobara-updater",
+        dry_run: bool = False,
+    ) -> bool:
+        with dnf_session.base() as base:
+            transaction = self._resolve(base, install, remove, upgrade, reinstall, allow_erasing)
+            self.unresolved = transaction is None
+            if self.unresolved:
+                return False
 
-    def _get_action_str(self, action):
-        action_map = {
-            dnf.transaction.PKG_DOWNGRADE: 'Downgrading:',
-            dnf.transaction.PKG_DOWNGRADED: 'Downgraded:',
-            dnf.transaction.PKG_INSTALL: 'Installing:',
-            dnf.transaction.PKG_OBSOLETE: 'Obsoleting:',
-            dnf.transaction.PKG_OBSOLETED: 'Obsoleted:',
-            dnf.transaction.PKG_REINSTALL: 'Reinstalling:',
-            dnf.transaction.PKG_REINSTALLED: 'Reinstalled:',
-            dnf.transaction.PKG_REMOVE: 'Removing:',
-            dnf.transaction.PKG_UPGRADE: 'Upgrading:',
-            dnf.transaction.PKG_UPGRADED: 'Upgraded:',
-            dnf.transaction.PKG_CLEANUP: 'Cleanup:',
-            dnf.transaction.PKG_VERIFY: 'Verified:',
-            dnf.transaction.PKG_SCRIPTLET: 'Running scriptlet:',
-            dnf.transaction.TRANS_PREPARATION: 'Preparing:',
+            t_pkgs = transaction.get_transaction_packages()
+            if not t_pkgs:
+                self.logger.info("Nothing to do.")
+                return True
+
+            self.log_transaction_summary(t_pkgs)
+            if dry_run:
+                self.logger.info("Dry run, not running the transaction.")
+                return True
+
+            inbound = [t_pkg.get_package() for t_pkg in t_pkgs if t_pkg.get_action() in INBOUND_ACTIONS]
+            package_cache.fetch(base, inbound, self.report)
+
+            if not transaction.check_gpg_signatures():
+                for problem in transaction.get_gpg_signature_problems():
+                    self.logger.error(problem)
+                return False
+
+            transaction.set_callbacks(
+                dnf5_rpm.TransactionCallbacksUniquePtr(InstallProgress(self.report, len(t_pkgs)))
+            )
+            transaction.set_description(description)
+            start = time.monotonic()
+            try:
+                result = transaction.run()
+            finally:
+                # The rpmdb changed underneath the shared sack
+                dnf_session.invalidate()
+            fields = {"action": "transaction", "duration": round(time.monotonic() - start, 3)}
+
+            if result != dnf5_base.Transaction.TransactionRunResult_SUCCESS:
+                self.logger.error(
+                    "Transaction failed: %s",
+                    dnf5_base.Transaction.transaction_result_to_string(result),
+                    extra={**fields, "status": "failed"},
+                )
+                for problem in transaction.get_transaction_problems():
+                    self.logger.error(problem)
+                return False
+            self.logger.info(
+                "Transaction complete (%.1fs)", fields["duration"], extra={**fields, "status": "ok"}
+            )
+            package_cache.release(inbound)
+            return True
+
+
+class PlanIntent:
+    # What one caller asked of a TransactionPlan, kept apart so the plan can
+    # still apply it on its own when the merged transaction doesn't resolve
+    def __init__(self, label: str = "") -> None:
+        self.label = label
+        self.install: list[str] = []
+        self.remove: list[str] = []
+        self.upgrade: list[str] = []
+        self.allow_erasing = False
+        self.post_commit: list = []
+
+    def is_empty(self) -> bool:
+        return not (self.install or self.remove or self.upgrade)
+
+
+class TransactionPlan:
+    # Collects install/remove/upgrade/replace intents from many callers and
+    # resolves and commits them as one libdnf5 transaction, instead of one
+    # depsolve, rpmdb lock and scriptlet pass per caller. If the merged
+    # transaction doesn't resolve, every intent is committed on its own, so
+    # one broken intent doesn't hold back the others.
+    def __init__(self, logger: logging.Logger | None = None) -> None:
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.intents: list[PlanIntent] = []
+        # Calls made inside intent() add to this one instead of starting their own
+        self._current: PlanIntent | None = None
+
+    @contextlib.contextmanager
+    def intent(self, label: str):
+        # Groups the calls made inside into one intent, e.g. everything a
+        # quirk queues, so a remove + install pair is never split up.
+        # Dropped if the caller raises halfway through.
+        intent = PlanIntent(label)
+        self._current = intent
+        try:
+            yield intent
+        finally:
+            self._current = None
+        if not intent.is_empty():
+            self.intents.append(intent)
+
+    def _target(self) -> PlanIntent:
+        if self._current is not None:
+            return self._current
+        intent = PlanIntent()
+        self.intents.append(intent)
+        return intent
+
+    @staticmethod
+    def _extend(target: list[str], specs: str | list[str]) -> None:
+        for spec in [specs] if isinstance(specs, str) else specs:
+            if spec not in target:
+                target.append(spec)
+
+    def _merged(self, attr: str) -> list[str]:
+        merged: list[str] = []
+        for intent in self.intents:
+            self._extend(merged, getattr(intent, attr))
+        return merged
+
+    @property
+    def install(self) -> list[str]:
+        return self._merged("install")
+
+    @property
+    def remove(self) -> list[str]:
+        return self._merged("remove")
+
+    @property
+    def upgrade(self) -> list[str]:
+        return self._merged("upgrade")
+
+    def add_install(self, specs: str | list[str]) -> None:
+        self._extend(self._target().install, specs)
+
+    def add_remove(self, specs: str | list[str]) -> None:
+        self._extend(self._target().remove, specs)
+
+    def add_upgrade(self, specs: str | list[str]) -> None:
+        self._extend(self._target().upgrade, specs)
+
+    def add_replace(self, old_specs: str | list[str], new_specs: str | list[str]) -> None:
+        # The replacements are resolved together with the removals, so
+        # dependents of the old packages are kept if the new ones satisfy them.
+        target = self._target()
+        self._extend(target.remove, old_specs)
+        self._extend(target.install, new_specs)
+        target.allow_erasing = True
+
+    def add_post_commit(self, callback) -> None:
+        # Work that needs the planned packages in place, e.g. enabling a
+        # service. Belongs to the intent queued last and only runs if that
+        # intent was applied.
+        if self._current is not None:
+            self._current.post_commit.append(callback)
+        elif self.intents:
+            self.intents[-1].post_commit.append(callback)
+        else:
+            self.logger.warning("Post-commit callback without planned changes, running it now")
+            callback()
+
+    def is_empty(self) -> bool:
+        return all(intent.is_empty() for intent in self.intents)
+
+    def describe(self) -> str:
+        lines = []
+        for title, specs in (
+            ("Install", self.install),
+            ("Remove", self.remove),
+            ("Upgrade", self.upgrade),
+        ):
+            if specs:
+                lines.append(f"{title}:")
+                lines.extend(f"    {spec}" for spec in specs)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _goal_specs(install: list[str], remove: list[str], upgrade: list[str], allow_erasing: bool) -> dict:
+        # A spec that is both removed and installed means "give me a clean copy"
+        both = [spec for spec in install if spec in remove]
+        reinstall = installed_packages().installed_of(both)
+        return {
+            "install": [spec for spec in install if spec not in reinstall],
+            "remove": [spec for spec in remove if spec not in both],
+            "upgrade": upgrade,
+            "reinstall": reinstall,
+            "allow_erasing": allow_erasing,
         }
-        return action_map.get(action, action)
+
+    def _run(
+        self,
+        engine: TransactionEngine,
+        install: list[str],
+        remove: list[str],
+        upgrade: list[str],
+        allow_erasing: bool,
+        dry_run: bool,
+    ) -> bool:
+        return engine.run(
+            **self._goal_specs(install, remove, upgrade, allow_erasing),
+            description="nobara-updater planned transaction",
+            dry_run=dry_run,
+        )
+
+    def resolves(self, assume_removed: list[str] | None = None) -> bool:
+        # Whether the merged plan depsolves right now, without committing or
+        # clearing it. assume_removed is resolved as a removal with
+        # allow_erasing, for changes made outside the plan before it commits.
+        remove = self.remove
+        self._extend(remove, assume_removed or [])
+        return TransactionEngine(logger=self.logger).resolves(
+            **self._goal_specs(
+                self.install,
+                remove,
+                self.upgrade,
+                bool(assume_removed) or any(intent.allow_erasing for intent in self.intents),
+            )
+        )
+
+    def commit(self, dry_run: bool = False) -> bool:
+        intents = [intent for intent in self.intents if not intent.is_empty()]
+        if not intents:
+            self.intents = []
+            return True
+
+        self.logger.info("Planned package changes:\n%s", self.describe())
+        install, remove, upgrade = self.install, self.remove, self.upgrade
+        self.intents = []
+        engine = TransactionEngine(logger=self.logger)
+        ok = self._run(
+            engine,
+            install,
+            remove,
+            upgrade,
+            any(intent.allow_erasing for intent in intents),
+            dry_run,
+        )
+        applied = intents if ok else []
+        if not ok and engine.unresolved and len(intents) > 1:
+            self.logger.warning("The planned changes don't resolve together, applying them one at a time")
+            ok = True
+            for intent in intents:
+                if self._run(
+                    engine, intent.install, intent.remove, intent.upgrade, intent.allow_erasing, dry_run
+                ):
+                    applied.append(intent)
+                else:
+                    self.logger.error("Could not apply %s", intent.label or "planned change")
+                    ok = False
+        if not dry_run:
+            for intent in applied:
+                for callback in intent.post_commit:
+                    callback()
+        return ok
+
 
 class PackageUpdater:
     def __init__(
@@ -239,60 +1186,35 @@ class PackageUpdater:
         action: str,
         liststore: Gtk.ListStore,
         logger: logging.Logger | None = None,
+        progress_callback=None,
     ):
         self.package_names = package_names
         self.liststore = liststore
-        self.log_queue: queue.Queue[str] = queue.Queue()
-        self.queue_handler = QueueHandler(self.log_queue)
         self.logger = logger if logger is not None else logging.getLogger()
-        self.logger.addHandler(self.queue_handler)
-        self.logger.setLevel(logging.INFO)
-        # Right now update_packages doesn't provide sufficient logging.
-        # It also doesn't correctly log in the dnf history
-        # Use DNF command for now
-        #self.update_packages(action)
-        self.update_packages_dnf_command(action)
-
-
-    def update_packages_dnf_command(self, action: str, retries: int = 3, delay: int = 5) -> None:
-        def _looks_like_dependency_conflict(lines: List[str]) -> bool:
-            needles = (
-                "Problem ",
-                "Skipping packages with conflicts",
-                "Skipping packages with broken dependencies",
-                "conflicts",
-                "broken dependencies",
-                "cannot install",
-                "Transaction check error",
-                "Error:",
-            )
-            return any(any(n in line for n in needles) for line in lines)
+        self.progress_callback = progress_callback
+        self.update_packages(action)
 
+    def log_failure(self) -> None:
+        self.logger.error("==================================================")
+        self.logger.error("ERROR: DNF Package update are incomplete or failed due to conflicts/broken dependencies.")
+        self.logger.error("ERROR: Please see ~/.local/share/nobara-updater/nobara-sync.log for more details")
+        self.logger.error("ERROR: You can press the 'Open Log File' button on the Update System app to view it.")
+        self.logger.error("==================================================")
+
+    def update_packages(self, action: str, retries: int = 3, delay: int = 5) -> None:
         if not self.package_names:
             raise ValueError("No package names provided")
 
-        action_map = {"upgrade": "update", "install": "install", "remove": "remove"}
-        if action not in action_map:
+        if action not in ("upgrade", "install", "remove"):
             raise ValueError(f"Invalid action: {action!r}")
-            
-        installed_set = set()
+
+        installed = None
         try:
-            temp_base = dnf5_base.Base()
-            temp_base.load_config()
-            temp_base.setup()
-            sack = temp_base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos() 
-            installed_query = dnf5_rpm.PackageQuery(temp_base)
-            installed_query.filter_installed()
-            installed_set = {pkg.get_name() for pkg in installed_query}
-            del installed_query
-            del sack
-            del temp_base
+            installed = installed_packages()
         except Exception as e:
             self.logger.warning("Could not pre-filter installed packages: %s", e)
-        if action == "upgrade":
-            targets = [p for p in self.package_names if p in installed_set]
+        if action == "upgrade" and installed is not None:
+            targets = installed.installed_of(self.package_names)
             if not targets:
                 targets = self.package_names
         else:
@@ -304,55 +1226,29 @@ class PackageUpdater:
             "remove": "Removing packages:",
         }[action]
 
-        cmd = ["dnf5", action_map[action], "--refresh", "-y", *targets]
-
         self.logger.info("%s\n%s", action_log_string, "\n".join(self.package_names))
 
+        engine = TransactionEngine(self.progress_callback, self.logger)
         for attempt in range(1, retries + 1):
             try:
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding="utf-8",
-                    errors="replace",
-                    bufsize=1,
+                ok = engine.run(
+                    **{action: targets},
+                    description=f"nobara-updater {action}",
                 )
-
-                output_lines: List[str] = []
-                assert process.stdout is not None
-                for raw in process.stdout:
-                    line = raw.rstrip("\n")
-                    output_lines.append(line)
-                    self.logger.info(line)
-
-                rc = process.wait()
-
-                # Treat "conflict-style" output as failure even if rc == 0 (your example case)
-                if _looks_like_dependency_conflict(output_lines):
-                    self.logger.error("==================================================")
-                    self.logger.error("ERROR: DNF Package update are incomplete or failed due to conflicts/broken dependencies.")
-                    self.logger.error("ERROR: Please see ~/.local/share/nobara-updater/nobara-sync.log for more details")
-                    self.logger.error("ERROR: You can press the 'Open Log File' button on the Update System app to view it.")
-                    self.logger.error("==================================================")
-                    return  # <-- IMPORTANT: exit normally (0) so GUI can reset buttons
-
-                if rc != 0:
-                    self.logger.error("==================================================")
-                    self.logger.error("ERROR: DNF Package update are incomplete or failed due to conflicts/broken dependencies.")
-                    self.logger.error("ERROR: Please see ~/.local/share/nobara-updater/nobara-sync.log for more details")
-                    self.logger.error("ERROR: You can press the 'Open Log File' button on the Update System app to view it.")
-                    self.logger.error("==================================================")
-                    return  # <-- exit normally
+                if not ok:
+                    # Resolve, signature and rpm problems are not transient, don't retry
+                    self.log_failure()
+                    return
 
                 self.logger.info("DNF System Updates complete!")
                 return
 
             except Exception as e:
+                # Download or librepo errors, start again from a freshly loaded sack
+                dnf_session.invalidate()
                 self.logger.error("Attempt %d/%d failed: %s", attempt, retries, e)
                 if attempt < retries:
                     time.sleep(delay)
                 else:
-
+                    self.log_failure()
                     return  # <-- exit normally even on final failure
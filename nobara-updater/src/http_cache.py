@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import requests
+
+logger = logging.getLogger()
+
+
+class CachedResponse:
+    # The parts of a requests.Response the callers use, either fresh from
+    # the server or served from the on-disk copy
+    def __init__(
+        self, url: str, status_code: int, content: bytes, from_cache: bool = False, stale: bool = False
+    ) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        # True on a 304 or when the cached copy stands in for an unreachable server
+        self.from_cache = from_cache
+        # True only in the second case
+        self.stale = stale
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+
+class HttpCache:
+    # Keeps the last body of each url together with its ETag / Last-Modified
+    # validators and revalidates with a conditional GET, so an unchanged
+    # document costs a 304 without payload.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _paths(self, url: str) -> tuple[Path, Path]:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.path / f"{key}.json", self.path / f"{key}.body"
+
+    def cached(self, url: str) -> CachedResponse | None:
+        meta_path, body_path = self._paths(url)
+        with self._lock:
+            try:
+                with meta_path.open() as f:
+                    meta = json.load(f)
+                content = body_path.read_bytes()
+            except (OSError, ValueError):
+                return None
+        if meta.get("url") != url:
+            return None
+        return CachedResponse(url, 200, content, from_cache=True)
+
+    def _validators(self, url: str) -> dict[str, str]:
+        meta_path, _ = self._paths(url)
+        try:
+            with meta_path.open() as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if meta.get("url") != url:
+            return {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def _store(self, url: str, response: requests.Response) -> None:
+        meta_path, body_path = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "timestamp": time.time(),
+        }
+        with self._lock:
+            try:
+                self.path.mkdir(parents=True, exist_ok=True)
+                tmp_body = body_path.with_suffix(".tmp")
+                tmp_body.write_bytes(response.content)
+                tmp_body.replace(body_path)
+                tmp_meta = meta_path.with_suffix(".tmp")
+                with tmp_meta.open("w") as f:
+                    json.dump(meta, f)
+                tmp_meta.replace(meta_path)
+            except OSError as e:
+                logger.warning("Could not cache %s: %s", url, e)
+
+    def get(
+        self,
+        url: str,
+        request: Callable[..., requests.Response] | None = None,
+        offline_fallback: bool = False,
+        **kwargs,
+    ) -> CachedResponse:
+        # request defaults to requests.get and is called as request(url, headers=...).
+        # With offline_fallback, a connection error or timeout returns the
+        # cached copy marked stale instead of raising.
+        if request is None:
+            request = requests.get
+        base_headers = dict(kwargs.pop("headers", {}) or {})
+        headers = {**base_headers, **self._validators(url)}
+        try:
+            response = request(url, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            cached = self.cached(url) if offline_fallback else None
+            if cached is None:
+                raise
+            logger.debug("Serving cached copy of %s, server unreachable", url)
+            cached.stale = True
+            return cached
+
+        if response.status_code == 304:
+            cached = self.cached(url)
+            if cached is not None:
+                return cached
+            # Lost the body somehow, ask again without validators
+            response = request(url, headers=base_headers, **kwargs)
+
+        if response.status_code == 200:
+            self._store(url, response)
+        return CachedResponse(url, response.status_code, response.content)
@@ -0,0 +1,240 @@
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# A log is rotated once it is this large, at startup or while writing
+MAX_LOG_BYTES = 8 * 1024 * 1024
+# or when its first run started this long ago, checked at startup
+MAX_LOG_AGE = 7 * 24 * 3600
+# Rotated segments kept per log, and for how long at most
+MAX_SEGMENTS = 20
+MAX_SEGMENT_AGE = 90 * 24 * 3600
+INDEX_NAME = "index.json"
+
+SEGMENT_SUFFIX = re.compile(r"\.(\d{8}-\d{6})(-\d+)?(\.gz)?$")
+# Names used by the old rotate-on-every-start scheme, nobara-sync.log.1 to .5
+LEGACY_SUFFIX = re.compile(r"\.\d$")
+
+
+class LogRotation:
+    # Rotates the logs in one directory by size and age into timestamped
+    # segments (nobara-sync.log.20250101-120000), gzips those in the
+    # background and keeps index.json up to date. The index has one entry
+    # per run and log: when it started, the file holding it and the byte
+    # offset where it begins, so a run can be found without unpacking every
+    # segment.
+    def __init__(self, log_dir: Path) -> None:
+        self.log_dir = log_dir
+        self.index_path = log_dir / INDEX_NAME
+        self._lock = threading.Lock()
+        self._compressing: dict[Path, threading.Thread] = {}
+
+    def _load_index(self) -> list[dict]:
+        # Callers hold the lock
+        try:
+            with self.index_path.open() as f:
+                runs = json.load(f).get("runs", [])
+        except (OSError, ValueError, AttributeError):
+            return []
+        return runs if isinstance(runs, list) else []
+
+    def _save_index(self, runs: list[dict]) -> None:
+        # Callers hold the lock
+        try:
+            tmp_path = self.index_path.with_suffix(".tmp")
+            with tmp_path.open("w") as f:
+                json.dump({"runs": runs}, f, indent=1)
+            tmp_path.replace(self.index_path)
+        except OSError as e:
+            logging.getLogger().warning("Could not write log index: %s", e)
+
+    def _rename_in_index(self, old_name: str, new_name: str) -> None:
+        with self._lock:
+            runs = self._load_index()
+            for run in runs:
+                if run.get("file") == old_name:
+                    run["file"] = new_name
+            self._save_index(runs)
+
+    def start_run(self, log_file: Path) -> int:
+        # Called once per log at startup. Rotates the log first if it is too
+        # big or too old, records the new run and returns the offset it starts at.
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.compress_leftovers(log_file)
+        if self.needs_rotation(log_file):
+            self.rotate(log_file)
+        try:
+            offset = log_file.stat().st_size
+        except OSError:
+            offset = 0
+        self.add_index_entry(log_file, offset)
+        return offset
+
+    def add_index_entry(self, log_file: Path, offset: int, continued: bool = False) -> None:
+        entry = {
+            "log": log_file.name,
+            "file": log_file.name,
+            "offset": offset,
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+        }
+        if continued:
+            # The same run carried on in a new file after a size rotation
+            entry["continued"] = True
+        with self._lock:
+            runs = self._load_index()
+            runs.append(entry)
+            self._save_index(runs)
+
+    def needs_rotation(self, log_file: Path) -> bool:
+        try:
+            st = log_file.stat()
+        except OSError:
+            return False
+        if st.st_size == 0:
+            return False
+        if st.st_size >= MAX_LOG_BYTES:
+            return True
+        with self._lock:
+            started = [
+                run["started"]
+                for run in self._load_index()
+                if run.get("file") == log_file.name and run.get("started")
+            ]
+        try:
+            first = datetime.fromisoformat(min(started)).timestamp() if started else st.st_mtime
+        except ValueError:
+            first = st.st_mtime
+        return time.time() - first >= MAX_LOG_AGE
+
+    def rotate(self, log_file: Path) -> Path | None:
+        # Renames the log to a new segment and compresses it in the background
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        segment = log_file.with_name(f"{log_file.name}.{stamp}")
+        counter = 1
+        while segment.exists() or segment.with_name(segment.name + ".gz").exists():
+            segment = log_file.with_name(f"{log_file.name}.{stamp}-{counter}")
+            counter += 1
+        try:
+            log_file.rename(segment)
+        except OSError as e:
+            logging.getLogger().warning("Could not rotate %s: %s", log_file, e)
+            return None
+        self._rename_in_index(log_file.name, segment.name)
+        self._compress_in_background(segment, log_file.name)
+        return segment
+
+    def _compress_in_background(self, segment: Path, log_name: str) -> None:
+        # Not a daemon, a short CLI run still finishes the compression
+        with self._lock:
+            self._compressing = {
+                path: thread for path, thread in self._compressing.items() if thread.is_alive()
+            }
+            if segment in self._compressing:
+                return
+            thread = threading.Thread(
+                target=self._compress, args=(segment, log_name), name="log-compress"
+            )
+            self._compressing[segment] = thread
+        thread.start()
+
+    def _compress(self, segment: Path, log_name: str) -> None:
+        compressed = segment.with_name(segment.name + ".gz")
+        tmp_path = segment.with_name(segment.name + ".gz.tmp")
+        try:
+            with segment.open("rb") as source, gzip.open(tmp_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            tmp_path.replace(compressed)
+        except OSError as e:
+            logging.getLogger().warning("Could not compress %s: %s", segment, e)
+            tmp_path.unlink(missing_ok=True)
+            return
+        # Point the index at the compressed copy before the original goes away
+        self._rename_in_index(segment.name, compressed.name)
+        segment.unlink(missing_ok=True)
+        self.prune(log_name)
+
+    def segments(self, log_name: str) -> list[Path]:
+        # Rotated segments of a log, oldest first
+        found = []
+        for path in self.log_dir.glob(f"{log_name}.*"):
+            match = SEGMENT_SUFFIX.fullmatch(path.name[len(log_name):])
+            if match:
+                # Same-second rotations get -1, -2... after the timestamp
+                counter = int(match.group(2)[1:]) if match.group(2) else 0
+                found.append(((match.group(1), counter), path))
+        return [path for _, path in sorted(found)]
+
+    def compress_leftovers(self, log_file: Path) -> None:
+        # Segments left uncompressed by a run that exited mid-compression
+        for segment in self.segments(log_file.name):
+            if segment.suffix != ".gz":
+                self._compress_in_background(segment, log_file.name)
+
+    def prune(self, log_name: str) -> None:
+        now = time.time()
+        segments = self.segments(log_name)
+        # Files of the old rotation scheme just age out
+        legacy = [
+            path
+            for path in self.log_dir.glob(f"{log_name}.*")
+            if LEGACY_SUFFIX.fullmatch(path.name[len(log_name):])
+        ]
+        expired = segments[: max(len(segments) - MAX_SEGMENTS, 0)]
+        for path in segments + legacy:
+            try:
+                if now - path.stat().st_mtime >= MAX_SEGMENT_AGE:
+                    expired.append(path)
+            except OSError:
+                continue
+        for path in set(expired):
+            path.unlink(missing_ok=True)
+
+        with self._lock:
+            runs = [
+                run
+                for run in self._load_index()
+                if run.get("log") != log_name or (self.log_dir / run.get("file", "")).exists()
+            ]
+            self._save_index(runs)
+
+    def wait(self) -> None:
+        with self._lock:
+            threads = list(self._compressing.values())
+        for thread in threads:
+            thread.join()
+
+
+class RotatingLogHandler(logging.FileHandler):
+    # Appends to the log across runs and rotates it through LogRotation:
+    # at startup when it is too big or old, and while writing once it
+    # passes MAX_LOG_BYTES.
+    def __init__(self, log_file: Path, rotation: LogRotation) -> None:
+        self.rotation = rotation
+        rotation.start_run(log_file)
+        super().__init__(log_file, mode="a")
+
+    def emit(self, record: logging.LogRecord) -> None:
+        super().emit(record)
+        try:
+            if self.stream is not None and self.stream.tell() >= MAX_LOG_BYTES:
+                self.rollover()
+        except Exception:
+            self.handleError(record)
+
+    def rollover(self) -> None:
+        # Runs from emit, under the handler lock
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        log_file = Path(self.baseFilename)
+        self.rotation.rotate(log_file)
+        self.rotation.add_index_entry(log_file, 0, continued=True)
+        self.stream = self._open()
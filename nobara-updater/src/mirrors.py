@@ -0,0 +1,246 @@
+import json
+import logging
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from nobara_updater.repocheck import MIRROR_FANOUT, REQUEST_TIMEOUT, RepoChecker
+
+logger = logging.getLogger()
+
+REPOMD_PATH = "/repodata/repomd.xml"
+# Size of the ranged GET used to estimate throughput
+PROBE_BYTES = 64 * 1024
+# Mirrors probed per repository and check
+MAX_PROBES_PER_REPO = 6
+# Mirrors handed to dnf ahead of its own mirror order
+BEST_MIRRORS = 3
+# Older measurements count half as much after this many seconds
+HALF_LIFE = 7 * 24 * 3600
+# Measurements older than this are not used for mirror selection at all
+MAX_AGE = 30 * 24 * 3600
+
+
+def ranking_key(repo_id: str, releasever: str, basearch: str) -> str:
+    # A repo's mirror set differs per release and architecture, so after a
+    # release upgrade the old release's mirrors are never preferred
+    return f"{repo_id}/{releasever}/{basearch}"
+
+
+def mirror_base(repomd_url: str) -> str:
+    if repomd_url.endswith(REPOMD_PATH):
+        return repomd_url[: -len(REPOMD_PATH)]
+    return repomd_url
+
+
+def metalink_mirrors(content: bytes) -> list[str]:
+    # repomd.xml urls of a metalink, highest preference first
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return []
+    mirrors = []
+    for element in root.iter():
+        if not element.tag.endswith("}url") and element.tag != "url":
+            continue
+        url = (element.text or "").strip()
+        if not url.startswith(("http://", "https://")) or not url.endswith(REPOMD_PATH):
+            continue
+        try:
+            preference = int(element.get("preference", "0"))
+        except ValueError:
+            preference = 0
+        mirrors.append((preference, url))
+    mirrors.sort(key=lambda mirror: -mirror[0])
+    return [url for _, url in mirrors]
+
+
+class MirrorProbe:
+    def __init__(
+        self,
+        url: str,
+        ok: bool,
+        connect: float = 0.0,
+        ttfb: float = 0.0,
+        throughput: float = 0.0,
+    ) -> None:
+        self.url = url
+        self.ok = ok
+        self.connect = connect
+        self.ttfb = ttfb
+        # bytes per second
+        self.throughput = throughput
+
+    @property
+    def score(self) -> float:
+        # Estimated seconds to fetch one MiB, lower is better
+        if not self.ok or self.throughput <= 0:
+            return float("inf")
+        return self.connect + self.ttfb + (1024 * 1024) / self.throughput
+
+    def __repr__(self) -> str:
+        if not self.ok:
+            return f"{self.url}: failed"
+        return (
+            f"{self.url}: connect {self.connect * 1000:.0f}ms, ttfb {self.ttfb * 1000:.0f}ms, "
+            f"{self.throughput / 1024:.0f} KiB/s"
+        )
+
+
+def probe_mirror(checker: RepoChecker, repomd_url: str) -> MirrorProbe:
+    parts = urlsplit(repomd_url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        start = time.monotonic()
+        with socket.create_connection(
+            (parts.hostname, port), timeout=min(REQUEST_TIMEOUT, max(checker.remaining(), 0.1))
+        ):
+            connect = time.monotonic() - start
+
+        response = checker.get(
+            repomd_url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"}, stream=True
+        )
+        with response:
+            # elapsed stops once the response headers are parsed
+            ttfb = response.elapsed.total_seconds()
+            if response.status_code not in (200, 206):
+                return MirrorProbe(repomd_url, False)
+            body_start = time.monotonic()
+            received = 0
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                received += len(chunk)
+                if received >= PROBE_BYTES:
+                    break
+            body_time = max(time.monotonic() - body_start, 1e-3)
+        if not received:
+            return MirrorProbe(repomd_url, False)
+        return MirrorProbe(repomd_url, True, connect, ttfb, received / body_time)
+    except Exception as e:
+        logger.debug("Mirror probe for %s failed: %s", repomd_url, e)
+        return MirrorProbe(repomd_url, False)
+
+
+class MirrorRanking:
+    # Persists per repository, release and architecture (see ranking_key)
+    # how fast each of its mirrors answered. New measurements are blended
+    # with the stored score, older measurements count less the older they
+    # are, and a mirror that failed its last probe is not preferred until it
+    # answers again. Only mirrors the repo's metalink/mirrorlist listed last
+    # time are kept.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: dict[str, dict[str, dict]] | None = None
+
+    def _entries(self) -> dict[str, dict[str, dict]]:
+        # Callers hold the lock
+        if self._data is None:
+            try:
+                with self.path.open() as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def record(self, key: str, probes: list[MirrorProbe]) -> None:
+        now = time.time()
+        with self._lock:
+            mirrors = self._entries().setdefault(key, {})
+            for probe in probes:
+                base = mirror_base(probe.url)
+                entry = mirrors.get(base)
+                if not probe.ok:
+                    if entry is None:
+                        entry = {"score": None, "updated": now, "failures": 0}
+                    entry["failures"] += 1
+                    entry["updated"] = now
+                    mirrors[base] = entry
+                    continue
+                if entry is None or entry.get("score") is None:
+                    score = probe.score
+                else:
+                    weight = 0.5 ** ((now - entry["updated"]) / HALF_LIFE)
+                    score = (entry["score"] * weight + probe.score) / (weight + 1)
+                mirrors[base] = {"score": score, "updated": now, "failures": 0}
+
+    def best(self, key: str, limit: int = BEST_MIRRORS) -> list[str]:
+        now = time.time()
+        with self._lock:
+            mirrors = self._entries().get(key, {})
+            ranked = sorted(
+                (entry["score"], base)
+                for base, entry in mirrors.items()
+                if entry.get("score") is not None
+                and not entry.get("failures")
+                and now - entry["updated"] < MAX_AGE
+            )
+        return [base for _, base in ranked[:limit]]
+
+    def candidates(self, key: str, repomd_urls: list[str], limit: int = MAX_PROBES_PER_REPO) -> list[str]:
+        # Re-measure the mirrors we already favour, fill up with ones we
+        # know nothing about yet in the order the repo lists them. Mirrors
+        # the repo no longer lists are forgotten, best() can't return them.
+        listed = {mirror_base(url) for url in repomd_urls}
+        with self._lock:
+            mirrors = self._entries().get(key, {})
+            if listed:
+                for base in [base for base in mirrors if base not in listed]:
+                    del mirrors[base]
+            known = set(mirrors)
+        known_good = set(self.best(key, limit))
+        preferred = [url for url in repomd_urls if mirror_base(url) in known_good]
+        unknown = [url for url in repomd_urls if mirror_base(url) not in known]
+        rest = [url for url in repomd_urls if url not in preferred and url not in unknown]
+        return (preferred + unknown + rest)[:limit]
+
+    def save(self) -> None:
+        now = time.time()
+        with self._lock:
+            data = self._entries()
+            # Drop what is too old to matter
+            for key in list(data):
+                data[key] = {
+                    base: entry
+                    for base, entry in data[key].items()
+                    if now - entry["updated"] < MAX_AGE
+                }
+                if not data[key]:
+                    del data[key]
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                with tmp_path.open("w") as f:
+                    json.dump(data, f)
+                tmp_path.replace(self.path)
+            except OSError as e:
+                logger.warning("Could not write mirror ranking: %s", e)
+
+
+def rank_mirrors(
+    checker: RepoChecker, ranking: MirrorRanking, key: str, repomd_urls: list[str]
+) -> list[MirrorProbe]:
+    # Probes a handful of a repository's mirrors concurrently and records the
+    # results under key (see ranking_key), returns the probes that finished
+    # before the deadline
+    candidates = ranking.candidates(key, repomd_urls)
+    if not candidates:
+        return []
+    probes = []
+    pool = ThreadPoolExecutor(max_workers=min(MIRROR_FANOUT, len(candidates)))
+    futures = [pool.submit(probe_mirror, checker, url) for url in candidates]
+    try:
+        for future in as_completed(futures, timeout=max(checker.remaining(), 0)):
+            probes.append(future.result())
+    except FuturesTimeoutError:
+        pass
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    for probe in sorted(probes, key=lambda probe: probe.score):
+        logger.debug("%s mirror %r", key, probe)
+    ranking.record(key, probes)
+    return probes
@@ -9,26 +9,46 @@ import re
 import subprocess
 import sys
 import threading
+import time
 import xml.etree.ElementTree as ElementTree
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Callable
 
 import gi  # type: ignore[import]
 import psutil
 import shutil
-import requests
-from nobara_updater.quirks import QuirkFixup  # type: ignore[import]
-from nobara_updater.run_as import run_as_user
+from nobara_updater.quirks import QuirkFixup, quirk_cache  # type: ignore[import]
+from nobara_updater.run_as import log_progress_events, run_as_user
+from nobara_updater.shared_functions import (  # type: ignore[import]
+    FLATPAK_LIST_RETRY,
+    list_cached_updates,
+    list_installation_updates,
+    watch_transaction,
+)
+from nobara_updater.http_cache import HttpCache
+from nobara_updater.log_rotation import LogRotation, RotatingLogHandler
+from nobara_updater.structured_log import in_current_context, json_file_handler, log_phase, log_pipeline
+from nobara_updater.mirrors import metalink_mirrors, rank_mirrors, ranking_key
+from nobara_updater.repocheck import RepoChecker
 
 gi.require_version("Gtk", "3.0")
 gi.require_version("GLib", "2.0")
 gi.require_version("Flatpak", "1.0")
 
-from gi.repository import Flatpak, GLib, Gtk  # type: ignore[import]
+from gi.repository import Flatpak, GLib, Gtk, Pango  # type: ignore[import]
 
 from nobara_updater.dnf import (  # type: ignore[import]
+    CACHE_DIR,
     AttributeDict,
     PackageUpdater,
+    TransactionPlan,
+    dnf_session,
+    installed_packages,
+    mirror_ranking,
+    prefetch_packages,
     repoindex,
     updatechecker,
 )
@@ -48,6 +68,8 @@ if not log_file_path.exists():
     log_file_path.mkdir(parents=True)
 
 log_file = log_file_path / "nobara-sync.log"
+json_log_file = log_file_path / "nobara-sync.jsonl"
+log_rotation = LogRotation(log_file_path)
 
 class Color:
     """A class for terminal color codes."""
@@ -76,45 +98,63 @@ class ColorLogFormatter(logging.Formatter):
         return log_entry
 
 
+# Lines kept in the status TextView, the log file has everything
+STATUS_SCROLLBACK_LINES = 5000
+# How often queued log lines are written to the TextView
+TEXTVIEW_FLUSH_INTERVAL_MS = 50
+
+
 class TextViewHandler(logging.Handler):
+    # Log records from any thread are queued and written to the TextView in
+    # one insert per TEXTVIEW_FLUSH_INTERVAL_MS from the GTK main loop,
+    # instead of one idle callback, mark and scroll per record
     def __init__(self, textview: Gtk.TextView) -> None:
         super().__init__()
         self.textview = textview
+        # deque appends and pops are atomic, emit doesn't need a lock. More
+        # pending lines than the scrollback would be trimmed right away.
+        self.pending: deque[str] = deque(maxlen=STATUS_SCROLLBACK_LINES)
+        self.flush_scheduled = False
 
     def emit(self, record: logging.LogRecord) -> None:
-        log_entry = self.format(record)
-        GLib.idle_add(self.update_textview, log_entry)
-
-    def update_textview(self, log_entry: str) -> bool:
-        buffer = self.textview.get_buffer()
-        # Create a mark at the end of the buffer
-        mark = buffer.create_mark(None, buffer.get_end_iter(), False)
-        # Insert the log entry text
-        buffer.insert_markup(buffer.get_end_iter(), log_entry + "\n", -1)
-        # Scroll to the mark
-        self.textview.scroll_to_mark(mark, 0.0, True, 0.0, 1.0)
-        return False  # Stop the idle_add loop
-
-
-def rotate_log_files(log_file: str) -> None:
-    log_file_path = Path(log_file)
-    log_dir = log_file_path.parent
-    log_pattern = f"{log_file_path.name}.*"
-
-    log_files = sorted(log_dir.glob(log_pattern), key=os.path.getmtime)
+        self.pending.append(self.format(record))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            GLib.timeout_add(TEXTVIEW_FLUSH_INTERVAL_MS, self.update_textview)
+
+    @staticmethod
+    def valid_markup(log_entry: str) -> str:
+        # One line with a stray "<" must not take the whole batch with it
+        try:
+            Pango.parse_markup(log_entry, -1, "\0")
+        except GLib.Error:
+            return GLib.markup_escape_text(log_entry, -1)
+        return log_entry
 
-    # Rotate log files
-    for i in range(len(log_files), 0, -1):
-        old_log = log_dir / f"{log_file_path.name}.{i}"
-        new_log = log_dir / f"{log_file_path.name}.{i+1}"
-        if i == 5:
-            old_log.unlink()
-        elif old_log.exists():
-            old_log.rename(new_log)
+    def update_textview(self) -> bool:
+        # Records emitted from here on schedule the next flush
+        self.flush_scheduled = False
+        entries = []
+        while self.pending:
+            entries.append(self.valid_markup(self.pending.popleft()))
+        if not entries:
+            return False
 
-    # Rename the current log file if it exists
-    if Path(log_file).exists():
-        Path(log_file).rename(Path(f"{log_file}.1"))
+        buffer = self.textview.get_buffer()
+        buffer.insert_markup(buffer.get_end_iter(), "\n".join(entries) + "\n", -1)
+        # Keep the view small, the full history is in the log file. The
+        # trailing newline leaves an empty last line, not counted.
+        excess = buffer.get_line_count() - 1 - STATUS_SCROLLBACK_LINES
+        if excess > 0:
+            buffer.delete(buffer.get_start_iter(), buffer.get_iter_at_line(excess))
+        # Scroll to the end once per batch, with the one mark we keep there
+        end_mark = buffer.get_mark("log-end")
+        if end_mark is None:
+            end_mark = buffer.create_mark("log-end", buffer.get_end_iter(), False)
+        else:
+            buffer.move_mark(end_mark, buffer.get_end_iter())
+        self.textview.scroll_to_mark(end_mark, 0.0, True, 0.0, 1.0)
+        return False  # Stop the timeout, the next record schedules a new one
 
 
 # Initialize the logger with a basic configuration
@@ -123,11 +163,9 @@ logger.setLevel(logging.INFO)
 
 
 def initialize_logging(textview: Gtk.TextView = None) -> logging.Logger:
-    global rotate_log_files
     global logger
 
-    # Clear existing handlers
-    logger.handlers = []
+    handlers: list[logging.Handler] = []
 
     # CONSOLE/TERMINAL
     # Create console handler
@@ -138,35 +176,48 @@ def initialize_logging(textview: Gtk.TextView = None) -> logging.Logger:
         "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
     )
     console_handler.setFormatter(console_formatter)
-    # Add the console handler to the logger
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
 
     # LOG FILE
-    # Rotate log files before writing the new log fo;e
-    rotate_log_files(str(log_file))
-
-    # Create file handler
-    file_handler = logging.FileHandler(log_file, mode="w")
+    # Appends to the log, rotating it by size and age
+    file_handler = RotatingLogHandler(log_file, log_rotation)
     file_handler.setLevel(logging.INFO)
     # Create formatter for the file handler
     file_formatter = logging.Formatter(
         "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
     )
     file_handler.setFormatter(file_formatter)
-    # Add the file handler to the logger
-    logger.addHandler(file_handler)
+    handlers.append(file_handler)
+
+    # JSON LINES LOG
+    # Same records with their structured fields
+    handlers.append(json_file_handler(json_log_file, log_rotation))
 
     # GUI STATUS WINDOW
     # Optionally create textview handler for GUI
     if textview is not None:
         textview_handler = TextViewHandler(textview)
         textview_handler.setLevel(logging.INFO)
-        # Add the textview handler to the logger
-        logger.addHandler(textview_handler)
+        handlers.append(textview_handler)
+
+    # The root logger only enqueues, one listener thread runs the handlers
+    log_pipeline.install(logger, handlers)
 
     return logger
 
 
+def relaunch() -> None:
+    # exec skips atexit and the handlers run on the listener thread, so
+    # write out every queued record and finish pending log compression first
+    log_pipeline.suspend()
+    log_rotation.wait()
+    try:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    finally:
+        # Only reached if exec failed
+        log_pipeline.resume()
+
+
 def is_running_with_sudo_or_pkexec() -> int:
     # Check environment variables first
     if "SUDO_USER" in os.environ:
@@ -300,27 +351,56 @@ def get_repolist() -> tuple[
     )
 
 
+NOTICES_URL = "https://updates.nobaraproject.org/updates.txt"
+
+# Validators and bodies of metalinks, mirrorlists and the notices
+http_cache = HttpCache(CACHE_DIR / "http")
+
+
+def fetch_notices() -> tuple[str | None, str | None]:
+    # Returns (content, error_message). When the server can't be reached the
+    # last copy we saw is shown instead of an error.
+    try:
+        response = http_cache.get(NOTICES_URL, offline_fallback=True, timeout=5)
+        if response.status_code == 200:
+            return response.text, None
+        return None, f"Failed to fetch updates.nobaraproject.org/updates.txt (Status code: {response.status_code})"
+    except Exception as e:
+        return None, f"Error fetching updates: {str(e)}"
+
+
 def validate_metalink(
-    metalink_url: str, session: requests.Session, headers: dict[str, str]
+    metalink_url: str, checker: RepoChecker, repo_id: str | None = None
 ) -> bool:
     try:
-        response = session.get(metalink_url, headers=headers, timeout=5)
+        # Not offline_fallback, an unreachable metalink is a failed check
+        response = http_cache.get(metalink_url, request=checker.get)
         if response.status_code == 200:
             try:
                 root = ElementTree.fromstring(response.content)
-                return bool(root.tag.endswith("metalink"))
             except ElementTree.ParseError:
                 return False
+            if not root.tag.endswith("metalink"):
+                return False
+            if repo_id:
+                # Measure some of the listed mirrors for the download stage
+                rank_mirrors(
+                    checker,
+                    mirror_ranking,
+                    ranking_key(repo_id, VERSION_ID, BASEARCH),
+                    metalink_mirrors(response.content),
+                )
+            return True
         return False
     except Exception:
         return False
 
 
 def validate_mirrorlist(
-    mirrorlist_url: str, session: requests.Session, headers: dict[str, str]
+    mirrorlist_url: str, checker: RepoChecker, repo_id: str | None = None
 ) -> bool:
     try:
-        response = session.get(mirrorlist_url, headers=headers, timeout=5)
+        response = http_cache.get(mirrorlist_url, request=checker.get)
         if response.status_code == 200:
             mirrors = response.text.splitlines()
             mirrors = [mirror for mirror in mirrors if mirror.strip()]
@@ -339,19 +419,19 @@ def validate_mirrorlist(
             mirrors = [
                 remove_double_slashes(mirror) for mirror in mirrors
             ]  # Remove any double slashes
-            if validate_baseurls(mirrors, session, headers):
-                return True
+            # Probing a few mirrors at once both validates and ranks them
+            key = ranking_key(repo_id or mirrorlist_url, VERSION_ID, BASEARCH)
+            probes = rank_mirrors(checker, mirror_ranking, key, mirrors)
+            return any(probe.ok for probe in probes)
         return False
     except Exception:
         return False
 
 
-def validate_baseurls(
-    baseurl_list: list[str], session: requests.Session, headers: dict[str, str]
-) -> bool:
+def validate_baseurls(baseurl_list: list[str], checker: RepoChecker) -> bool:
     for url in baseurl_list:
         try:
-            response = session.head(url, headers=headers, timeout=5)
+            response = checker.head(url)
             if response.status_code == 200:
                 return True
         except Exception:
@@ -373,50 +453,42 @@ def check_repos() -> None:
         mirrorlist_repos,
         baseurl_repos,
     ) = get_repolist()
-    log_messages = []
-
-    # Create a session
-    session = requests.Session()
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36"
-    }
-    # Example: Validate the URLs and print the corresponding repo names
+    # All urls are checked at once, each result is logged as soon as it is known
+    checks = []
     for metalink in metalinks:
-        escaped_metalink = html.escape(metalink)
-        if validate_metalink(metalink, session, headers):
-            log_messages.append(
-                f"{check_mark} {metalink_repos[metalink]}: metalink: {escaped_metalink}\n"
+        checks.append(
+            (
+                (metalink_repos[metalink], "metalink", metalink),
+                lambda checker, url=metalink: validate_metalink(
+                    url, checker, metalink_repos[url]
+                ),
             )
-        else:
-            log_messages.append(
-                f"{red_x} {metalink_repos[metalink]}: metalink: {escaped_metalink}\n"
-            )
-
+        )
     for mirrorlist in mirrorlists:
-        escaped_mirrorlist = html.escape(mirrorlist)
-        if validate_mirrorlist(mirrorlist, session, headers):
-            log_messages.append(
-                f"{check_mark} {mirrorlist_repos[mirrorlist]}: mirrorlist: {escaped_mirrorlist}\n"
-            )
-        else:
-            log_messages.append(
-                f"{red_x} {mirrorlist_repos[mirrorlist]}: mirrorlist: {escaped_mirrorlist}\n"
+        checks.append(
+            (
+                (mirrorlist_repos[mirrorlist], "mirrorlist", mirrorlist),
+                lambda checker, url=mirrorlist: validate_mirrorlist(
+                    url, checker, mirrorlist_repos[url]
+                ),
             )
-
+        )
     for url in baseurls:
-        escaped_url = html.escape(url)
-        if validate_baseurls([url], session, headers):
-            log_messages.append(
-                f"{check_mark} {baseurl_repos[url]}: baseurl: {escaped_url}\n"
-            )
-        else:
-            log_messages.append(
-                f"{red_x} {baseurl_repos[url]}: baseurl: {escaped_url}\n"
+        checks.append(
+            (
+                (baseurl_repos[url], "baseurl", url),
+                lambda checker, url=url: validate_baseurls([url], checker),
             )
+        )
 
-    for message in log_messages:
-        logger.info(message)
+    def report(key: tuple[str | None, str, str], ok: bool) -> None:
+        repo_id, kind, url = key
+        mark = check_mark if ok else red_x
+        logger.info(f"{mark} {repo_id}: {kind}: {html.escape(url)}\n")
+
+    RepoChecker().run(checks, report)
+    mirror_ranking.save()
 
 
 updates_available = 0
@@ -425,6 +497,8 @@ perform_kernel_actions = 0
 perform_reboot_request = 0
 perform_refresh = 0
 is_refreshing = 0
+# Set by --force-refresh, applies to every check of the run
+force_refresh_requested = 0
 media_fixup_event = threading.Event()
 
 def get_system_updates_available() -> int:
@@ -452,7 +526,29 @@ def get_fixups_available() -> int:
     global fixups_available
     return fixups_available
 
-def check_updates(return_texts: bool = False) -> None | tuple[str | None, str | None, str | None]:
+# Seconds each update source may take before check_updates stops waiting for it
+UPDATE_SOURCE_TIMEOUTS = {
+    "system": 600,
+    "flatpak-user": 120,
+    "flatpak-system": 120,
+}
+# Handed to on_source_done for a source that passed its timeout, so a view
+# doesn't keep showing the result of an earlier check
+UPDATE_SOURCE_TIMED_OUT_TEXT = "Timed out while checking for updates, try again later."
+
+
+@log_phase("check-updates")
+def check_updates(
+    return_texts: bool = False,
+    on_source_done: Callable[[str, str | None], None] | None = None,
+    refresh: bool = False,
+) -> None | tuple[str | None, str | None, str | None]:
+    # The dnf, user Flatpak and system Flatpak checks don't depend on each
+    # other and run at the same time. on_source_done(source, text) is called
+    # from a worker thread as soon as one of them has its answer, or with
+    # UPDATE_SOURCE_TIMED_OUT_TEXT once it took too long. refresh is
+    # for checks the user asked for and fetches fresh repo metadata and
+    # Flatpak remote summaries.
     global updates_available
     global system_updates_available
     global flatpak_updates_available
@@ -461,55 +557,97 @@ def check_updates(return_texts: bool = False) -> None | tuple[str | None, str |
     system_updates_available = 0
     flatpak_updates_available = 0
 
-    sys_update_text = None
-    fp_user_update_text = None
-    fp_sys_update_text = None
+    force_refresh = force_refresh_requested == 1
 
-    # Get our system updates
-    package_names = updatechecker()
-    if package_names:
-        updates_available = 1
-        system_updates_available = 1
-        sys_update_text = "\n".join(package_names)
+    orig_user_uid, orig_user_gid = get_orig_user_ids()
 
-    if is_running_with_sudo_or_pkexec() == 1:
-        sudo_user = os.environ.get('SUDO_USER', '')
-        if sudo_user and not sudo_user.isdigit():
-            try:
-                orig_user_uid = pwd.getpwnam(sudo_user).pw_uid
-                os.environ['ORIG_USER'] = str(orig_user_uid)
+    def system_source() -> str | None:
+        # Get our system updates
+        package_names = updatechecker(force_refresh=force_refresh, refresh_metadata=refresh)
+        return "\n".join(package_names) if package_names else None
+
+    def flatpak_user_source() -> str | None:
+        fp_user_updates = run_as_user(
+            orig_user_uid,
+            orig_user_gid,
+            "fp_get_user_updates",
+            "refresh" if force_refresh or refresh else "",
+        )
+        return "\n".join(fp_user_updates) if fp_user_updates else None
 
-                original_user_home = pwd.getpwnam(sudo_user).pw_dir
-                os.environ['ORIGINAL_USER_HOME'] = str(original_user_home)
-            except KeyError:
-                print(f"User {sudo_user} not found")
+    def flatpak_system_source() -> str | None:
+        fp_system_updates = fp_get_system_updates(force_refresh or refresh)
+        if not fp_system_updates:
+            return None
+        return "\n".join(
+            fp_system_update.get_appdata_name()
+            for fp_system_update in fp_system_updates
+            if fp_system_update.get_appdata_name() is not None
+        )
 
-    # Get the original user's UID and GID
-    orig_user = os.environ.get("ORIG_USER")
-    if orig_user is None:
-        orig_user = "0"
-    orig_user_uid = int(orig_user)
-    pw_record = pwd.getpwuid(orig_user_uid)
-    orig_user_gid = pw_record.pw_gid
+    sources = {
+        "system": system_source,
+        "flatpak-user": flatpak_user_source,
+        "flatpak-system": flatpak_system_source,
+    }
+    texts: dict[str, str | None] = dict.fromkeys(sources)
+    # Sources already passed to on_source_done, with their answer or as
+    # timed out. Whichever comes first wins, a late answer is dropped.
+    reported: set[str] = set()
+    report_lock = threading.Lock()
+
+    def report(source: str, text: str | None) -> None:
+        with report_lock:
+            if source in reported:
+                return
+            reported.add(source)
+        if on_source_done:
+            on_source_done(source, text)
+
+    def run_source(source: str) -> str | None:
+        try:
+            text = sources[source]()
+        except Exception as e:
+            logger.error("Checking %s updates failed: %s", source, e)
+            text = None
+        report(source, text)
+        return text
+
+    start = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="update-check")
+    pending = {pool.submit(in_current_context(run_source), source): source for source in sources}
+    try:
+        while pending:
+            now = time.monotonic()
+            expired = [
+                future for future, source in pending.items()
+                if now - start >= UPDATE_SOURCE_TIMEOUTS[source]
+            ]
+            for future in expired:
+                source = pending.pop(future)
+                logger.warning("Gave up waiting for %s updates", source)
+                report(source, UPDATE_SOURCE_TIMED_OUT_TEXT)
+            if not pending:
+                break
+            timeout = min(UPDATE_SOURCE_TIMEOUTS[source] for source in pending.values()) - (now - start)
+            done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                texts[pending.pop(future)] = future.result()
+    finally:
+        # A source stuck past its timeout must not hold up the caller
+        pool.shutdown(wait=False)
 
-    # Flatpak User Updates window
-    fp_user_updates = run_as_user(orig_user_uid, orig_user_gid, "fp_get_user_updates")
-    if fp_user_updates:
-        updates_available = 1
-        flatpak_updates_available = 1
-        fp_user_update_text = "\n".join(fp_user_updates)
+    sys_update_text = texts["system"]
+    fp_user_update_text = texts["flatpak-user"]
+    fp_sys_update_text = texts["flatpak-system"]
 
-    # Flatpak System Updates window
-    fp_system_updates = fp_get_system_updates()
-    if fp_system_updates:
+    # Sources return None when they have nothing to offer
+    if sys_update_text is not None:
+        updates_available = 1
+        system_updates_available = 1
+    if fp_user_update_text is not None or fp_sys_update_text is not None:
         updates_available = 1
         flatpak_updates_available = 1
-        fp_sys_update_texts = [
-            fp_system_update.get_appdata_name()
-            for fp_system_update in fp_system_updates
-            if fp_system_update.get_appdata_name() is not None
-        ]
-        fp_sys_update_text = "\n".join(fp_sys_update_texts)
 
     if is_running_with_sudo_or_pkexec() == 1:
         if sys_update_text:
@@ -530,12 +668,9 @@ def check_updates(return_texts: bool = False) -> None | tuple[str | None, str |
         return sys_update_text, fp_user_update_text, fp_sys_update_text
     return None
 
-def fp_get_system_updates() -> list[Flatpak.Ref] | None:
-    # Get our flatpak updates
-    with fp_system_installation_list(Flatpak.Installation.new_system(None)) as flatpak_sys_updates:
-        if flatpak_sys_updates != []:
-            return flatpak_sys_updates
-        return []
+def fp_get_system_updates(refresh: bool = False) -> list[Flatpak.InstalledRef]:
+    # Get our flatpak updates, from cached remote summaries unless refresh
+    return list_cached_updates(Flatpak.Installation.new_system(None), refresh, logger.warning)
 
 def get_orig_user_ids() -> tuple[int, int]:
     if is_running_with_sudo_or_pkexec() == 1:
@@ -555,6 +690,7 @@ def get_orig_user_ids() -> tuple[int, int]:
     orig_user_gid = pw_record.pw_gid
     return orig_user_uid, orig_user_gid
 
+@log_phase("install-system")
 def install_system_updates_only() -> None:
     global perform_kernel_actions
     global perform_reboot_request
@@ -612,15 +748,17 @@ def install_system_updates_only() -> None:
         logger.info("Kernel, kernel module, or desktop compositor update performed. Reboot required.")
         prompt_reboot()
 
+@log_phase("install-flatpak")
 def install_flatpak_updates_only() -> None:
     logger.info("Starting FLATPAK updates, please do not turn off your computer...\n")
 
     orig_user_uid, orig_user_gid = get_orig_user_ids()
 
-    # system flatpaks
+    # System first: the user transaction pulls runtimes through
+    # add_default_dependency_sources(), which only skips the ones the system
+    # installation already has up to date once its transaction is done.
+    # Run concurrently, both would download and deploy the same runtimes.
     install_system_flatpak_updates()
-
-    # user flatpaks
     run_as_user(orig_user_uid, orig_user_gid, "install_user_flatpak_updates")
 
     # refresh systray
@@ -644,30 +782,34 @@ def install_system_flatpak_updates() -> None:
                     transaction.add_update(ref.format_ref(), None, None)
                 except Exception as e:
                     logger.error("Error updating %s: %s", ref.get_appdata_name(), e)
+            watch_transaction(transaction, log_progress_events())
             transaction.run()
             logger.info("Flatpak System Updates complete!")
     del system_installation
 
 class fp_system_installation_list(object):
-    # Generates flatpak_system_updates for other functions with error handling
+    # Generates flatpak_system_updates for other functions with error handling,
+    # None if the updates could not be listed. The RetryResult is kept in
+    # self.result.
     def __init__(self, system_installation):
         self.system_installation = system_installation
+        self.result = None
 
 
     def __enter__(self):
-        flatpak_system_updates = None
-        error = True # No do-while in Python so init to true to run loop once
-        while error:
-            try:
-                flatpak_system_updates = self.system_installation.list_installed_refs_for_update(None)
-            except gi.repository.GLib.GError as e:
-                # Expected, see #43
-                logger.error(e)
-            except:
-                raise
-            else:
-                error = False
-        return flatpak_system_updates
+        def on_error(e, attempt):
+            logger.error(
+                "Error getting Flatpak system updates (attempt %d/%d): %s",
+                attempt,
+                FLATPAK_LIST_RETRY.attempts,
+                e,
+            )
+
+        self.result = list_installation_updates(self.system_installation, on_error)
+        if not self.result.ok:
+            logger.error("Giving up on Flatpak system updates for now")
+            return None
+        return self.result.value
 
 
     def __exit__(self, *args):
@@ -682,6 +824,7 @@ def button_ensure_sensitivity(
     if current_state != desired_state:
         widget.set_sensitive(desired_state)
 
+@log_phase("fixups")
 def install_fixups() -> None:
     global perform_kernel_actions
     global perform_reboot_request
@@ -702,11 +845,14 @@ def install_fixups() -> None:
         perform_refresh,
     ) = quirk_fixup.system_quirk_fixup()
 
+    # Quirks modify the rpmdb and repo files directly, reload the sack afterwards
+    dnf_session.invalidate()
+
     # Perform final refresh after making core fixes before updating the rest of the packages.
     if perform_refresh == 1:
         logger.info("Re-launching after critical update to continue update process...")
         try:
-            os.execv(sys.executable, [sys.executable] + sys.argv)
+            relaunch()
             # Log success
             logger.info("Command scheduled successfully.")
         except Exception as e:
@@ -746,6 +892,7 @@ def install_updates() -> None:
     install_system_updates_only()
     install_flatpak_updates_only()
 
+@log_phase("repair")
 def attempt_distro_sync() -> None:
     # Run dnf distro-sync first
     try:
@@ -762,6 +909,7 @@ def attempt_distro_sync() -> None:
         # Display the output in the status window
         if result.stdout:
             logger.info("dnf distro-sync output:\n" + result.stdout)
+        dnf_session.invalidate()
 
     except subprocess.CalledProcessError as e:
         logger.error(f"dnf distro-sync failed: {e}")
@@ -830,20 +978,21 @@ def attempt_distro_sync() -> None:
         return
 
     try:
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+        relaunch()
         # Log success
         logger.info("Command scheduled successfully.")
     except Exception as e:
         logger.error(f"Failed to relaunch script: {e}")
         self.status_label_updates("Failed to relaunch script")
 
-def prompt_media_fixup() -> None:
+def prompt_media_fixup(dry_run: bool = False) -> None:
     global media_fixup_event
     media_fixup_event.set()
-    media_fixup()
+    media_fixup(dry_run)
     media_fixup_event.wait()
 
-def media_fixup() -> None:
+@log_phase("media-fixup")
+def media_fixup(dry_run: bool = False) -> None:
     global fixups_available
     global media_fixup_event
     hard_removal = [
@@ -889,47 +1038,6 @@ def media_fixup() -> None:
         "mesa-vulkan-drivers-git.i686",
     ]
 
-    action_log_string = "Purging media packages for a clean slate..."
-    combined_removal = hard_removal + soft_removal
-    indented_combined_removal = ["    " + line for line in combined_removal]
-    logger.info("%s\n\n%s\n", action_log_string, chr(10).join(indented_combined_removal))
-    for package in hard_removal:
-        subprocess.run(
-            ["rpm", "-e", "--nodeps", package], capture_output=True, text=True
-        )
-
-    soft_removal_list = []
-    for package in soft_removal:
-        removal_check = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True
-        )
-        if removal_check.returncode == 0:
-            soft_removal_list.append(package)
-    if soft_removal_list:
-        PackageUpdater(soft_removal_list, "remove", None)
-
-    vulkan_standard_installed = 0
-    vulkan_git_installed = 0
-    for package in vulkan_standard:
-        removal_check_vulkan = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True
-        )
-        if removal_check_vulkan.returncode == 0:
-            subprocess.run(
-                ["rpm", "-e", "--nodeps", package], capture_output=True, text=True
-            )
-            vulkan_standard_installed = 1
-
-    for package in vulkan_git:
-        removal_check_vulkan_git = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True
-        )
-        if removal_check_vulkan_git.returncode == 0:
-            subprocess.run(
-                ["rpm", "-e", "--nodeps", package], capture_output=True, text=True
-            )
-            vulkan_git_installed = 1
-
     install = [
         "mesa-libgallium-freeworld.x86_64",
         "mesa-libgallium-freeworld.i686",
@@ -967,56 +1075,118 @@ def media_fixup() -> None:
     ]
 
     # enable the nobara-pikaos-additional repo first
-    subprocess.run(
-            ["dnf", "config-manager", "setopt", "nobara-pikaos-additional.enabled=1"], capture_output=True, text=True
+    if dry_run:
+        logger.info("Dry run: would enable the nobara-pikaos-additional repo.")
+    else:
+        subprocess.run(
+                ["dnf", "config-manager", "setopt", "nobara-pikaos-additional.enabled=1"], capture_output=True, text=True
+            )
+
+        subprocess.run(
+            ["sed", "-i", "s/enabled=0/enabled=1/g", "/etc/yum.repos.d/nobara-pikaos-additional.repo"],
+            capture_output=True,
+            text=True
         )
 
-    subprocess.run(
-        ["sed", "-i", "s/enabled=0/enabled=1/g", "/etc/yum.repos.d/nobara-pikaos-additional.repo"],
-        capture_output=True,
-        text=True
+    vulkan_git_detected = bool(installed_packages().installed_of(vulkan_git))
+    vulkan_replacements = (
+        [
+            "mesa-vulkan-drivers-git-freeworld.x86_64",
+            "mesa-vulkan-drivers-git-freeworld.i686",
+        ]
+        if vulkan_git_detected
+        else [
+            "mesa-vulkan-drivers-freeworld.x86_64",
+            "mesa-vulkan-drivers-freeworld.i686",
+        ]
     )
 
+    # The repo was possibly just enabled, reload the sack before resolving
+    dnf_session.invalidate(refresh_metadata=True)
+
+    # Download the replacements before anything is removed, so a slow or
+    # dropped connection cannot leave the system without codecs halfway through.
+    if not dry_run:
+        logger.info("Downloading media packages before replacing them...")
+        prefetch_packages(install=install + vulkan_replacements)
+
+    # One snapshot of the rpmdb answers every membership check below
+    installed = installed_packages()
+
+    action_log_string = "Purging media packages for a clean slate..."
+    combined_removal = hard_removal + soft_removal
+    indented_combined_removal = ["    " + line for line in combined_removal]
+    logger.info("%s\n\n%s\n", action_log_string, chr(10).join(indented_combined_removal))
+
+    vulkan_standard_installed = [package for package in vulkan_standard if installed.is_installed(package)]
+    vulkan_git_installed = [package for package in vulkan_git if installed.is_installed(package)]
+    # Removed in a single rpm call without dependency checks, their
+    # replacements are installed right after.
+    hard_removal_list = [package for package in hard_removal if installed.is_installed(package)]
+    soft_removal_list = [package for package in soft_removal if installed.is_installed(package)]
+
+    # The codec changes go into one planned transaction
+    codec_plan = TransactionPlan(logger)
+    codec_plan.add_remove(soft_removal_list)
+
     action_log_string = "Performing clean media package installation..."
     indented_install = ["    " + line for line in install]
     logger.info("%s\n\n%s\n", action_log_string, chr(10).join(indented_install))
-    install_list = []
-    for package in install:
-        install_check = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True
-        )
-        if install_check.returncode != 0:
-            install_list.append(package)
-
-    if install_list:
-        PackageUpdater(install_list, "install", None)
+    codec_plan.add_install(
+        [package for package in install if package in hard_removal_list or not installed.is_installed(package)]
+    )
 
-    if vulkan_standard_installed == 1:
-        vulkan_standard_freeworld = [
+    # The Vulkan drivers are swapped in a transaction of their own, the old
+    # ones only go out together with their freeworld replacement, so a
+    # failure leaves the installed drivers alone.
+    vulkan_plan = TransactionPlan(logger)
+    if vulkan_standard_installed:
+        vulkan_plan.add_replace(vulkan_standard_installed, [
             "mesa-vulkan-drivers-freeworld.x86_64",
             "mesa-vulkan-drivers-freeworld.i686",
-        ]
-        PackageUpdater(vulkan_standard_freeworld, "install", None)
+        ])
 
-    if vulkan_git_installed == 1:
-        vulkan_git_freeworld = [
+    if vulkan_git_installed:
+        vulkan_plan.add_replace(vulkan_git_installed, [
             "mesa-vulkan-drivers-git-freeworld.x86_64",
             "mesa-vulkan-drivers-git-freeworld.i686",
-        ]
-        PackageUpdater(vulkan_git_freeworld, "install", None)
+        ])
 
-    vulkan_install_check_standard_freeworld = subprocess.run(
-        ["rpm", "-q", "mesa-vulkan-drivers-freeworld"], capture_output=True, text=True
-    )
-    vulkan_install_check_git_freeworld = subprocess.run(
-        ["rpm", "-q", "mesa-vulkan-drivers-git-freeworld"], capture_output=True, text=True
-    )
-    if vulkan_standard_installed == 0 and vulkan_git_installed == 0 and vulkan_install_check_standard_freeworld.returncode != 0 and vulkan_install_check_git_freeworld.returncode != 0:
-        vulkan_standard_freeworld = [
+    if (
+        not vulkan_standard_installed
+        and not vulkan_git_installed
+        and not installed.is_installed("mesa-vulkan-drivers-freeworld")
+        and not installed.is_installed("mesa-vulkan-drivers-git-freeworld")
+    ):
+        vulkan_plan.add_install([
             "mesa-vulkan-drivers-freeworld.x86_64",
             "mesa-vulkan-drivers-freeworld.i686",
-        ]
-        PackageUpdater(vulkan_standard_freeworld, "install", None)
+        ])
+
+    if dry_run:
+        # The rpm -e --nodeps purge listed above has no dnf equivalent, so
+        # it is not part of the preview
+        logger.info("Dry run, nothing will be changed.")
+        codec_plan.commit(dry_run=True)
+        vulkan_plan.commit(dry_run=True)
+        return
+
+    # Nothing brings the purged packages back if their replacements then
+    # fail to resolve, so only purge once the codec plan resolves without
+    # them. dnf would also drop their dependents where rpm -e --nodeps
+    # keeps them, this only approximates the state after the purge.
+    if codec_plan.resolves(assume_removed=hard_removal_list):
+        if hard_removal_list:
+            subprocess.run(
+                ["rpm", "-e", "--nodeps", *hard_removal_list], capture_output=True, text=True
+            )
+        if not codec_plan.commit():
+            logger.error("Clean media package installation failed, see the log above for details.")
+    else:
+        logger.error("Media packages could not be resolved, keeping the installed ones. See the log above for details.")
+
+    if not vulkan_plan.commit():
+        logger.error("Replacing the Vulkan drivers failed, see the log above for details.")
 
     fixups_available = 0
 
@@ -1025,24 +1195,45 @@ def prompt_reboot() -> None:
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Update System")
+    parser.set_defaults(force_refresh=False)
+
+    # Options shared by every subcommand
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        "--force-refresh",
+        action="store_true",
+        help="Ignore cached update check, Flatpak remote summaries and quirk results and re-resolve against fresh metadata",
+    )
 
     subparsers = parser.add_subparsers(dest="command")
 
     subparsers.add_parser(
         "install-updates",
+        parents=[common_parser],
         help="Performs check-updates, install-fixups, then installs any updates available.",
     )
-    subparsers.add_parser("check-updates", help="Check for new updates and fixups.")
-    subparsers.add_parser("repair", help="Attempts repair using distro-sync.")
     subparsers.add_parser(
-        "install-fixups", help="Performs a series of known problem fixes."
+        "check-updates", parents=[common_parser], help="Check for new updates and fixups."
+    )
+    subparsers.add_parser(
+        "repair", parents=[common_parser], help="Attempts repair using distro-sync."
     )
     subparsers.add_parser(
+        "install-fixups", parents=[common_parser], help="Performs a series of known problem fixes."
+    )
+    codecs_parser = subparsers.add_parser(
         "install-codecs",
+        parents=[common_parser],
         help="Performs media codec installation.",
     )
+    codecs_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the merged package plan without changing anything",
+    )
     cli_parser = subparsers.add_parser(
         "cli",
+        parents=[common_parser],
         help="Run in CLI mode. Installs system updates and fixups by default; use --all to also install Flatpak updates.",
     )
     cli_parser.add_argument("username", help="Specify the username", nargs="?")
@@ -1052,7 +1243,9 @@ def parse_args() -> argparse.Namespace:
         help="Also install flatpak updates after the default CLI actions",
     )
 
-    subparsers.add_parser("check-repos", help="list enabled repo information")
+    subparsers.add_parser(
+        "check-repos", parents=[common_parser], help="list enabled repo information"
+    )
 
     argv = sys.argv[1:]
     known_commands = {
@@ -1173,29 +1366,28 @@ def cleanup_xhost():
             pass
 
 def main() -> None:
+    global force_refresh_requested
 
     args = parse_args()
     check_manual_sudo()
     check_root_privileges(args)
 
+    if args.force_refresh:
+        force_refresh_requested = 1
+        quirk_cache.clear()
+
     if args.command and os.geteuid() == 0:
         initialize_logging()
         logger.info("Running CLI mode...")
         # Display updates.txt content
-        try:
-            response = requests.get("https://updates.nobaraproject.org/updates.txt", timeout=5)
-            if response.status_code == 200:
-                content = response.text
-                print("\n" + "="*50)
-                print("Important Notices:")
-                print("="*50)
-                print(content)
-                print("="*50)
-            else:
-                error_message = f"Failed to fetch updates.nobaraproject.org/updates.txt (Status code: {response.status_code})"
-                print(error_message)
-        except Exception as e:
-            error_message = f"Error fetching updates: {str(e)}"
+        content, error_message = fetch_notices()
+        if content is not None:
+            print("\n" + "="*50)
+            print("Important Notices:")
+            print("="*50)
+            print(content)
+            print("="*50)
+        else:
             print(error_message)
         if args.command == "install-updates":
             check_repos()
@@ -1218,7 +1410,7 @@ def main() -> None:
             request_update_status()
             exit(0)
         if args.command == "install-codecs":
-            prompt_media_fixup()
+            prompt_media_fixup(args.dry_run)
             exit(0)
         if args.command == "install-fixups":
             check_updates()
@@ -1334,9 +1526,7 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         )  # Make the status_textview take the remaining 3/4 of the width
         status_scrolled_window.set_vexpand(True)  # Allow vertical expansion
 
-        # Connect to the insert-text signal to auto-scroll
-        status_buffer = self.status_textview.get_buffer()
-        status_buffer.connect("insert-text", self.on_status_text_inserted)
+        # TextViewHandler scrolls to the end after each batch of log lines
 
         # Create the flatpak user updates text view and its scrolled window
         self.flatpak_user_textview = Gtk.TextView()
@@ -1500,54 +1690,52 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
 
 
     def update_nobara_notices(self):
-        try:
-            response = requests.get("https://updates.nobaraproject.org/updates.txt", timeout=5)
-            if response.status_code == 200:
-                content = response.text
-                buffer = self.nobara_notices_textview.get_buffer()
-                buffer.set_text(content)
-
-                # Log the content with a clear separator
-                logger.info("\n" + "="*50)
-                logger.info("Important Notices:")
-                logger.info("="*50)
-                logger.info(content)
-                logger.info("="*50)
-            else:
-                error_message = f"Failed to fetch updates.nobaraproject.org/updates.txt (Status code: {response.status_code})"
-                buffer = self.nobara_notices_textview.get_buffer()
-                buffer.set_text(error_message)
-                logger.error(error_message)
-        except Exception as e:
-            error_message = f"Error fetching updates: {str(e)}"
-            buffer = self.nobara_notices_textview.get_buffer()
+        # Show the last notices we have right away, the window must not wait
+        # for the server. The fresh copy replaces them once it arrives.
+        cached = http_cache.cached(NOTICES_URL)
+        if cached is not None:
+            self.nobara_notices_textview.get_buffer().set_text(cached.text)
+        threading.Thread(target=self.update_nobara_notices_async, daemon=True).start()
+
+    def update_nobara_notices_async(self):
+        content, error_message = fetch_notices()
+        GLib.idle_add(self.show_nobara_notices, content, error_message)
+
+    def show_nobara_notices(self, content: str | None, error_message: str | None) -> bool:
+        buffer = self.nobara_notices_textview.get_buffer()
+        if content is not None:
+            buffer.set_text(content)
+
+            # Log the content with a clear separator
+            logger.info("\n" + "="*50)
+            logger.info("Important Notices:")
+            logger.info("="*50)
+            logger.info(content)
+            logger.info("="*50)
+        else:
             buffer.set_text(error_message)
             logger.error(error_message)
+        return False  # Stop the idle_add loop
 
-    def textview_updates(self) -> None:
-        result = check_updates(return_texts=True)
-        if result is None:
-            result = "", "", ""
-        sys_update_text, fp_user_update_text, fp_sys_update_text = result
+    def textview_updates(self, refresh: bool = False) -> None:
+        textviews = {
+            "system": self.update_textview,
+            "flatpak-user": self.flatpak_user_textview,
+            "flatpak-system": self.flatpak_system_textview,
+        }
 
         # Function to clear and insert text into a buffer
         def clear_and_insert_text(buffer, text):
             buffer.set_text("")  # Clear the buffer
             if text:
                 buffer.insert(buffer.get_end_iter(), text + "\n")
+            return False
 
-        if result:
-            # Clear and insert text into the update buffer
-            update_buffer = self.update_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, update_buffer, sys_update_text)
-
-            # Clear and insert text into the flatpak user buffer
-            user_buffer = self.flatpak_user_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, user_buffer, fp_user_update_text)
+        # Each view is filled as soon as its source answered
+        def on_source_done(source: str, text: str | None) -> None:
+            GLib.idle_add(clear_and_insert_text, textviews[source].get_buffer(), text)
 
-            # Clear and insert text into the flatpak system buffer
-            system_buffer = self.flatpak_system_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, system_buffer, fp_sys_update_text)
+        check_updates(on_source_done=on_source_done, refresh=refresh)
 
     def status_label_updates(self, message: str) -> None:
         GLib.idle_add(
@@ -1574,7 +1762,7 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
     def on_check_updates_button_clicked_async(self):
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
-        self.textview_updates()
+        self.textview_updates(refresh=True)
         install_fixups()
         self.textview_updates()
         toggle_refresh()
@@ -1628,12 +1816,6 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
             self.orig_user_uid, self.orig_user_gid, "on_button_popen_async", option
         )
 
-    def on_status_text_inserted(self, buffer, iter, text, length):
-        # Create a mark at the end of the buffer
-        mark = buffer.create_mark(None, buffer.get_end_iter(), False)
-        # Scroll to the mark after the text has been inserted
-        GLib.idle_add(self.status_textview.scroll_to_mark, mark, 0.0, True, 0.0, 1.0)
-
     def toggle_buttons_during_refresh(self):
         if get_refresh() == 1:
             GLib.idle_add(button_ensure_sensitivity, self.check_updates_button, False)
@@ -8,6 +8,10 @@ import shlex
 import pwd
 import re
 import glob
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -22,1104 +26,1159 @@ gi.require_version("Flatpak", "1.0")
 os.environ.setdefault("LANG", "C.UTF-8")
 os.environ.setdefault("LC_ALL", "C.UTF-8")
 
-from nobara_updater.dnf import PackageUpdater, updatechecker  # type: ignore[import]
+from nobara_updater.dnf import (  # type: ignore[import]
+    CACHE_DIR,
+    PackageUpdater,
+    TransactionPlan,
+    installed_packages,
+    prefetch_packages,
+    rpmdb_cookie,
+    rpmdb_stamp,
+    updatechecker,
+)
+from nobara_updater.structured_log import in_current_context  # type: ignore[import]
+
+CURRENT_RELEASE = 43
+DETECT_WORKERS = 8
+
+logger = logging.getLogger("nobara-updater.quirks")
+
+
+def path_state(path: str) -> str:
+    # mtime and size of a file, or of every entry of a directory
+    try:
+        if os.path.isdir(path):
+            entries = []
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                st = entry.stat(follow_symlinks=False)
+                entries.append(f"{entry.name}:{st.st_mtime_ns}:{st.st_size}")
+            return "\n".join(entries)
+        st = os.stat(path)
+        return f"{st.st_mtime_ns}:{st.st_size}"
+    except OSError:
+        return "missing"
+
+
+class QuirkResultCache:
+    # Remembers which quirks found nothing to do, together with a fingerprint
+    # of everything their detect() looked at. While the fingerprint still
+    # matches, detecting again would give the same answer and is skipped.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def code_state() -> str:
+        # An updated nobara-updater may have changed the quirks themselves
+        return path_state(__file__)
+
+    def load(self) -> dict[str, str]:
+        with self._lock:
+            try:
+                with self.path.open() as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return {}
+        if data.get("code") != self.code_state():
+            return {}
+        return dict(data.get("clean", {}))
+
+    def store(self, clean: dict[str, str]) -> None:
+        with self._lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                with tmp_path.open("w") as f:
+                    json.dump(
+                        {"code": self.code_state(), "timestamp": time.time(), "clean": clean}, f
+                    )
+                tmp_path.replace(self.path)
+            except OSError as e:
+                logger.warning("Could not write quirk result cache: %s", e)
+
+    def clear(self) -> None:
+        with self._lock:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not clear quirk result cache: %s", e)
+
+
+quirk_cache = QuirkResultCache(CACHE_DIR / "quirks.json")
+
+
+class QuirkContext:
+    # State shared by the quirks of one pass. detect() only reads from it and
+    # may run concurrently, apply() runs in order and records what the caller
+    # has to do afterwards.
+    def __init__(self, fixup: "QuirkFixup", package_names: list[str]) -> None:
+        self.fixup = fixup
+        self.logger = fixup.logger
+        self.plan = fixup.plan
+        self.package_names = package_names
+        self.installed_stamp = rpmdb_stamp()
+        self._installed = None
+        self._inputs: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.perform_kernel_actions = 0
+        self.perform_reboot_request = 0
+        self.perform_refresh = 0
+        self.media_fixup = 0
+        # Set by quirks after which the updater has to relaunch itself
+        self.stop = False
+
+    @property
+    def installed(self):
+        # Only built if some quirk actually has to look at it
+        with self._lock:
+            if self._installed is None:
+                self._installed = installed_packages()
+            return self._installed
+
+    def is_installed(self, spec: str) -> bool:
+        return self.installed.is_installed(spec)
+
+    def refresh_snapshot(self) -> bool:
+        # Returns True if the installed set changed since the last snapshot
+        stamp = rpmdb_stamp()
+        if stamp == self.installed_stamp:
+            return False
+        with self._lock:
+            self.installed_stamp = stamp
+            self._installed = None
+            self._inputs.clear()
+        return True
+
+    def input_state(self, name: str) -> str:
+        # Current value of one of the inputs a quirk declares, see Quirk.inputs
+        with self._lock:
+            if name in self._inputs:
+                return self._inputs[name]
+        if name == "rpmdb":
+            value = rpmdb_cookie()
+        elif name == "updates":
+            value = "\n".join(sorted(self.package_names))
+        elif name == "kernel":
+            value = os.uname().release
+        elif name == "boot":
+            try:
+                with open("/proc/sys/kernel/random/boot_id") as f:
+                    value = f.read().strip()
+            except OSError:
+                value = ""
+        elif name.startswith("/"):
+            value = path_state(name)
+        else:
+            raise ValueError(f"Unknown quirk input {name}")
+        with self._lock:
+            self._inputs[name] = value
+        return value
+
+    def fingerprint(self, quirk: "Quirk") -> str | None:
+        if not quirk.inputs:
+            return None
+        digest = hashlib.sha256(quirk.name.encode())
+        for name in quirk.inputs:
+            digest.update(f"\0{name}\0{self.input_state(name)}".encode())
+        return digest.hexdigest()
+
+
+class Quirk:
+    # A single fixup. detect() must not change the system and returns a
+    # finding, anything falsy means there is nothing to do. apply() gets that
+    # finding back and performs the repair.
+    name = ""
+    description = ""
+    # Names of quirks that have to run before this one
+    after: tuple[str, ...] = ("self-update",)
+    # Everything detect() reads: "rpmdb", "updates" (the pending upgrade
+    # list), "kernel", "boot" or an absolute file or directory path. While
+    # none of them changed, a clean verdict from an earlier pass is reused.
+    # Quirks without inputs are detected on every pass.
+    inputs: tuple[str, ...] = ()
+
+    def detect(self, ctx: QuirkContext):
+        return None
+
+    def apply(self, ctx: QuirkContext, finding) -> None:
+        pass
+
+
+QUIRKS: list[Quirk] = []
+
+
+def register_quirk(cls):
+    QUIRKS.append(cls())
+    return cls
+
+
+def ordered_quirks(quirks: list[Quirk] | None = None) -> list[Quirk]:
+    # Registration order, except where a quirk declares it has to run after another one
+    quirks = list(QUIRKS if quirks is None else quirks)
+    by_name = {quirk.name: quirk for quirk in quirks}
+    ordered: list[Quirk] = []
+    placed: set[str] = set()
+    visiting: set[str] = set()
+
+    def place(quirk: Quirk) -> None:
+        if quirk.name in placed:
+            return
+        if quirk.name in visiting:
+            raise ValueError(f"Quirk ordering cycle at {quirk.name}")
+        visiting.add(quirk.name)
+        for dependency in quirk.after:
+            if dependency not in by_name:
+                raise ValueError(f"Quirk {quirk.name} runs after unknown quirk {dependency}")
+            place(by_name[dependency])
+        visiting.discard(quirk.name)
+        placed.add(quirk.name)
+        ordered.append(quirk)
+
+    for quirk in quirks:
+        place(quirk)
+    return ordered
+
+
+def dmesg_contains(text: str) -> bool:
+    return subprocess.run(
+        f"dmesg | grep '{text}'", capture_output=True, text=True, shell=True
+    ).returncode == 0
+
+
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def current_plymouth_theme() -> str:
+    return subprocess.run(
+        ["plymouth-set-default-theme"], capture_output=True, text=True
+    ).stdout
+
+
+def set_boot_theme(steamos: bool) -> None:
+    # Switch plymouth and grub between the stock look and the steamos-like
+    # one used by gamescope sessions
+    grub_file_path = "/etc/default/grub"
+    grub_hidden_lines = [
+        "GRUB_TIMEOUT_STYLE='hidden'",
+        "GRUB_HIDDEN_TIMEOUT='0'",
+        "GRUB_HIDDEN_TIMEOUT_QUIET='true'",
+    ]
+
+    subprocess.run(
+        ["plymouth-set-default-theme", "steamos" if steamos else "bgrt"],
+        capture_output=True,
+        text=True,
+    )
+    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+
+    sha256_before = file_sha256(grub_file_path)
+
+    if steamos:
+        subprocess.run(
+            ["sed", "-i", "s/GRUB_TIMEOUT='5'/GRUB_TIMEOUT='0'/g", grub_file_path],
+            capture_output=True,
+            text=True,
+        )
+        with open(grub_file_path, "r") as file:
+            current_contents = file.readlines()
+        with open(grub_file_path, "a") as file:
+            for line in grub_hidden_lines:
+                if line + "\n" not in current_contents:
+                    file.write(line + "\n")
+    else:
+        subprocess.run(
+            ["sed", "-i", "s/GRUB_TIMEOUT='0'/GRUB_TIMEOUT='5'/g", grub_file_path],
+            capture_output=True,
+            text=True,
+        )
+        with open(grub_file_path, "r") as file:
+            current_contents = file.readlines()
+        with open(grub_file_path, "w") as file:
+            file.writelines(
+                line for line in current_contents if line.strip() not in grub_hidden_lines
+            )
 
+    if sha256_before != file_sha256(grub_file_path):
+        subprocess.run(
+            ["/usr/sbin/grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"],
+            capture_output=True,
+            text=True,
+        )
 
-class QuirkFixup:
-    def __init__(self, logger=None):
-        self.logger = logger if logger else logging.getLogger("nobara-updater.quirks")
 
-    def system_quirk_fixup(self):
-        package_names = updatechecker()
-        action = "upgrade"
-        perform_kernel_actions = 0
-        perform_reboot_request = 0
-        perform_refresh = 0
-        current_release = 43
-        # START QUIRKS LIST
-
-        # QUIRK: Make sure to refresh the repositories and gpg-keys before anything
-        self.logger.info("QUIRK: Make sure to refresh the repositories and gpg-keys before anything.")
-        critical_packages = [
-            "fedora-gpg-keys",
-            "nobara-gpg-keys",
-            "nobara-repos",
-        ]
-        if any(pkg in package_names for pkg in critical_packages):
-            critical_updates = [
-                pkg for pkg in package_names if pkg in critical_packages
-            ]
-            log_message = "Updates for repository packages detected: {}. Updating these first...\n".format(
-                ", ".join(critical_updates)
-            )
-            subprocess.run("dnf update -y --refresh fedora-repos fedora-gpg-keys nobara-repos nobara-gpg-keys --nogpgcheck", shell=True, capture_output=True, text=True, check=True)
-            if "fedora-gpg-keys" in package_names:
-                package_names = [pkg for pkg in package_names if pkg != "fedora-gpg-keys"]
-            if "nobara-repos" in package_names:
-                package_names = [pkg for pkg in package_names if pkg != "nobara-repos"]
-            if "nobara-gpg-keys" in package_names:
-                package_names = [pkg for pkg in package_names if pkg != "nobara-gpg-keys"]
-            perform_refresh = 1
-            return (
-                0,
-                0,
-                0,
-                perform_refresh,
-            )
-            self.logger.info(log_message)
-        # QUIRK: Make sure to update the updater itself and refresh before anything
-        self.logger.info("QUIRK: Make sure to update the updater itself and refresh before anything.")
-        # Update release packages on new release
-
-        result = subprocess.run("cat /etc/os-release | grep VERSION_ID", shell=True, capture_output=True, text=True, check=True)
-
-        # Split the output into lines
-        release = result.stdout.strip().split('\n')
-
-        if current_release not in release:
-            subprocess.run("dnf update -y --refresh nobara-release* --nogpgcheck", shell=True, capture_output=True, text=True, check=True)
-
-        if "nobara-updater" in package_names:
-            log_message = "An update for the Update System app has been detected, updating self...\n"
-            subprocess.run("rpm -e --nodeps nobara-updater", shell=True, capture_output=True, text=True, check=True)
-            self.ensure_package_installed("nobara-updater")
-            perform_refresh = 1
-            self.logger.info(perform_refresh)
-            return (
-                0,
-                0,
-                0,
-                perform_refresh,
+# START QUIRKS LIST
+
+
+@register_quirk
+class RepoPackagesQuirk(Quirk):
+    name = "repo-packages"
+    description = "Make sure to refresh the repositories and gpg-keys before anything."
+    inputs = ("updates",)
+    after = ()
+    critical_packages = [
+        "fedora-gpg-keys",
+        "nobara-gpg-keys",
+        "nobara-repos",
+    ]
+
+    def detect(self, ctx):
+        return [pkg for pkg in ctx.package_names if pkg in self.critical_packages]
+
+    def apply(self, ctx, finding):
+        ctx.logger.info(
+            "Updates for repository packages detected: {}. Updating these first...\n".format(
+                ", ".join(finding)
             )
-            self.logger.info(log_message)
-        # QUIRK: Cleanup outdated kernel modules
-        self.logger.info("QUIRK: Cleanup outdated kernel modules.")
-        try:
-            # Run the command and capture the output
-            result = subprocess.run("ls /boot/ | grep vmlinuz | grep -v rescue", shell=True, capture_output=True, text=True, check=True)
+        )
+        subprocess.run("dnf update -y --refresh fedora-repos fedora-gpg-keys nobara-repos nobara-gpg-keys --nogpgcheck", shell=True, capture_output=True, text=True, check=True)
+        ctx.perform_refresh = 1
+        ctx.stop = True
 
-            # Split the output into lines
-            lines = result.stdout.strip().split('\n')
 
-            # Extract version numbers by removing 'vmlinuz-' prefix
-            versions = [line.replace('vmlinuz-', '') for line in lines if line.startswith('vmlinuz-')]
+@register_quirk
+class ReleasePackagesQuirk(Quirk):
+    name = "release-packages"
+    description = "Update release packages on new release."
+    inputs = ("/etc/os-release",)
+    after = ("repo-packages",)
 
-            # Run the ls command and capture the output
-            result = subprocess.run(['ls', '/lib/modules'], capture_output=True, text=True, check=True)
+    def detect(self, ctx):
+        with open("/etc/os-release", "r", encoding="utf-8", errors="ignore") as f:
+            release = [line.strip() for line in f if line.startswith("VERSION_ID")]
+        return f"VERSION_ID={CURRENT_RELEASE}" not in release
 
-            # Split the output into entries
-            modules = result.stdout.strip().split()
+    def apply(self, ctx, finding):
+        subprocess.run("dnf update -y --refresh nobara-release* --nogpgcheck", shell=True, capture_output=True, text=True, check=True)
 
-            # Filter modules that do not match the kernel versions
-            filtered_modules = [module for module in modules if module not in versions]
 
-            # Remove filtered modules
-            for directory in filtered_modules:
-                if directory:  # Check if directory is not None or empty
-                    dir_path = os.path.join('/lib/modules', directory)
-                    if os.path.exists(dir_path):  # Check if the path exists
-                        shutil.rmtree(dir_path)
+@register_quirk
+class SelfUpdateQuirk(Quirk):
+    name = "self-update"
+    description = "Make sure to update the updater itself and refresh before anything."
+    inputs = ("updates",)
+    after = ("release-packages",)
 
-        except subprocess.CalledProcessError as e:
-            print(f"An error occurred: {e}")
+    def detect(self, ctx):
+        return "nobara-updater" in ctx.package_names
 
-        # QUIRK: Remove RPM Fusion release packages if they exist, we use Terra and they conflict.
-        self.logger.info("QUIRK: Remove RPM Fusion release packages if they exist, we use Terra and they conflict.")
-        rpmfusion_packages = [
-            "rpmfusion-free-release",
-            "rpmfusion-nonfree-release",
-            "rpmfusion-free-release-tainted",
-            "rpmfusion-nonfree-release-tainted",
-            "rpmfusion-free-release-rawhide",
-            "rpmfusion-nonfree-release-rawhide",
-        ]
-        if self.remove_installed_packages(rpmfusion_packages) == 1:
-            perform_refresh = 1
+    def apply(self, ctx, finding):
+        ctx.logger.info("An update for the Update System app has been detected, updating self...\n")
+        subprocess.run("rpm -e --nodeps nobara-updater", shell=True, capture_output=True, text=True, check=True)
+        ctx.fixup.ensure_package_installed("nobara-updater")
+        ctx.perform_refresh = 1
+        ctx.stop = True
 
-        self.logger.info("QUIRK: maliit-keyboard, as plasma-keyboard is now default.")
-        rpmfusion_packages = [
-            "maliit-keyboard",
-        ]
-        self.remove_installed_packages(rpmfusion_packages)
 
-        # QUIRK: Repair incomplete TigerVNC server package set.
-        self.logger.info("QUIRK: Repair incomplete TigerVNC server package set.")
-        tigervnc_installed = [
-            "tigervnc-license",
-            "tigervnc-server-minimal",
-        ]
-        tigervnc_missing = [
-            "tigervnc-x11-server",
-            "tigervnc-selinux",
-        ]
-        if (
-            all(
-                subprocess.run(["rpm", "-q", pkg], capture_output=True, text=True).returncode == 0
-                for pkg in tigervnc_installed
-            )
-            and all(
-                subprocess.run(["rpm", "-q", pkg], capture_output=True, text=True).returncode != 0
-                for pkg in tigervnc_missing
-            )
-        ):
-            if self.remove_installed_packages(tigervnc_installed) == 1:
-                perform_refresh = 1
-            if self.ensure_package_installed(tigervnc_installed + tigervnc_missing) == 1:
-                perform_refresh = 1
-
-        # QUIRK: Make sure dnf-app-center is installed.
-        self.logger.info("QUIRK: Make sure dnf-app-center is installed.")
-        if self.ensure_package_installed("dnf-app-center") == 1:
-            perform_refresh = 1
-
-        # QUIRK: Replace SDDM with Plasma Login Manager when SDDM is installed.
-        self.logger.info("QUIRK: Replace SDDM with Plasma Login Manager when SDDM is installed.")
-        check_sddm = subprocess.run(
-            ["rpm", "-q", "sddm"], capture_output=True, text=True
+@register_quirk
+class StaleKernelModulesQuirk(Quirk):
+    name = "stale-kernel-modules"
+    description = "Cleanup outdated kernel modules."
+    inputs = ("/boot", "/lib/modules")
+
+    def detect(self, ctx):
+        try:
+            versions = [
+                entry.replace("vmlinuz-", "")
+                for entry in os.listdir("/boot")
+                if entry.startswith("vmlinuz-") and "rescue" not in entry
+            ]
+            modules = os.listdir("/lib/modules")
+        except OSError as e:
+            print(f"An error occurred: {e}")
+            return []
+        # Without any kernel image found there is nothing to compare against
+        if not versions:
+            return []
+        return [module for module in modules if module and module not in versions]
+
+    def apply(self, ctx, finding):
+        for directory in finding:
+            dir_path = os.path.join("/lib/modules", directory)
+            if os.path.exists(dir_path):
+                shutil.rmtree(dir_path)
+
+
+@register_quirk
+class RpmFusionReleaseQuirk(Quirk):
+    name = "rpmfusion-release"
+    description = "Remove RPM Fusion release packages if they exist, we use Terra and they conflict."
+    inputs = ("rpmdb",)
+    packages = [
+        "rpmfusion-free-release",
+        "rpmfusion-nonfree-release",
+        "rpmfusion-free-release-tainted",
+        "rpmfusion-nonfree-release-tainted",
+        "rpmfusion-free-release-rawhide",
+        "rpmfusion-nonfree-release-rawhide",
+    ]
+
+    def detect(self, ctx):
+        return ctx.installed.installed_of(self.packages)
+
+    def apply(self, ctx, finding):
+        if ctx.fixup.remove_installed_packages(finding, defer=True) == 1:
+            ctx.perform_refresh = 1
+
+
+@register_quirk
+class MaliitKeyboardQuirk(Quirk):
+    name = "maliit-keyboard"
+    description = "maliit-keyboard, as plasma-keyboard is now default."
+    inputs = ("rpmdb",)
+
+    def detect(self, ctx):
+        return ctx.installed.installed_of(["maliit-keyboard"])
+
+    def apply(self, ctx, finding):
+        ctx.fixup.remove_installed_packages(finding, defer=True)
+
+
+@register_quirk
+class TigerVncQuirk(Quirk):
+    name = "tigervnc"
+    description = "Repair incomplete TigerVNC server package set."
+    inputs = ("rpmdb",)
+    installed = [
+        "tigervnc-license",
+        "tigervnc-server-minimal",
+    ]
+    missing = [
+        "tigervnc-x11-server",
+        "tigervnc-selinux",
+    ]
+
+    def detect(self, ctx):
+        return (
+            all(ctx.is_installed(pkg) for pkg in self.installed)
+            and all(not ctx.is_installed(pkg) for pkg in self.missing)
         )
-        if check_sddm.returncode == 0:
-            sddm_conf = Path("/etc/sddm.conf")
-            sddm_conf_d = Path("/etc/sddm.conf.d")
-            plasmalogin_conf = Path("/etc/plasmalogin.conf")
-            plasmalogin_conf_d = Path("/etc/plasmalogin.conf.d")
 
-            plasmalogin_conf_d.mkdir(parents=True, exist_ok=True)
+    def apply(self, ctx, finding):
+        # Queued as remove + install of the same names, which the plan
+        # turns into a reinstall of the partial set plus the missing parts.
+        ctx.plan.add_remove(self.installed)
+        ctx.plan.add_install(self.installed + self.missing)
+        ctx.perform_refresh = 1
 
-            if sddm_conf_d.exists() and sddm_conf_d.is_dir():
-                for conf_file in sddm_conf_d.iterdir():
-                    if conf_file.is_file():
-                        shutil.copy2(conf_file, plasmalogin_conf_d / conf_file.name)
 
-            if sddm_conf.exists() and sddm_conf.is_file():
-                shutil.copy2(sddm_conf, plasmalogin_conf)
+@register_quirk
+class DnfAppCenterQuirk(Quirk):
+    name = "dnf-app-center"
+    description = "Make sure dnf-app-center is installed."
+    inputs = ("rpmdb",)
 
-            subprocess.run(["dnf", "remove", "-y", "sddm", "--setopt=tsflags=noscripts"], capture_output=True, text=True)
-            self.ensure_package_installed("plasma-login-manager")
+    def detect(self, ctx):
+        return not ctx.is_installed("dnf-app-center")
 
-            subprocess.run(
-                ["systemctl", "disable", "sddm.service"],
-                capture_output=True,
-                text=True,
-                check=False,
-            )
-            subprocess.run(
-                ["systemctl", "enable", "plasmalogin.service"],
-                capture_output=True,
-                text=True,
-                check=False,
-            )
+    def apply(self, ctx, finding):
+        if ctx.fixup.ensure_package_installed("dnf-app-center", defer=True) == 1:
+            ctx.perform_refresh = 1
 
-        # QUIRK: Make sure to run both dracut and dkms if any kmods  or kernel packages were updated.
-        self.logger.info("QUIRK: Make sure to run both dracut and dkms if any kmods  or kernel packages were updated.")
-        # Check if any packages contain "kernel" or "dkms"
-        kernel_kmod_packages = [
-            pkg for pkg in package_names if "kernel" in pkg or "dkms" in pkg
-        ]
-        if kernel_kmod_packages:
-            perform_kernel_actions = 1
-            perform_reboot_request = 1
-
-        # QUIRK: If kwin or mutter are being updated, ask for a reboot.
-        self.logger.info("QUIRK: If kwin or mutter are being updated, ask for a reboot.")
-        de_update_packages = [
-            pkg for pkg in package_names if "kwin" in pkg or "mutter" in pkg
-        ]
-        if de_update_packages:
-            perform_reboot_request = 1
 
-        # QUIRK: Install InputPlumber for Controller input, install steam firmware for steamdecks. Cleanup old packages.
-        remove_names = []
-        updatelist  = []
+@register_quirk
+class PlasmaLoginManagerQuirk(Quirk):
+    name = "plasma-login-manager"
+    description = "Replace SDDM with Plasma Login Manager when SDDM is installed."
+    inputs = ("rpmdb",)
 
-        self.logger.info("QUIRK: Install InputPlumber for Controller input, install steam firmware for steamdecks. Cleanup old packages.")
+    def detect(self, ctx):
+        return ctx.is_installed("sddm")
 
-        # Install InputPlumber
-        check_ip = subprocess.run(
-            ["rpm", "-q", "inputplumber"], capture_output=True, text=True
-        )
-        if check_ip.returncode != 0:
-            updatelist.append("inputplumber")
+    def apply(self, ctx, finding):
+        sddm_conf = Path("/etc/sddm.conf")
+        sddm_conf_d = Path("/etc/sddm.conf.d")
+        plasmalogin_conf = Path("/etc/plasmalogin.conf")
+        plasmalogin_conf_d = Path("/etc/plasmalogin.conf.d")
 
-        # Install ROG Ally/X firmware if needed
-        check_ally = subprocess.run(
-            "dmesg | grep 'ROG Ally'", capture_output=True, text=True, shell=True
-        )
-        ally_detected = check_ally.returncode == 0
-        if ally_detected:
-            self.logger.info(
-                "Found ROG Ally, installing firmware"
-            )
+        plasmalogin_conf_d.mkdir(parents=True, exist_ok=True)
 
-            rogfw_name = "rogally-firmware"
-            check_rogfw = subprocess.run(
-                ["rpm", "-q", rogfw_name], capture_output=True, text=True
-            )
-            rogfw_installed = check_rogfw.returncode == 0
-            # Remove it, it's upstreamed now'
-            if rogfw_installed:
-                PackageUpdater([rogfw_name], "remove", None)
+        if sddm_conf_d.exists() and sddm_conf_d.is_dir():
+            for conf_file in sddm_conf_d.iterdir():
+                if conf_file.is_file():
+                    shutil.copy2(conf_file, plasmalogin_conf_d / conf_file.name)
 
-        check_falcond = subprocess.run(
-            ["rpm", "-q", "falcond"], capture_output=True, text=True
-        )
-        falcond_installed = check_falcond.returncode == 0
-        if not falcond_installed:
-            PackageUpdater(["falcond"], "install", None)
-            subprocess.run(
-                ["systemctl", "enable", "--now", "falcond"],
-                capture_output=True,
-                text=True,
-            )
+        if sddm_conf.exists() and sddm_conf.is_file():
+            shutil.copy2(sddm_conf, plasmalogin_conf)
 
+        # Not deferred into the shared plan: sddm goes away right after, and
+        # it may only go once its replacement is actually installed, or the
+        # system is left without a display manager.
+        ctx.fixup.ensure_package_installed("plasma-login-manager")
+        if not ctx.fixup.is_installed("plasma-login-manager"):
+            ctx.logger.error("Installing plasma-login-manager failed, keeping SDDM.")
+            return
 
-        check_gamescope_htpc = subprocess.run(
-            ["rpm", "-q", "gamescope-htpc-common"], capture_output=True, text=True
-        )
-        gamescope_htpc_installed = check_gamescope_htpc.returncode == 0
+        subprocess.run(["dnf", "remove", "-y", "sddm", "--setopt=tsflags=noscripts"], capture_output=True, text=True)
 
-        check_gamescope_session_common = subprocess.run(
-            ["rpm", "-q", "gamescope-session-common"], capture_output=True, text=True
+        subprocess.run(
+            ["systemctl", "disable", "sddm.service"],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        subprocess.run(
+            ["systemctl", "enable", "plasmalogin.service"],
+            capture_output=True,
+            text=True,
+            check=False,
         )
-        gamescope_session_common_installed = check_gamescope_session_common.returncode == 0
-        if gamescope_htpc_installed:
-            if not gamescope_session_common_installed:
-                # Return to normal grub + plymouth first.
-                plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
-                if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
-
-                # Run the 'plymouth-set-default-theme' command and capture its output
-                check_theme = subprocess.run(
-                    ["plymouth-set-default-theme"],
-                    capture_output=True,
-                    text=True
-                )
-                if 'steamos' in check_theme.stdout:
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["plymouth-set-default-theme", "bgrt"],
-                        capture_output=True,
-                        text=True,
-                    )
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
 
-                    # Path to the grub configuration file
-                    grub_file_path = "/etc/default/grub"  # Use the test file path
+@register_quirk
+class KernelUpdateQuirk(Quirk):
+    name = "kernel-update"
+    description = "Make sure to run both dracut and dkms if any kmods  or kernel packages were updated."
+    inputs = ("updates",)
 
-                    # Function to calculate SHA256 checksum
-                    def calculate_sha256(file_path):
-                        result = subprocess.run(
-                            ["sha256sum", file_path], capture_output=True, text=True
-                        )
-                        return result.stdout.split()[0]  # Extract the checksum from the output
+    def detect(self, ctx):
+        return [pkg for pkg in ctx.package_names if "kernel" in pkg or "dkms" in pkg]
 
-                    # Calculate SHA256 checksum before changes
-                    sha256_before = calculate_sha256(grub_file_path)
+    def apply(self, ctx, finding):
+        ctx.perform_kernel_actions = 1
+        ctx.perform_reboot_request = 1
 
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["sed", "-i", "s/GRUB_TIMEOUT='0'/GRUB_TIMEOUT='5'/g", "/etc/default/grub"],
-                        capture_output=True,
-                        text=True,
-                    )
 
-                    # Lines to remove from the file
-                    lines_to_remove = [
-                        "GRUB_TIMEOUT_STYLE='hidden'",
-                        "GRUB_HIDDEN_TIMEOUT='0'",
-                        "GRUB_HIDDEN_TIMEOUT_QUIET='true'"
-                    ]
-
-                    # Read the current contents of the file
-                    with open(grub_file_path, "r") as file:
-                        current_contents = file.readlines()
-
-                    # Filter out the lines to remove
-                    updated_contents = [
-                        line for line in current_contents if line.strip() not in lines_to_remove
-                    ]
-
-                    # Write the updated contents back to the file
-                    with open(grub_file_path, "w") as file:
-                        file.writelines(updated_contents)
-
-                    # Calculate SHA256 checksum after changes
-                    sha256_after = calculate_sha256(grub_file_path)
-
-                    # Compare checksums
-                    if sha256_before != sha256_after:
-                        subprocess.run(
-                            ["/usr/sbin/grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"],
-                            capture_output=True,
-                            text=True,
-                        )
-            else:
-                # Fixup plymouth so it's more steamos-like
-                plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
-                if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
-
-                # Run the 'plymouth-set-default-theme' command and capture its output
-                check_theme = subprocess.run(
-                    ["plymouth-set-default-theme"],
-                    capture_output=True,
-                    text=True
-                )
-                if not 'steamos' in check_theme.stdout:
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["plymouth-set-default-theme", "steamos"],
-                        capture_output=True,
-                        text=True,
-                    )
+@register_quirk
+class CompositorUpdateQuirk(Quirk):
+    name = "compositor-update"
+    description = "If kwin or mutter are being updated, ask for a reboot."
+    inputs = ("updates",)
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+    def detect(self, ctx):
+        return [pkg for pkg in ctx.package_names if "kwin" in pkg or "mutter" in pkg]
 
-                    # Path to the grub configuration file
-                    grub_file_path = "/etc/default/grub"  # Use the test file path
+    def apply(self, ctx, finding):
+        ctx.perform_reboot_request = 1
 
-                    # Function to calculate SHA256 checksum
-                    def calculate_sha256(file_path):
-                        result = subprocess.run(
-                            ["sha256sum", file_path], capture_output=True, text=True
-                        )
-                        return result.stdout.split()[0]  # Extract the checksum from the output
 
-                    # Calculate SHA256 checksum before changes
-                    sha256_before = calculate_sha256(grub_file_path)
+@register_quirk
+class InputPlumberQuirk(Quirk):
+    name = "inputplumber"
+    description = "Install InputPlumber for Controller input."
+    inputs = ("rpmdb",)
 
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["sed", "-i", "s/GRUB_TIMEOUT='5'/GRUB_TIMEOUT='0'/g", "/etc/default/grub"],
-                        capture_output=True,
-                        text=True,
-                    )
+    def detect(self, ctx):
+        return not ctx.is_installed("inputplumber")
 
-                    # Lines to add to the file
-                    lines_to_add = [
-                        "GRUB_TIMEOUT_STYLE='hidden'",
-                        "GRUB_HIDDEN_TIMEOUT='0'",
-                        "GRUB_HIDDEN_TIMEOUT_QUIET='true'"
-                    ]
-
-                    # Read the current contents of the file
-                    with open(grub_file_path, "r") as file:
-                        current_contents = file.readlines()
-
-                    # Function to check if a line exists and append it if not
-                    def add_line_if_missing(line):
-                        if line + "\n" not in current_contents:  # Ensure newline is considered
-                            with open(grub_file_path, "a") as file:  # Open file in append mode
-                                file.write(line + "\n")  # Append the line with a newline
-
-                    # Check and add each line
-                    for line in lines_to_add:
-                        add_line_if_missing(line)
-
-                    # Calculate SHA256 checksum after changes
-                    sha256_after = calculate_sha256(grub_file_path)
-
-                    # Compare checksums
-                    if sha256_before != sha256_after:
-                        subprocess.run(
-                            ["/usr/sbin/grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"],
-                            capture_output=True,
-                            text=True,
-                        )
-        if gamescope_session_common_installed:
-            if not gamescope_htpc_installed:
-                # Return to normal grub + plymouth first.
-                plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
-                if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
-
-                # Run the 'plymouth-set-default-theme' command and capture its output
-                check_theme = subprocess.run(
-                    ["plymouth-set-default-theme"],
-                    capture_output=True,
-                    text=True
-                )
-                if 'steamos' in check_theme.stdout:
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["plymouth-set-default-theme", "bgrt"],
-                        capture_output=True,
-                        text=True,
-                    )
+    def apply(self, ctx, finding):
+        ctx.plan.add_install("inputplumber")
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
 
-                    # Path to the grub configuration file
-                    grub_file_path = "/etc/default/grub"  # Use the test file path
+@register_quirk
+class RogAllyFirmwareQuirk(Quirk):
+    name = "rogally-firmware"
+    description = "Remove ROG Ally/X firmware package, it's upstreamed now."
+    inputs = ("rpmdb", "boot")
 
-                    # Function to calculate SHA256 checksum
-                    def calculate_sha256(file_path):
-                        result = subprocess.run(
-                            ["sha256sum", file_path], capture_output=True, text=True
-                        )
-                        return result.stdout.split()[0]  # Extract the checksum from the output
+    def detect(self, ctx):
+        return ctx.is_installed("rogally-firmware") and dmesg_contains("ROG Ally")
 
-                    # Calculate SHA256 checksum before changes
-                    sha256_before = calculate_sha256(grub_file_path)
+    def apply(self, ctx, finding):
+        ctx.logger.info("Found ROG Ally, removing rogally-firmware")
+        ctx.plan.add_remove("rogally-firmware")
 
-                    # Fixup grub so it's more steamos-like
-                    subprocess.run(
-                        ["sed", "-i", "s/GRUB_TIMEOUT='0'/GRUB_TIMEOUT='5'/g", "/etc/default/grub"],
-                        capture_output=True,
-                        text=True,
-                    )
 
-                    # Lines to remove from the file
-                    lines_to_remove = [
-                        "GRUB_TIMEOUT_STYLE='hidden'",
-                        "GRUB_HIDDEN_TIMEOUT='0'",
-                        "GRUB_HIDDEN_TIMEOUT_QUIET='true'"
-                    ]
-
-                    # Read the current contents of the file
-                    with open(grub_file_path, "r") as file:
-                        current_contents = file.readlines()
-
-                    # Filter out the lines to remove
-                    updated_contents = [
-                        line for line in current_contents if line.strip() not in lines_to_remove
-                    ]
-
-                    # Write the updated contents back to the file
-                    with open(grub_file_path, "w") as file:
-                        file.writelines(updated_contents)
-
-                    # Calculate SHA256 checksum after changes
-                    sha256_after = calculate_sha256(grub_file_path)
-
-                    # Compare checksums
-                    if sha256_before != sha256_after:
-                        subprocess.run(
-                            ["/usr/sbin/grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"],
-                            capture_output=True,
-                            text=True,
-                        )
-
-        if len(remove_names) > 0:
-            PackageUpdater(remove_names, "remove", None)
-
-        if len(updatelist) > 0:
-            PackageUpdater(updatelist, "install", None)
-
-        # Also check if device is steamdeck, if so install jupiter packages
-        check_galileo = subprocess.run(
-            "dmesg | grep 'Galileo'", capture_output=True, text=True, shell=True
-        )
-        galileo_detected = check_galileo.returncode == 0
+@register_quirk
+class FalcondQuirk(Quirk):
+    name = "falcond"
+    description = "Install and enable falcond."
+    inputs = ("rpmdb",)
 
-        check_jupiter = subprocess.run(
-            "dmesg | grep 'Jupiter'", capture_output=True, text=True, shell=True
-        )
-        jupiter_detected = check_jupiter.returncode == 0
+    def detect(self, ctx):
+        return not ctx.is_installed("falcond")
 
-        if (galileo_detected or jupiter_detected):
-            steamdeck_install = []
-
-            jupiter_hw = "jupiter-hw-support"
-            check_jupiter_hw = subprocess.run(
-                ["rpm", "-q", jupiter_hw], capture_output=True, text=True
+    def apply(self, ctx, finding):
+        ctx.plan.add_install("falcond")
+        ctx.plan.add_post_commit(
+            lambda: subprocess.run(
+                ["systemctl", "enable", "--now", "falcond"],
+                capture_output=True,
+                text=True,
             )
-            jupiter_hw_installed = check_jupiter_hw.returncode != 0
-            if jupiter_hw_installed:
-                steamdeck_install.append(jupiter_hw)
+        )
 
-            jupiter_fan = "jupiter-fan-control"
-            check_jupiter_fan = subprocess.run(
-                ["rpm", "-q", jupiter_fan], capture_output=True, text=True
-            )
-            jupiter_fan_installed = check_jupiter_fan.returncode != 0
-            if jupiter_fan_installed:
-                steamdeck_install.append(jupiter_fan)
 
-            steamdeck_dsp = "steamdeck-dsp"
-            check_steamdeck_dsp = subprocess.run(
-                ["rpm", "-q", steamdeck_dsp], capture_output=True, text=True
-            )
-            steamdeck_dsp_installed = check_steamdeck_dsp.returncode != 0
-            if steamdeck_dsp_installed:
-                steamdeck_install.append(steamdeck_dsp)
-
-            steamdeck_firmware = "steamdeck-firmware"
-            check_steamdeck_firmware = subprocess.run(
-                ["rpm", "-q", steamdeck_firmware], capture_output=True, text=True
-            )
-            steamdeck_firmware_installed = check_steamdeck_firmware.returncode != 0
-            if steamdeck_firmware_installed:
-                steamdeck_install.append(steamdeck_firmware)
-
-            if len(steamdeck_install) > 0:
-                PackageUpdater(steamdeck_install, "install", None)
-
-        # QUIRK: Problematic package cleanup
-        self.logger.info("QUIRK: Problematic package cleanup.")
-        problematic = [
-            "qt5-qtwebengine-freeworld",
-            "qt6-qtwebengine-freeworld",
-            "qgnomeplatform-qt6",
-            "qgnomeplatform-qt5",
-            "okular5-libs",
-            "fedora-workstation-repositories",
-            "deckyloader"
-        ]
-        problematic_names = []
-        for package in problematic:
-            problematic_check = subprocess.run(
-                ["rpm", "-q", package], capture_output=True, text=True
-            )
-            if problematic_check.returncode == 0:
-                problematic_names.append(package)
-
-        if len(problematic_names) > 0:
-            self.logger.info("Found problematic packages, removing...")
-            PackageUpdater(problematic_names, "remove", None)
-
-        problematic_2025 = [
-            "plasma-workspace-geolocation",
-            "plasma-workspace-geolocation-libs",
-            "rubberband.i686",
-            "python3-torch-rocm-gfx9",
-            "python3-torchaudio-rocm-gfx9",
-            "tesseract.i686"
-        ]
-        for package in problematic_2025:
-            problematic_check_2025 = subprocess.run(
-                ["rpm", "-q", package], capture_output=True, text=True
-            )
-            if problematic_check_2025.returncode == 0:
-                if "rubberband" in package:
-                    libs32_check = subprocess.run(["rpm", "-q", package], capture_output=True, text=True)
-                    if libs32_check.returncode == 0:
-                        subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True)
-                        subprocess.run(["dnf", "install", "-y", "rubberband-libs.x86_64", "--refresh"], capture_output=True, text=True)
-                        subprocess.run(["dnf", "install", "-y", "rubberband-libs.i686", "--refresh"], capture_output=True, text=True)
-                elif "tesseract" in package:
-                    libs32_check = subprocess.run(["rpm", "-q", package], capture_output=True, text=True)
-                    if libs32_check.returncode == 0:
-                        subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True)
-                        subprocess.run(["dnf", "install", "-y", "tesseract-libs.x86_64", "--refresh"], capture_output=True, text=True)
-                        subprocess.run(["dnf", "install", "-y", "tesseract-libs.i686", "--refresh"], capture_output=True, text=True)
-                else:
-                    subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True)
-
-        # QUIRK: Clear plasmashell cache if a plasma-workspace update is available
-        self.logger.info("QUIRK: Clear plasmashell cache if a plasma-workspace update is available.")
-        # Function to run the rpm command and get the output
-        def check_update():
-            try:
-                # Run the dnf check-update command and filter for plasma-workspace
-                result = subprocess.run(['dnf', 'check-update'], capture_output=True, text=True, check=False)
-                # Use Python's string filtering instead of piping in the shell
-                if result.returncode in [0, 100]:
-                    if 'plasma-workspace' in result.stdout:
-                        return True
-                    return False
-                self.logger.error(f"DNF error (code {result.returncode}): {result.stderr}")
-                return False
-                
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to run dnf command: {e}")
-                return False
-
-        # Function to get the list of all user home directories
-        def get_all_user_home_directories():
-            home_directories = []
-            for user in pwd.getpwall():
-                if user.pw_uid >= 1000:  # Filter out system users
-                    home_directories.append(user.pw_dir)
-            return home_directories
-
-        # Function to check and delete qmlcache folder if older than install date
-        def delete_qmlcache(home_dir):
-            qmlcache_dir = os.path.join(home_dir, ".cache", "plasmashell", "qmlcache")
+@register_quirk
+class GamescopeBootThemeQuirk(Quirk):
+    name = "gamescope-boot-theme"
+    description = "Match plymouth and grub to the installed gamescope session packages."
+    inputs = ("rpmdb", "/etc/plymouth/plymouthd.conf")
+
+    def detect(self, ctx):
+        htpc = ctx.is_installed("gamescope-htpc-common")
+        session_common = ctx.is_installed("gamescope-session-common")
+        if not (htpc or session_common):
+            return None
+        # Only the full gamescope session gets the steamos-like boot
+        want_steamos = htpc and session_common
+        script_missing = not ctx.is_installed("plymouth-plugin-script")
+        theme_is_steamos = "steamos" in current_plymouth_theme()
+        if script_missing or theme_is_steamos != want_steamos:
+            return {"steamos": want_steamos, "script_missing": script_missing}
+        return None
+
+    def apply(self, ctx, finding):
+        if finding["script_missing"]:
+            PackageUpdater(["plymouth-plugin-script"], "install", None)
+        if ("steamos" in current_plymouth_theme()) != finding["steamos"]:
+            set_boot_theme(finding["steamos"])
+
+
+@register_quirk
+class SteamDeckQuirk(Quirk):
+    name = "steamdeck"
+    description = "Install steam firmware and support packages for steamdecks."
+    inputs = ("rpmdb", "boot")
+    packages = [
+        "jupiter-hw-support",
+        "jupiter-fan-control",
+        "steamdeck-dsp",
+        "steamdeck-firmware",
+    ]
+
+    def detect(self, ctx):
+        missing = ctx.installed.missing_of(self.packages)
+        if missing and (dmesg_contains("Galileo") or dmesg_contains("Jupiter")):
+            return missing
+        return []
+
+    def apply(self, ctx, finding):
+        ctx.plan.add_install(finding)
+
+
+@register_quirk
+class ProblematicPackagesQuirk(Quirk):
+    name = "problematic-packages"
+    description = "Problematic package cleanup."
+    inputs = ("rpmdb",)
+    packages = [
+        "qt5-qtwebengine-freeworld",
+        "qt6-qtwebengine-freeworld",
+        "qgnomeplatform-qt6",
+        "qgnomeplatform-qt5",
+        "okular5-libs",
+        "fedora-workstation-repositories",
+        "deckyloader"
+    ]
+
+    def detect(self, ctx):
+        return ctx.installed.installed_of(self.packages)
+
+    def apply(self, ctx, finding):
+        ctx.logger.info("Found problematic packages, removing...")
+        ctx.plan.add_remove(finding)
+
+
+@register_quirk
+class Problematic2025Quirk(Quirk):
+    name = "problematic-packages-2025"
+    description = "Problematic package cleanup (2025)."
+    inputs = ("rpmdb",)
+    after = ("problematic-packages",)
+    packages = [
+        "plasma-workspace-geolocation",
+        "plasma-workspace-geolocation-libs",
+        "rubberband.i686",
+        "python3-torch-rocm-gfx9",
+        "python3-torchaudio-rocm-gfx9",
+        "tesseract.i686"
+    ]
+
+    def detect(self, ctx):
+        return ctx.installed.installed_of(self.packages)
+
+    def apply(self, ctx, finding):
+        for package in finding:
+            subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True)
+            for lib in ("rubberband", "tesseract"):
+                if lib in package:
+                    subprocess.run(["dnf", "install", "-y", f"{lib}-libs.x86_64", "--refresh"], capture_output=True, text=True)
+                    subprocess.run(["dnf", "install", "-y", f"{lib}-libs.i686", "--refresh"], capture_output=True, text=True)
+
+
+@register_quirk
+class PlasmashellCacheQuirk(Quirk):
+    name = "plasmashell-cache"
+    description = "Clear plasmashell cache if a plasma-workspace update is available."
+    inputs = ("updates",)
+
+    def detect(self, ctx):
+        return any("plasma-workspace" in pkg for pkg in ctx.package_names)
+
+    def apply(self, ctx, finding):
+        for user in pwd.getpwall():
+            if user.pw_uid < 1000:  # Filter out system users
+                continue
+            qmlcache_dir = os.path.join(user.pw_dir, ".cache", "plasmashell", "qmlcache")
             if os.path.exists(qmlcache_dir):
                 try:
                     shutil.rmtree(qmlcache_dir)
                     print(f"Deleted '{qmlcache_dir}' directory successfully")
-                except Exception as e:
+                except Exception:
                     pass
-            else:
-                pass
-
-        # Main script execution
-        if check_update():
-            for home_dir in get_all_user_home_directories():
-                delete_qmlcache(home_dir)
 
-        # QUIRK: Fix Nvidia epoch so it matches that of negativo17 for cross compatibility
-        self.logger.info("QUIRK: Fix Nvidia epoch so it matches that of negativo17 for cross compatibility.")
-        self.logger.info("QUIRK: Also swap akmod-nvidia for dkms-nvidia.")
 
-        # Run the dnf list installed command and capture the output
-        check_nvidia_wrong_epoch = subprocess.run(
-            ["dnf", "list", "--installed"], capture_output=True, text=True
-        )
+@register_quirk
+class NvidiaEpochQuirk(Quirk):
+    name = "nvidia-epoch"
+    description = "Fix Nvidia epoch so it matches that of negativo17 for cross compatibility, swap akmod-nvidia for dkms-nvidia."
+    inputs = ("rpmdb",)
+    kernel_conf_path = "/etc/nvidia/kernel.conf"
+    packages = [
+        "dkms-nvidia",
+        "nvidia-driver",
+        "libnvidia-ml",
+        "libnvidia-ml.i686",
+        "libnvidia-fbc",
+        "nvidia-driver-cuda",
+        "nvidia-driver-cuda-libs",
+        "nvidia-driver-cuda-libs.i686",
+        "nvidia-driver-libs",
+        "nvidia-driver-libs.i686",
+        "nvidia-kmod-common",
+        "nvidia-libXNVCtrl",
+        "nvidia-modprobe",
+        "nvidia-persistenced",
+        "nvidia-settings",
+        "nvidia-xconfig",
+        "libva-nvidia-driver",
+        "nvidia-gpu-firmware",
+        "libnvidia-cfg"
+    ]
+
+    def detect(self, ctx):
+        nvidia_wrong_epoch = bool(ctx.installed.query(name="*nvidia*", epoch=4))
+        nvidia_akmod = bool(ctx.installed.query(name="*akmod-nvidia*"))
+        return nvidia_wrong_epoch or nvidia_akmod
+
+    def apply(self, ctx, finding):
+        prior_variant = "unknown"   # "open" / "closed" / "unknown"
+        try:
+            with open(self.kernel_conf_path, "r", encoding="utf-8", errors="ignore") as f:
+                contents = f.read()
+            if "MODULE_VARIANT=kernel-open" in contents:
+                prior_variant = "open"
+            elif "MODULE_VARIANT=kernel" in contents:
+                prior_variant = "closed"
+        except OSError:
+            prior_variant = "unknown"
+
+        packages = list(self.packages)
+        if ctx.is_installed("chromium"):
+            packages.append("chromium")
+
+        # Remove old
+        remove_proc = subprocess.run(["dnf", "remove", "-y", "*nvidia*"], capture_output=True, text=True)
+        if remove_proc.returncode != 0:
+            ctx.logger.warning("dnf remove *nvidia* failed: %s", remove_proc.stderr.strip())
+
+        for path in glob.glob("/var/lib/dkms/nvidia*"):
+            subprocess.run(["rm", "-rf", path], check=False)
+
+        # Add new, capture returncode so we can gate post steps
+        install_proc = subprocess.run(["dnf", "install", "-y"] + packages + ["--refresh"])
+        if install_proc.returncode != 0:
+            ctx.logger.warning("dnf install nvidia stack failed with rc=%s", install_proc.returncode)
+            return
+
+        conf = "options nvidia-drm modeset=1 fbdev=1\n"
+        # --- Convert to closed if previous was closed ---
+        if prior_variant == "closed":
+            conf += "options nvidia NVreg_EnableGpuFirmware=0\n"
+            if os.path.exists(self.kernel_conf_path):
+                subprocess.run(["sed", "-i", "-e", "s/kernel-open$/kernel/g", self.kernel_conf_path], check=False)
+            subprocess.run(["dkms", "autoinstall"], check=False)
+
+        subprocess.run(["tee", "/etc/modprobe.d/nvidia-modeset.conf"],
+                       input=conf, text=True, check=False)
+
+        subprocess.run(["chmod", "644", "/etc/modprobe.d/nvidia-modeset.conf"], check=False)
+
+        ctx.perform_kernel_actions = 1
+        ctx.perform_reboot_request = 1
+
+
+@register_quirk
+class MesaN41Quirk(Quirk):
+    name = "mesa-n41"
+    description = "Update old N41 mesa packages to current versions."
+    inputs = ("rpmdb",)
+    to_install = [
+        "mesa-compat-libOSMesa.x86_64",
+        "mesa-dri-drivers.i686",
+        "mesa-dri-drivers.x86_64",
+        "mesa-filesystem.i686",
+        "mesa-filesystem.x86_64",
+        "mesa-libEGL.i686",
+        "mesa-libEGL.x86_64",
+        "mesa-libGL.i686",
+        "mesa-libGL.x86_64",
+        "mesa-libGLU.i686",
+        "mesa-libGLU.x86_64",
+        "mesa-libOpenCL.x86_64",
+        "mesa-libgallium.i686",
+        "mesa-libgallium.x86_64",
+        "mesa-libgbm.i686",
+        "mesa-libgbm.x86_64",
+        "mesa-libxatracker.x86_64",
+        "mesa-va-drivers.i686",
+        "mesa-va-drivers.x86_64",
+        "mesa-vulkan-drivers.i686",
+        "mesa-vulkan-drivers.x86_64",
+    ]
+
+    def detect(self, ctx):
+        return [pkg.name_arch for pkg in ctx.installed.query(name="*mesa*", release="fc41")]
+
+    def apply(self, ctx, finding):
+        # Remove all of them at once, then install the current ones
+        subprocess.run(["rpm", "-e", "--nodeps"] + finding)
+        subprocess.run(["dnf", "install", "-y"] + self.to_install)
+
+
+@register_quirk
+class RocmSwapQuirk(Quirk):
+    name = "rocm-swap"
+    description = "Swap old AMD ROCm packages with upstream Fedora ROCm versions."
+    inputs = ("rpmdb",)
+    old_rocm_removal = [
+        "comgr.x86_64",
+        "hip-devel.x86_64",
+        "hip-runtime-amd.x86_64",
+        "hipcc.x86_64",
+        "hsa-rocr.x86_64",
+        "hsa-rocr-devel.x86_64",
+        "hsakmt-roct-devel.x86_64",
+        "openmp-extras-runtime.x86_64",
+        "rocm-core.x86_64",
+        "rocm-device-libs.x86_64",
+        "rocm-hip-runtime.x86_64",
+        "rocm-language-runtime.x86_64",
+        "rocm-llvm.x86_64",
+        "rocm-opencl.x86_64",
+        "rocm-opencl-icd-loader.x86_64",
+        "rocm-opencl-runtime.x86_64",
+        "rocm-smi-lib.x86_64",
+        "rocminfo.x86_64",
+        "rocprofiler-register.x86_64",
+        "rocm-meta",
+    ]
+
+    def detect(self, ctx):
+        return bool(ctx.installed.query(from_repo="nobara-rocm-official"))
+
+    def apply(self, ctx, finding):
+        try:
+            PackageUpdater(self.old_rocm_removal, "remove", None)
+            # Now reinstall new rocm-meta
+            PackageUpdater(["rocm-meta"], "install", None)
+        except Exception as e:
+            print(f"An error occurred: {e}")
 
-        # Check if the command was successful
-        if check_nvidia_wrong_epoch.returncode == 0:
-            # Filter the output for lines containing 'nvidia' and '4:'
-            output_lines = check_nvidia_wrong_epoch.stdout.splitlines()
-            nvidia_wrong_epoch = any("nvidia" in line and "4:" in line for line in output_lines)
-            nvidia_akmod = any("akmod-nvidia" in line for line in output_lines)
-            chromium = any(line.startswith("chromium.") or line.startswith("chromium ") for line in output_lines)
-            kernel_conf_path = "/etc/nvidia/kernel.conf"
-            prior_variant = "unknown"   # "open" / "closed" / "unknown"
-
-            # Proceed if nvidia_wrong_epoch or nvidia_akmod is True
-            if nvidia_wrong_epoch or nvidia_akmod:
-                try:
-                    with open(kernel_conf_path, "r", encoding="utf-8", errors="ignore") as f:
-                        contents = f.read()
-                    if "MODULE_VARIANT=kernel-open" in contents:
-                        prior_variant = "open"
-                    elif "MODULE_VARIANT=kernel" in contents:
-                        prior_variant = "closed"
-                except OSError:
-                    prior_variant = "unknown"
-
-                # Remove old
-                remove_proc = subprocess.run(["dnf", "remove", "-y", "*nvidia*"], capture_output=True, text=True)
-                if remove_proc.returncode != 0:
-                    self.logger.warning("dnf remove *nvidia* failed: %s", remove_proc.stderr.strip())
-
-                for path in glob.glob("/var/lib/dkms/nvidia*"):
-                    subprocess.run(["rm", "-rf", path], check=False)
-
-                # Add new
-                packages = [
-                    "dkms-nvidia",
-                    "nvidia-driver",
-                    "libnvidia-ml",
-                    "libnvidia-ml.i686",
-                    "libnvidia-fbc",
-                    "nvidia-driver-cuda",
-                    "nvidia-driver-cuda-libs",
-                    "nvidia-driver-cuda-libs.i686",
-                    "nvidia-driver-libs",
-                    "nvidia-driver-libs.i686",
-                    "nvidia-kmod-common",
-                    "nvidia-libXNVCtrl",
-                    "nvidia-modprobe",
-                    "nvidia-persistenced",
-                    "nvidia-settings",
-                    "nvidia-xconfig",
-                    "libva-nvidia-driver",
-                    "nvidia-gpu-firmware",
-                    "libnvidia-cfg"
-                ]
-
-                if chromium:
-                    packages.append("chromium")
-
-                # Add the '--refresh' option at the end
-                command = ["dnf", "install", "-y"] + packages + ["--refresh"]
-
-                # Run the command (capture returncode so we can gate post steps)
-                install_proc = subprocess.run(command)
-
-                conf = "options nvidia-drm modeset=1 fbdev=1\n"
-
-                ok = (install_proc.returncode == 0)
-                # --- Convert to closed if previous was closed ---
-                if ok:
-                    if prior_variant == "closed":
-                        conf += "options nvidia NVreg_EnableGpuFirmware=0\n"
-                        if os.path.exists(kernel_conf_path):
-                            subprocess.run(["sed", "-i", "-e", "s/kernel-open$/kernel/g", kernel_conf_path], check=False)
-                        subprocess.run(["dkms", "autoinstall"], check=False)
-
-                    subprocess.run(["tee", "/etc/modprobe.d/nvidia-modeset.conf"],
-                                input=conf, text=True, check=False)
-
-                    subprocess.run(["chmod", "644", "/etc/modprobe.d/nvidia-modeset.conf"], check=False)
-
-                    perform_kernel_actions = 1
-                    perform_reboot_request = 1
-                else:
-                    self.logger.warning("dnf install nvidia stack failed with rc=%s", install_proc.returncode)
-
-        # QUIRK: Post N41 mesa update
-        self.logger.info("QUIRK: Update old N41 mesa packages to current versions.")
-
-        # Run the first command and capture the output
-        cmd = "dnf list --installed | grep mesa | grep fc41 | cut -d ' ' -f 1"
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
-        # Split output into a list of package names
-        packages = result.stdout.strip().split("\n")
-
-        # Run rpm -e --nodeps with all packages at once
-        if packages and packages != ['']:
-            rpm_cmd = ["rpm", "-e", "--nodeps"] + packages
-            subprocess.run(rpm_cmd)
-
-            # Step 2: Install required mesa packages
-            to_install = [
-                "mesa-compat-libOSMesa.x86_64",
-                "mesa-dri-drivers.i686",
-                "mesa-dri-drivers.x86_64",
-                "mesa-filesystem.i686",
-                "mesa-filesystem.x86_64",
-                "mesa-libEGL.i686",
-                "mesa-libEGL.x86_64",
-                "mesa-libGL.i686",
-                "mesa-libGL.x86_64",
-                "mesa-libGLU.i686",
-                "mesa-libGLU.x86_64",
-                "mesa-libOpenCL.x86_64",
-                "mesa-libgallium.i686",
-                "mesa-libgallium.x86_64",
-                "mesa-libgbm.i686",
-                "mesa-libgbm.x86_64",
-                "mesa-libxatracker.x86_64",
-                "mesa-va-drivers.i686",
-                "mesa-va-drivers.x86_64",
-                "mesa-vulkan-drivers.i686",
-                "mesa-vulkan-drivers.x86_64",
-            ]
 
-            dnf_cmd = ["dnf", "install", "-y"] + to_install
-            subprocess.run(dnf_cmd)
+@register_quirk
+class MesaVulkanDriversQuirk(Quirk):
+    name = "mesa-vulkan-drivers"
+    description = "mesa-vulkan-drivers fixup."
+    inputs = ("rpmdb",)
+    after = ("mesa-n41",)
 
-        # QUIRK: Swap old AMD ROCm packages with upstream Fedora ROCm versions.
-        self.logger.info("QUIRK: Swap old AMD ROCm packages with upstream Fedora ROCm versions.")
+    def detect(self, ctx):
+        return not ctx.installed.query(name="*mesa-vulkan-drivers*")
 
+    def apply(self, ctx, finding):
         try:
-            result = subprocess.run(
-                "dnf list --installed | grep @nobara-rocm-official",
-                shell=True,
-                capture_output=True,
-                text=True
+            subprocess.run(
+                ["dnf", "install", "-y", "mesa-vulkan-drivers.x86_64", "mesa-vulkan-drivers.i686"], capture_output=True, text=True
             )
-
-            # Check if there is any output
-            if result.stdout.strip():
-                # Remove old ROCm packages
-                old_rocm_removal = [
-                    "comgr.x86_64",
-                    "hip-devel.x86_64",
-                    "hip-runtime-amd.x86_64",
-                    "hipcc.x86_64",
-                    "hsa-rocr.x86_64",
-                    "hsa-rocr-devel.x86_64",
-                    "hsakmt-roct-devel.x86_64",
-                    "openmp-extras-runtime.x86_64",
-                    "rocm-core.x86_64",
-                    "rocm-device-libs.x86_64",
-                    "rocm-hip-runtime.x86_64",
-                    "rocm-language-runtime.x86_64",
-                    "rocm-llvm.x86_64",
-                    "rocm-opencl.x86_64",
-                    "rocm-opencl-icd-loader.x86_64",
-                    "rocm-opencl-runtime.x86_64",
-                    "rocm-smi-lib.x86_64",
-                    "rocminfo.x86_64",
-                    "rocprofiler-register.x86_64",
-                    "rocm-meta",
-                ]
-                PackageUpdater(old_rocm_removal, "remove", None)
-                # Now reinstall new rocm-meta
-                PackageUpdater(["rocm-meta"], "install", None)
-
         except Exception as e:
             print(f"An error occurred: {e}")
 
-        # QUIRK: mesa-vulkan-drivers fixup
-        self.logger.info("QUIRK: mesa-vulkan-drivers fixup.")
-        try:
-            result = subprocess.run(
-                "rpm -qa | grep mesa-vulkan-drivers",
-                shell=True,
-                capture_output=True,
-                text=True
+
+@register_quirk
+class VaapiQuirk(Quirk):
+    name = "vaapi"
+    description = "vaapi fixup."
+    inputs = ("rpmdb",)
+    after = ("mesa-n41",)
+    mixed_packages = [
+        "mesa-libgallium.x86_64",
+        "mesa-libgallium.i686",
+        "mesa-libgallium-freeworld.x86_64",
+        "mesa-libgallium-freeworld.i686",
+        "mesa-va-drivers.x86_64",
+        "mesa-va-drivers.i686",
+        "mesa-va-drivers-freeworld.x86_64",
+        "mesa-va-drivers-freeworld.i686",
+    ]
+
+    def detect(self, ctx):
+        freeworld = [
+            ctx.is_installed("mesa-libgallium-freeworld.x86_64"),
+            ctx.is_installed("mesa-libgallium-freeworld.i686"),
+        ]
+        standard = [
+            ctx.is_installed("mesa-libgallium.x86_64"),
+            ctx.is_installed("mesa-libgallium.i686"),
+        ]
+        # they should all either end in -freeworld or not, no mixing.
+        if all(freeworld) or all(standard):
+            return None
+        # Nothing installed at all gets freeworld, a mix is corrected to standard
+        if not any(freeworld + standard):
+            return "mesa-libgallium-freeworld"
+        return "mesa-libgallium"
+
+    def apply(self, ctx, finding):
+        for package in self.mixed_packages:
+            subprocess.run(
+                ["rpm", "-e", "--nodeps", package], capture_output=True, text=True
             )
+        subprocess.run(
+            ["dnf", "install", "-y", f"{finding}.x86_64", f"{finding}.i686", "--refresh"],
+            capture_output=True, text=True
+        )
 
-            # Check if there is any output
-            if result.returncode !=0:
-                self.logger.info("mesa-vulkan-drivers fixup.")
-                subprocess.run(
-                    ["dnf", "install", "-y", "mesa-vulkan-drivers.x86_64", "mesa-vulkan-drivers.i686"], capture_output=True, text=True
-                )
-        except Exception as e:
-            print(f"An error occurred: {e}")
 
-        # QUIRK: vaapi fixup
-        self.logger.info("QUIRK: vaapi fixup.")
-        mesa_fixup_check = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True
-        )
-        mesa_fixup_check1 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True
-        )
+@register_quirk
+class KernelFsyncQuirk(Quirk):
+    name = "kernel-fsync"
+    description = "Kernel fsync->nobara conversion update."
+    inputs = ("kernel",)
+    target_version = "6.12.11-204.nobara.fc41.x86_64"
 
-        mesa_fixup_check2 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium.x86_64"], capture_output=True, text=True
-        )
-        mesa_fixup_check3 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium.i686"], capture_output=True, text=True
-        )
-        # they should all either end in -freeworld or not, no mixing.
-        if not (
-            mesa_fixup_check.returncode == 0
-            and mesa_fixup_check1.returncode == 0
+    def detect(self, ctx):
+        version_output = os.uname().release
+        if "fsync" in version_output or (
+            "nobara" in version_output and version_output < self.target_version
         ):
-            # If all of them are not freeworld, check if they are all standard:
-            if not (
-                mesa_fixup_check2.returncode == 0
-                and mesa_fixup_check3.returncode == 0
-            ):
-
-                # looks like we have a mix of both, let's check if -any- of them are freeworld:
-                if not (
-                    # If at least one of them is freeworld, correct all to freeworld
-                    mesa_fixup_check.returncode == 0
-                    or mesa_fixup_check1.returncode == 0
-                    or mesa_fixup_check2.returncode == 0
-                    or mesa_fixup_check3.returncode == 0
-                ):
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["dnf", "install", "-y", "mesa-libgallium-freeworld.x86_64", "mesa-libgallium-freeworld.i686", "--refresh"],
-                        capture_output=True, text=True
-                    )
-                # Otherwise correct to original
-                else:
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.x86_64"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.i686"], capture_output=True, text=True
-                    )
-                    subprocess.run(
-                        ["dnf", "install", "-y", "mesa-libgallium.x86_64", "mesa-libgallium.i686", "--refresh"],
-                        capture_output=True, text=True
-                    )
+            return version_output
+        return None
 
-        # QUIRK: Kernel 6.12.9 fixup
-        self.logger.info("QUIRK: Kernel fsync->nobara conversion update.")
+    def apply(self, ctx, finding):
         try:
-            # Get the full kernel version
-            full_version = subprocess.run(['uname', '-r'], capture_output=True, text=True, check=True)
-
-            # Access the captured output
-            version_output = full_version.stdout.strip()
-
-            if "fsync" in version_output:
+            if "fsync" in finding:
                 subprocess.run(['dnf', 'remove', 'kernel-uki-virt*', '-y'], capture_output=True, text=True, check=True)
                 subprocess.run(['dnf', 'update', 'kernel', '-y'], capture_output=True, text=True, check=True)
                 subprocess.run(['dnf', 'update', 'kernel-devel', '-y'], capture_output=True, text=True, check=True)
-                perform_kernel_actions = 1
-                perform_reboot_request = 1
-
-            target_version = "6.12.11-204.nobara.fc41.x86_64"
-            if "nobara" in version_output:
-                if version_output < target_version:
-                    checkpending = subprocess.run(['rpm', '-q', f'kernel-{target_version}'], capture_output=True, text=True, check=True)
-                    checkpending_output = checkpending.stdout.strip()
-                    if "not installed" in checkpending_output:
-                        try:
-                            subprocess.run(['dnf', 'install', "-y", f'kernel-{target_version}'], check=True)
-                            subprocess.run(['dnf', 'install', "-y", f'kernel-devel-{target_version}'], check=True)
-                            perform_kernel_actions = 1
-                            perform_reboot_request = 1
-                        except subprocess.CalledProcessError as e:
-                            self.logger.info(f"Error installing new kernel: {e}")
+                ctx.perform_kernel_actions = 1
+                ctx.perform_reboot_request = 1
+
+            if "nobara" in finding and finding < self.target_version:
+                checkpending = subprocess.run(['rpm', '-q', f'kernel-{self.target_version}'], capture_output=True, text=True, check=True)
+                checkpending_output = checkpending.stdout.strip()
+                if "not installed" in checkpending_output:
+                    try:
+                        subprocess.run(['dnf', 'install', "-y", f'kernel-{self.target_version}'], check=True)
+                        subprocess.run(['dnf', 'install', "-y", f'kernel-devel-{self.target_version}'], check=True)
+                        ctx.perform_kernel_actions = 1
+                        ctx.perform_reboot_request = 1
+                    except subprocess.CalledProcessError as e:
+                        ctx.logger.info(f"Error installing new kernel: {e}")
 
         except subprocess.CalledProcessError as e:
-            self.logger.info(f"An error occurred: {e}")
+            ctx.logger.info(f"An error occurred: {e}")
+
+
+@register_quirk
+class MediaFixupQuirk(Quirk):
+    name = "media-fixup"
+    description = "Media fixup."
+    inputs = ("rpmdb", "/etc/yum.repos.d", "/etc/dnf")
+    after = ("mesa-vulkan-drivers", "vaapi")
+    repo_name = "nobara-pikaos-additional"
+
+    # These must be installed; if any is missing -> media_fixup = 1
+    must_be_installed = [
+        "x264-libs.x86_64",
+        "x264-libs.i686",
+        "x265-libs.x86_64",
+        "x265-libs.i686",
+        "libavcodec-freeworld.x86_64",
+        "libavcodec-freeworld.i686",
+        "libavcodec-free.x86_64",
+        "libavcodec-free.i686",
+        "openh264.x86_64",
+        "openh264.i686",
+        "mesa-libgallium-freeworld.x86_64",
+        "mesa-libgallium-freeworld.i686",
+        "gstreamer1-plugins-bad-free-extras.x86_64",
+        "gstreamer1-plugins-bad-free-extras.i686",
+        "mozilla-openh264.x86_64",
+        "libheif-freeworld.x86_64",
+        "libheif-freeworld.i686",
+        "libheif.x86_64",
+        "libheif.i686",
+        "pipewire-codec-aptx",
+    ]
+
+    must_not_be_installed = [
+        "ffmpeg-libs.x86_64",
+        "ffmpeg-libs.i686",
+        "x264.x86_64",
+        "x265.x86_64",
+        "noopenh264.x86_64",
+        "noopenh264.i686",
+        "mesa-libgallium.x86_64",
+        "mesa-libgallium.i686",
+        "mesa-vulkan-drivers.x86_64",
+        "mesa-vulkan-drivers.i686",
+        "mesa-vulkan-drivers-git.x86_64",
+        "mesa-vulkan-drivers-git.i686",
+    ]
+
+    def repo_enabled(self) -> bool:
+        try:
+            # Run `dnf -q repolist --enabled`
+            dnfoverride = subprocess.run(
+                ["dnf", "-q", "repolist", "--enabled"],
+                capture_output=True,
+                text=True,
+                check=True
+            )
+        except subprocess.CalledProcessError:
+            return False
+        # Extract repo IDs (skip the first line like `awk 'NR>1 {print $1}'`)
+        repos = [line.split()[0] for line in dnfoverride.stdout.strip().splitlines()[1:]]
+        return self.repo_name in repos
 
-        # QUIRK 18: Media fixup
-        media_fixup = 0
+    def detect(self, ctx):
+        if not self.repo_enabled():
+            # Any freeworld package without the repo providing it
+            return bool(ctx.installed.query(name="*freeworld*"))
 
-        def repo_enabled(repo_name="nobara-pikaos-additional"):
-            try:
-                # Run `dnf -q repolist --enabled`
-                dnfoverride = subprocess.run(
-                    ["dnf", "-q", "repolist", "--enabled"],
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
+        # 1) Anything that must be installed but isn’t -> fixup
+        for pkg in self.must_be_installed:
+            if not ctx.is_installed(pkg):
+                ctx.logger.info(f"Found missing media package: {pkg}")
+                return True
 
-                # Extract repo IDs (skip the first line like `awk 'NR>1 {print $1}'`)
-                repos = [line.split()[0] for line in dnfoverride.stdout.strip().splitlines()[1:]]
+        # 2) If still clean: anything that must NOT be installed but is -> fixup
+        for pkg in self.must_not_be_installed:
+            if ctx.is_installed(pkg):
+                ctx.logger.info(f"Found incorrect media package: {pkg}")
+                return True
 
-                # Check if repo_name exists in list
-                if repo_name in repos:
-                    return True
-            except subprocess.CalledProcessError:
-                return False
+        return False
 
-        def repo_file_broken():
-            try:
-                dnffile = subprocess.run(
-                    ["grep", "enabled=1", "/etc/yum.repos.d/nobara-pikaos-additional.repo"],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
-                if repo_enabled() and 'enabled=1' not in dnffile.stdout:
-                    media_fixup = 1
-            except subprocess.CalledProcessError:
-                return False
+    def apply(self, ctx, finding):
+        # The repair itself is offered to the user by the caller
+        ctx.media_fixup = 1
 
-        def broken_codecs():
-            if not repo_enabled():
-                try:
-                    # Run the rpm command and capture output
-                    result = subprocess.run(
-                        ["rpm", "-qa"],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        check=True
-                    )
-                    # Look for "freeworld" in the output
-                    if "freeworld" in result.stdout:
-                        return True
-                except subprocess.CalledProcessError as e:
-                    # Handle rpm command failure
-                    print(f"Error checking rpm packages: {e}")
-            return False
 
-        if broken_codecs():
-            media_fixup = 1
-
-        if repo_enabled() and media_fixup == 0:
-            self.logger.info("QUIRK: Media fixup.")
-            def rpm_installed(name: str) -> bool:
-                """Return True if rpm -q <name> reports installed."""
-                return subprocess.run(["rpm", "-q", name], capture_output=True).returncode == 0
-
-            # These must be installed; if any is missing -> media_fixup = 1
-            MUST_BE_INSTALLED = {
-                "x264-libs.x86_64",
-                "x264-libs.i686",
-                "x265-libs.x86_64",
-                "x265-libs.i686",
-                "libavcodec-freeworld.x86_64",
-                "libavcodec-freeworld.i686",
-                "libavcodec-free.x86_64",
-                "libavcodec-free.i686",
-                "openh264.x86_64",
-                "openh264.i686",
-                "mesa-libgallium-freeworld.x86_64",
-                "mesa-libgallium-freeworld.i686",
-                "gstreamer1-plugins-bad-free-extras.x86_64",
-                "gstreamer1-plugins-bad-free-extras.i686",
-                "mozilla-openh264.x86_64",
-                "libheif-freeworld.x86_64",
-                "libheif-freeworld.i686",
-                "libheif.x86_64",
-                "libheif.i686",
-                "pipewire-codec-aptx",
-            }
+# END QUIRKS LIST
 
-            MUST_NOT_BE_INSTALLED = {
-                "ffmpeg-libs.x86_64",
-                "ffmpeg-libs.i686",
-                "x264.x86_64",
-                "x265.x86_64",
-                "noopenh264.x86_64",
-                "noopenh264.i686",
-                "mesa-libgallium.x86_64",
-                "mesa-libgallium.i686",
-                "mesa-vulkan-drivers.x86_64",
-                "mesa-vulkan-drivers.i686",
-                "mesa-vulkan-drivers-git.x86_64",
-                "mesa-vulkan-drivers-git.i686",
-            }
 
-            media_fixup = 0
+class QuirkFixup:
+    def __init__(self, logger=None):
+        self.logger = logger if logger else logging.getLogger("nobara-updater.quirks")
+        # Package changes that don't need to happen immediately are collected
+        # here and committed as one transaction at the end of the quirk pass.
+        self.plan = TransactionPlan(self.logger)
+
+    def detect_quirks(self, quirks: list[Quirk], ctx: QuirkContext) -> dict[str, object]:
+        # detect() only reads, so all of them run at once over the same snapshot
+        if not quirks:
+            return {}
+        with ThreadPoolExecutor(
+            max_workers=min(DETECT_WORKERS, len(quirks)), thread_name_prefix="quirk-detect"
+        ) as pool:
+            futures = [(quirk, pool.submit(in_current_context(quirk.detect), ctx)) for quirk in quirks]
+            return {quirk.name: future.result() for quirk, future in futures}
+
+    def detect_changed(
+        self, quirks: list[Quirk], ctx: QuirkContext, clean: dict[str, str]
+    ) -> tuple[dict[str, object], dict[str, str | None]]:
+        # Skips the quirks whose inputs are unchanged since a pass where they found nothing
+        fingerprints = {quirk.name: ctx.fingerprint(quirk) for quirk in quirks}
+        changed = [
+            quirk
+            for quirk in quirks
+            if fingerprints[quirk.name] is None or clean.get(quirk.name) != fingerprints[quirk.name]
+        ]
+        findings: dict[str, object] = {quirk.name: None for quirk in quirks}
+        findings.update(self.detect_quirks(changed, ctx))
+        if len(changed) < len(quirks):
+            self.logger.debug(
+                "Skipped %d unchanged quirk checks", len(quirks) - len(changed)
+            )
+        return findings, fingerprints
 
-            # 1) Anything that must be installed but isn’t -> fixup
-            for pkg in MUST_BE_INSTALLED:
-                if not rpm_installed(pkg):
-                    self.logger.info(f"Found missing media package: {pkg}")
-                    media_fixup = 1
-                    break
+    def system_quirk_fixup(self):
+        ctx = QuirkContext(self, updatechecker())
+        clean = quirk_cache.load()
+        pending = ordered_quirks()
+        findings, fingerprints = self.detect_changed(pending, ctx, clean)
+
+        for index, quirk in enumerate(pending):
+            if ctx.refresh_snapshot():
+                # An earlier quirk changed the installed set right away, so
+                # what is left was detected against an outdated snapshot
+                remaining = self.detect_changed(pending[index:], ctx, clean)
+                findings.update(remaining[0])
+                fingerprints.update(remaining[1])
+
+            self.logger.info("QUIRK: %s", quirk.description, extra={"quirk": quirk.name, "action": "check"})
+            finding = findings[quirk.name]
+            if not finding:
+                continue
+            start = time.monotonic()
+            status = "failed"
+            try:
+                with self.plan.intent(quirk.name):
+                    quirk.apply(ctx, finding)
+                status = "ok"
+            finally:
+                duration = round(time.monotonic() - start, 3)
+                self.logger.info(
+                    "QUIRK: %s applied: %s (%.1fs)",
+                    quirk.name,
+                    status,
+                    duration,
+                    extra={"quirk": quirk.name, "action": "apply", "duration": duration, "status": status},
+                )
+            if ctx.stop:
+                return (
+                    0,
+                    0,
+                    0,
+                    ctx.perform_refresh,
+                )
 
-            # 2) If still clean: anything that must NOT be installed but is -> fixup
-            if media_fixup == 0:
-                for pkg in MUST_NOT_BE_INSTALLED:
-                    if rpm_installed(pkg):
-                        self.logger.info(f"Found incorrect media package: {pkg}")
-                        media_fixup = 1
-                        break
+        # Remember what had nothing to do. Package changes below move the
+        # rpmdb, so quirks depending on it are detected again next time.
+        quirk_cache.store(
+            {
+                quirk.name: fingerprints[quirk.name]
+                for quirk in pending
+                if not findings[quirk.name] and fingerprints[quirk.name] is not None
+            }
+        )
 
-        if media_fixup == 1:
-            # do fixup
-            pass
+        # One download stage for the quirk plan and the pending system
+        # updates, the system transaction after the fixups then installs
+        # from the package cache instead of downloading on its own
+        if not self.plan.is_empty() or ctx.package_names:
+            prefetch_packages(install=self.plan.install, upgrade=ctx.package_names)
 
+        # Commit the package changes collected by the quirks above in one transaction
+        try:
+            if not self.plan.commit():
+                self.logger.error("Some quirk package changes could not be applied, see the log above.")
+        except Exception as e:
+            self.logger.error("Failed to apply quirk package changes: %s", e)
 
-        # END QUIRKS LIST
         # Check if any packages contain "kernel" or "dkms"
         if "gamescope" in os.environ.get('XDG_CURRENT_DESKTOP', '').lower():
             gamescope_packages = [
-                pkg for pkg in package_names if "gamescope" in pkg
+                pkg for pkg in ctx.package_names if "gamescope" in pkg
             ]
             if gamescope_packages:
-                perform_reboot_request = 1
+                ctx.perform_reboot_request = 1
 
         # Remove newinstall needs-update tracker
         if Path.exists(Path("/etc/nobara/newinstall")):
@@ -1127,15 +1186,20 @@ class QuirkFixup:
                 # Remove the file
                 Path("/etc/nobara/newinstall").unlink()
             except OSError as e:
-                logger.error("Error: %s", e.strerror)
+                self.logger.error("Error: %s", e.strerror)
 
         return (
-            perform_kernel_actions,
-            perform_reboot_request,
-            media_fixup,
-            perform_refresh,
+            ctx.perform_kernel_actions,
+            ctx.perform_reboot_request,
+            ctx.media_fixup,
+            ctx.perform_refresh,
         )
 
+    def is_installed(self, spec: str) -> bool:
+        # Answered from the shared installed-package index, which is rebuilt
+        # whenever the rpmdb changed (including by the rpm/dnf calls above).
+        return installed_packages().is_installed(spec)
+
     def update_core_packages(
         self, package_list: list[str], action: str, log_message: str
     ) -> None:
@@ -1143,20 +1207,17 @@ class QuirkFixup:
 
         # Run the updater in a separate thread and wait for it to finish
         updater_thread = threading.Thread(
-            target=self.run_package_updater, args=(package_list, action)
+            target=in_current_context(self.run_package_updater), args=(package_list, action)
         )
         updater_thread.start()
         updater_thread.join()  # Wait for the updater thread to finish
 
-    def ensure_package_installed(self, package_name: str | list[str]) -> int:
+    def ensure_package_installed(self, package_name: str | list[str], defer: bool = False) -> int:
         package_names = [package_name] if isinstance(package_name, str) else package_name
         missing_packages = []
 
         for pkg in package_names:
-            result = subprocess.run(
-                ["rpm", "-q", pkg], capture_output=True, text=True
-            )
-            if result.returncode != 0:
+            if not self.is_installed(pkg):
                 missing_packages.append(pkg)
 
         if missing_packages:
@@ -1165,8 +1226,11 @@ class QuirkFixup:
                 "" if len(missing_packages) == 1 else "s",
                 ", ".join(missing_packages),
             )
+            if defer:
+                self.plan.add_install(missing_packages)
+                return 1
             updater_thread = threading.Thread(
-                target=self.run_package_updater, args=(missing_packages, "install")
+                target=in_current_context(self.run_package_updater), args=(missing_packages, "install")
             )
             updater_thread.start()
             updater_thread.join()
@@ -1174,21 +1238,21 @@ class QuirkFixup:
 
         return 0
 
-    def remove_installed_packages(self, package_names: list[str]) -> int:
+    def remove_installed_packages(self, package_names: list[str], defer: bool = False) -> int:
         installed_packages = []
         for packagename in package_names:
-            result = subprocess.run(
-                ["rpm", "-q", packagename], capture_output=True, text=True
-            )
-            if result.returncode == 0:
+            if self.is_installed(packagename):
                 installed_packages.append(packagename)
 
         if installed_packages:
             self.logger.info(
                 "Removing conflicting packages: %s\n", ", ".join(installed_packages)
             )
+            if defer:
+                self.plan.add_remove(installed_packages)
+                return 1
             updater_thread = threading.Thread(
-                target=self.run_package_updater, args=(installed_packages, "remove")
+                target=in_current_context(self.run_package_updater), args=(installed_packages, "remove")
             )
             updater_thread.start()
             updater_thread.join()
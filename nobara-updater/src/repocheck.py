@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Any, Callable
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36"
+# Per request timeout, same as the old sequential checks
+REQUEST_TIMEOUT = 5
+# Whole repository check gives up after this many seconds
+CHECK_DEADLINE = 30
+CHECK_WORKERS = 16
+# Simultaneous requests to one host, also the size of its keep-alive pool
+PER_HOST_LIMIT = 4
+# Mirrors of a repository probed at the same time
+MIRROR_FANOUT = 4
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class HostLimiter:
+    # Bounds the number of requests in flight per host, so a repo list that
+    # points everything at one mirror doesn't hammer it.
+    def __init__(self, limit: int = PER_HOST_LIMIT) -> None:
+        self.limit = limit
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+def make_session(per_host: int = PER_HOST_LIMIT) -> requests.Session:
+    # Connections are kept alive per host and reused across all checks
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=per_host, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+class RepoChecker:
+    # Runs repository checks concurrently against a shared deadline. Each
+    # check is a callable taking the checker and returning True if the repo
+    # is reachable.
+    def __init__(
+        self,
+        session: requests.Session | None = None,
+        deadline: float = CHECK_DEADLINE,
+        workers: int = CHECK_WORKERS,
+    ) -> None:
+        self.session = session if session else make_session()
+        self.limiter = HostLimiter()
+        self.workers = workers
+        self.deadline = time.monotonic() + deadline
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        slot = self.limiter.slot(url)
+        # Waiting for a free slot counts against the deadline as well
+        if not slot.acquire(timeout=max(self.remaining(), 0)):
+            raise DeadlineExceeded(url)
+        try:
+            remaining = self.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded(url)
+            return self.session.request(
+                method, url, timeout=min(REQUEST_TIMEOUT, remaining), **kwargs
+            )
+        finally:
+            slot.release()
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def run(
+        self,
+        checks: list[tuple[Any, Callable[["RepoChecker"], bool]]],
+        report: Callable[[Any, bool], None],
+    ) -> None:
+        # report(key, ok) is called for each check as soon as it finishes,
+        # checks still running at the deadline are reported as failed.
+        if not checks:
+            return
+        pool = ThreadPoolExecutor(max_workers=min(self.workers, len(checks)))
+        futures = {pool.submit(check, self): key for key, check in checks}
+        reported = set()
+        try:
+            for future in as_completed(futures, timeout=max(self.remaining(), 0)):
+                try:
+                    ok = bool(future.result())
+                except Exception as e:
+                    logger.debug("Repository check for %s failed: %s", futures[future], e)
+                    ok = False
+                reported.add(future)
+                report(futures[future], ok)
+        except FuturesTimeoutError:
+            for future, key in futures.items():
+                if future not in reported:
+                    logger.debug("Repository check for %s hit the deadline", key)
+                    report(key, False)
+        finally:
+            # Don't wait for requests stuck past the deadline
+            pool.shutdown(wait=False, cancel_futures=True)
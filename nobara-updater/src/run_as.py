@@ -1,64 +1,279 @@
+import atexit
 import json
 import logging
-import multiprocessing
 import os
 import pwd
+import socket
+import struct
 import sys
 import subprocess
+import threading
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 SCRIPT_FILE = __file__
 
+# Frames are a 4 byte big-endian length followed by that many bytes of JSON
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Progress of one ref is logged in steps of this many percent
+PROGRESS_LOG_STEP = 25
+
+
+def write_frame(sock: socket.socket, message: dict[str, Any]) -> None:
+    payload = json.dumps(message).encode()
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def _read_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("user worker connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def read_frame(sock: socket.socket) -> dict[str, Any]:
+    (size,) = FRAME_HEADER.unpack(_read_exact(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"user worker frame too large: {size} bytes")
+    return json.loads(_read_exact(sock, size))
+
+
+def target_script() -> Path:
+    # run_as_user_target.py lives next to this file
+    return Path(SCRIPT_FILE).resolve().parent / "run_as_user_target.py"
+
+
+class UserWorker:
+    # A process that drops to one user's privileges once and then serves
+    # every run_as_user call for that user over a socketpair, instead of
+    # starting a new interpreter with its GI imports per call.
+    def __init__(self, uid: int, gid: int) -> None:
+        self.uid = uid
+        self.gid = gid
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(
+                [
+                    sys.executable,
+                    target_script(),
+                    "--serve",
+                    str(uid),
+                    str(gid),
+                    str(child_sock.fileno()),
+                ],
+                pass_fds=(child_sock.fileno(),),
+                stdout=subprocess.DEVNULL,
+            )
+        except Exception:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self.sock = parent_sock
+        # One call at a time, replies come back in request order
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def call(
+        self,
+        func_name: str,
+        option: str = "",
+        args: tuple[Any, ...] = (),
+        on_event: Callable[[dict[str, Any]], None] | None = None,
+    ) -> dict[str, Any]:
+        # The worker streams events while the function runs and ends the
+        # call with a "result" event, which is returned
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            write_frame(
+                self.sock,
+                {"id": request_id, "func": func_name, "option": str(option), "args": list(args)},
+            )
+            while True:
+                message = read_frame(self.sock)
+                if message.get("id") != request_id:
+                    raise ValueError(
+                        f"user worker answered request {message.get('id')}, expected {request_id}"
+                    )
+                if message.get("event") == "result":
+                    return message
+                if on_event is not None:
+                    on_event(message)
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                write_frame(self.sock, {"id": 0, "func": None})
+            except OSError:
+                pass
+            self.sock.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+_workers: dict[tuple[int, int], UserWorker] = {}
+_workers_lock = threading.Lock()
+
+
+def get_user_worker(uid: int, gid: int) -> UserWorker:
+    with _workers_lock:
+        worker = _workers.get((uid, gid))
+        if worker is None or not worker.alive():
+            worker = UserWorker(uid, gid)
+            _workers[(uid, gid)] = worker
+        return worker
+
+
+def discard_user_worker(uid: int, gid: int) -> None:
+    with _workers_lock:
+        worker = _workers.pop((uid, gid), None)
+    if worker is not None:
+        worker.close()
+
+
+@atexit.register
+def shutdown_user_workers() -> None:
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for worker in workers:
+        worker.close()
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def log_progress_events() -> Callable[[dict[str, Any]], None]:
+    # Default event handler: log lines as they are, ref status changes, and
+    # progress only every PROGRESS_LOG_STEP percent per ref
+    logged_progress: dict[str, int] = {}
+
+    def handle(event: dict[str, Any]) -> None:
+        kind = event.get("event")
+        if kind == "log":
+            logger.info(event.get("message", ""))
+        elif kind == "progress":
+            ref = event.get("ref", "")
+            percent = int(event.get("fraction", 0.0) * 100)
+            step = percent - percent % PROGRESS_LOG_STEP
+            if step > logged_progress.get(ref, -1):
+                logged_progress[ref] = step
+                if event.get("bytes"):
+                    logger.info(
+                        "%s: %s (%d%%, %s)", ref, event.get("status", ""), percent, format_bytes(event["bytes"])
+                    )
+                else:
+                    logger.info("%s: %s (%d%%)", ref, event.get("status", ""), percent)
+        elif kind == "status":
+            if event.get("status") == "error":
+                logger.error("%s: %s", event.get("ref", ""), event.get("message", ""))
+            else:
+                logger.info("%s: %s", event.get("ref", ""), event.get("status", ""))
+
+    return handle
+
+
+def event_dispatcher(
+    on_event: Callable[[dict[str, Any]], None] | None,
+) -> Callable[[dict[str, Any]], None]:
+    # Log lines always go to the logger. Progress and status events go to
+    # on_event, or are logged if it is not given.
+    handle_default = log_progress_events()
+
+    def dispatch(event: dict[str, Any]) -> None:
+        try:
+            if event.get("event") == "log" or on_event is None:
+                handle_default(event)
+            else:
+                on_event(event)
+        except Exception:
+            # A broken handler must not lose the rest of the stream
+            logger.exception("Handling %s event failed", event.get("event"))
+
+    return dispatch
+
+
 def run_as_user(
-    uid: int, gid: int, func_name: str, option: str = "", *args: Any
+    uid: int,
+    gid: int,
+    func_name: str,
+    option: str = "",
+    *args: Any,
+    on_event: Callable[[dict[str, Any]], None] | None = None,
 ) -> list[str] | None:
-    # Determine the real directory of the main script
-    script_dir = Path(SCRIPT_FILE).resolve().parent
-    # Construct the path to run_as_user_target.py
-    target_script = script_dir / "run_as_user_target.py"
-    # Create a manager for shared queues
-    manager = multiprocessing.Manager()
-    log_queue = manager.Queue()
-    update_queue = manager.Queue()
-
-    # Serialize the queue data
-    log_queue_data: list[Any] = []
-    update_queue_data: list[Any] = []
+    try:
+        reply = get_user_worker(uid, gid).call(func_name, option, args, event_dispatcher(on_event))
+    except (OSError, EOFError, ValueError) as e:
+        # The worker died or can't be started, this call still has to happen
+        logger.warning("User worker unavailable (%s), running %s in a new process", e, func_name)
+        discard_user_worker(uid, gid)
+        return run_as_user_oneshot(uid, gid, func_name, option, *args, on_event=on_event)
+
+    if reply.get("error"):
+        logger.error("%s failed as user %s: %s", func_name, uid, reply["error"])
+        return None
+    return reply.get("result")
+
 
+def run_as_user_oneshot(
+    uid: int,
+    gid: int,
+    func_name: str,
+    option: str = "",
+    *args: Any,
+    on_event: Callable[[dict[str, Any]], None] | None = None,
+) -> list[str] | None:
+    # Starts run_as_user_target.py for this one call, it prints the same
+    # events as the persistent worker, one JSON object per line
+    dispatch = event_dispatcher(on_event)
     command = [
         sys.executable,
-        target_script,
+        target_script(),
         str(uid),
         str(gid),
         func_name,
-        json.dumps(log_queue_data),
-        json.dumps(update_queue_data),
         str(option),
         *args,
     ]
 
-    result = subprocess.run(command, capture_output=True, text=True)
-    # Enable these for debugging run_as_user_target.py
-    if result.returncode == 0 and result.stdout is not None:
-        try:
-            output = json.loads(result.stdout.strip())
-            # Deserialize the queue data
-            for item in output["log_queue"]:
-                log_queue.put(item)
-            for item in output["update_queue"]:
-                update_queue.put(item)
-            # Process logs
-            while not log_queue.empty():
-                log_message = log_queue.get()
-                logger.info(log_message)
-            return output["result"]
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON output from subprocess")
-            return None
-    else:
-        return None
+    reply = None
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+        assert process.stdout is not None
+        for line in process.stdout:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # Something in the function printed to stdout
+                logger.debug("%s: %s", func_name, line.rstrip())
+                continue
+            if event.get("event") == "result":
+                reply = event
+            else:
+                dispatch(event)
 
+    if process.returncode != 0 or reply is None:
+        logger.error("%s as user %s exited with %s", func_name, uid, process.returncode)
+        return None
+    if reply.get("error"):
+        logger.error("%s failed as user %s: %s", func_name, uid, reply["error"])
+        return None
+    return reply.get("result")
@@ -1,27 +1,20 @@
 import json
 import logging
-import multiprocessing
 import os
 import pwd
+import socket
 import sys
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import nobara_updater.shared_functions as shared_functions  # type: ignore[import]
+from nobara_updater.run_as import read_frame, write_frame  # type: ignore[import]
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_as_user_target(
-    uid: int,
-    gid: int,
-    func_name: str,
-    log_queue_data: list[Any],
-    update_queue_data: list[Any],
-    option: str = "",
-    *args: Any,
-) -> None:
+def drop_privileges(uid: int, gid: int) -> None:
     os.setgid(gid)
     os.setuid(uid)
 
@@ -47,48 +40,111 @@ def run_as_user_target(
     # Change working directory to the user's home directory
     os.chdir(user_home)
 
-    # Create the queues from the passed data
-    manager = multiprocessing.Manager()
-    log_queue = manager.Queue()
-    update_queue = manager.Queue()
-
-    for item in log_queue_data:
-        log_queue.put(item)
-
-    for item in update_queue_data:
-        update_queue.put(item)
-
-    # Import the function dynamically from shared_functions
-    func = getattr(shared_functions, func_name)
-    result = func(uid, gid, log_queue, update_queue, option, *args)
-
-    # Collect the queue data to return
-    log_queue_data = []
-    while not log_queue.empty():
-        log_queue_data.append(log_queue.get())
-
-    update_queue_data = []
-    while not update_queue.empty():
-        update_queue_data.append(update_queue.get())
-
-    sys.stdout.write(
-        json.dumps(
-            {
-                "result": result,
-                "log_queue": log_queue_data,
-                "update_queue": update_queue_data,
-            }
+
+class EventStream:
+    # Stands in for the log/update queues of the shared functions: every
+    # put() is handed to send right away, which writes it to the parent.
+    # Plain strings become events of the stream's default kind, dicts must
+    # carry their own "event" key.
+    def __init__(self, send: Callable[[dict[str, Any]], None], request_id: Any, kind: str) -> None:
+        self.send = send
+        self.request_id = request_id
+        self.kind = kind
+        self.broken = False
+
+    def put(self, item: Any) -> None:
+        if self.broken:
+            return
+        if isinstance(item, dict):
+            event = {**item, "id": self.request_id}
+        else:
+            event = {"id": self.request_id, "event": self.kind, "message": str(item)}
+        try:
+            self.send(event)
+        except OSError:
+            # Parent went away, let the function finish, the reply write ends the loop
+            self.broken = True
+
+    def empty(self) -> bool:
+        return True
+
+
+def call_shared_function(
+    uid: int,
+    gid: int,
+    request_id: Any,
+    func_name: str,
+    option: str,
+    args: list[Any],
+    send: Callable[[dict[str, Any]], None],
+) -> dict[str, Any]:
+    # Runs func_name from shared_functions, streaming its queue items
+    # through send, and returns the closing "result" event
+    log_queue = EventStream(send, request_id, "log")
+    update_queue = EventStream(send, request_id, "update")
+    reply: dict[str, Any] = {"id": request_id, "event": "result"}
+    try:
+        func = getattr(shared_functions, func_name)
+        reply["result"] = func(uid, gid, log_queue, update_queue, option, *args)
+    except Exception as e:
+        # The parent logs the failure for this call only
+        logger.exception("%s failed", func_name)
+        reply["error"] = f"{type(e).__name__}: {e}"
+    return reply
+
+
+def serve(uid: int, gid: int, fd: int) -> None:
+    # Persistent worker for run_as.UserWorker: drop privileges once, then
+    # answer framed requests until the parent asks us to stop or goes away.
+    sock = socket.socket(fileno=fd)
+    drop_privileges(uid, gid)
+
+    def send(event: dict[str, Any]) -> None:
+        write_frame(sock, event)
+
+    while True:
+        try:
+            request = read_frame(sock)
+        except (EOFError, OSError):
+            break
+        if request.get("func") is None:
+            break
+
+        reply = call_shared_function(
+            uid,
+            gid,
+            request.get("id"),
+            request["func"],
+            request.get("option", ""),
+            request.get("args", []),
+            send,
         )
-        + "\n"
-    )
+        try:
+            send(reply)
+        except OSError:
+            break
+    sock.close()
+
+
+def run_as_user_target(uid: int, gid: int, func_name: str, option: str = "", *args: Any) -> None:
+    # One-shot mode for run_as.run_as_user_oneshot: the same events, one
+    # JSON object per line on stdout
+    drop_privileges(uid, gid)
+
+    def send(event: dict[str, Any]) -> None:
+        sys.stdout.write(json.dumps(event) + "\n")
+        sys.stdout.flush()
+
+    send(call_shared_function(uid, gid, 0, func_name, option, list(args), send))
 
 
 if __name__ == "__main__":
+    if sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit(0)
     uid = int(sys.argv[1])
     gid = int(sys.argv[2])
     func_name = sys.argv[3]
-    log_queue_data = json.loads(sys.argv[4])
-    update_queue_data = json.loads(sys.argv[5])
-    option = str(sys.argv[6])
-    args = sys.argv[7:]
-    run_as_user_target(uid, gid, func_name, log_queue_data, update_queue_data, option, *args)
+    option = str(sys.argv[4])
+    args = sys.argv[5:]
+    run_as_user_target(uid, gid, func_name, option, *args)
@@ -1,15 +1,19 @@
+import fnmatch
 import os
 import pwd
+import random
 import subprocess
+import threading
+import time
 
 import gi  # type: ignore[import]
 
 gi.require_version("Flatpak", "1.0")
 
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
-from gi.repository import Flatpak  # type: ignore[import]
+from gi.repository import Flatpak, Gio  # type: ignore[import]
 
 def fp_get_user_updates(
     uid: int, gid: int, log_queue: Any, update_queue: Any, option: str = "",
@@ -49,13 +53,16 @@ def fp_get_user_updates(
     user_installation = Flatpak.Installation.new_user(None)
     # flatpak_user_updates = user_installation.list_installed_refs_for_update(None)
 
-    with fp_user_installation_list(user_installation, log_queue) as flatpak_user_updates:
-        # Convert InstalledRef objects to a list of strings
-        update_list = [
-            fp_user_update.get_appdata_name()
-            for fp_user_update in flatpak_user_updates
-            if fp_user_update.get_appdata_name()
-        ]
+    # option "refresh" fetches every remote's summary again
+    flatpak_user_updates = list_cached_updates(
+        user_installation, option == "refresh", log_queue.put
+    )
+    # Convert InstalledRef objects to a list of strings
+    update_list = [
+        fp_user_update.get_appdata_name()
+        for fp_user_update in flatpak_user_updates
+        if fp_user_update.get_appdata_name()
+    ]
     del user_installation
     if update_list:
         return update_list
@@ -168,6 +175,9 @@ def install_user_flatpak_updates(
     with fp_user_installation_list(user_installation, log_queue) as flatpak_user_updates:
         if flatpak_user_updates:
             transaction = Flatpak.Transaction.new_for_installation(user_installation)
+            # Resolve runtimes from the system installation where it already has
+            # them, instead of pulling a second copy into the user installation
+            transaction.add_default_dependency_sources()
             for ref in flatpak_user_updates:
                 try:
                     appdata_name = ref.get_appdata_name()
@@ -181,34 +191,294 @@ def install_user_flatpak_updates(
                         log_queue.put(f"Error updating {appdata_name}: {e}")
                     else:
                         log_queue.put(f"Error updating ref: {e}")
+            watch_transaction(transaction, update_queue.put)
             transaction.run()
             log_queue.put("Flatpak User Updates complete!")
 
     del user_installation
 
 
+def watch_transaction(transaction: Any, report: Callable[[dict[str, Any]], None]) -> None:
+    # Reports per-ref progress and completion through report while
+    # transaction.run() is going, so they can be shown as they happen
+    def on_new_operation(transaction, operation, progress):
+        ref = operation.get_ref()
+        last = [-1, ""]
+
+        def on_changed(progress):
+            percent = progress.get_progress()
+            status = progress.get_status() or ""
+            # changed fires far more often than the numbers change
+            if [percent, status] == last:
+                return
+            last[:] = [percent, status]
+            report(
+                {
+                    "event": "progress",
+                    "ref": ref,
+                    "fraction": percent / 100,
+                    "bytes": progress.get_bytes_transferred(),
+                    "status": status,
+                }
+            )
+
+        progress.connect("changed", on_changed)
+        report({"event": "status", "ref": ref, "status": "started"})
+
+    def on_operation_done(transaction, operation, commit, result):
+        report({"event": "status", "ref": operation.get_ref(), "status": "done"})
+
+    def on_operation_error(transaction, operation, error, details):
+        report({"event": "status", "ref": operation.get_ref(), "status": "error", "message": str(error)})
+        # Same as without a handler, the error stops the transaction
+        return False
+
+    transaction.connect("new-operation", on_new_operation)
+    transaction.connect("operation-done", on_operation_done)
+    transaction.connect("operation-error", on_operation_error)
+
+
+class RetryResult(object):
+    # Outcome of RetryPolicy.run: value on success, otherwise the last error
+    def __init__(self, value: Any = None, error: BaseException | None = None, attempts: int = 0):
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class RetryPolicy(object):
+    # Bounded retries with exponential backoff. Each delay is randomised by
+    # +-jitter of itself so several callers don't retry in lockstep, and is
+    # never longer than max_delay.
+    def __init__(
+        self,
+        attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 16.0,
+        jitter: float = 0.25,
+        retry_on: tuple[type[BaseException], ...] = (Exception,),
+    ):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def delay(self, attempt: int) -> float:
+        # Wait after the given failed attempt, counting from 1
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(
+        self,
+        func: Callable[[], Any],
+        on_error: Callable[[BaseException, int], None] | None = None,
+    ) -> RetryResult:
+        # on_error(error, attempt) is called for every failure. Errors not in
+        # retry_on are raised straight away.
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return RetryResult(func(), attempts=attempt)
+            except self.retry_on as e:
+                if on_error is not None:
+                    on_error(e, attempt)
+                if attempt == self.attempts:
+                    return RetryResult(error=e, attempts=attempt)
+                time.sleep(self.delay(attempt))
+        return RetryResult(attempts=0)
+
+
+# list_installed_refs_for_update fails now and then when a remote is
+# unreachable (see #43). Five attempts sleep at most ~19s in between,
+# well inside the update check timeouts.
+FLATPAK_LIST_RETRY = RetryPolicy(retry_on=(gi.repository.GLib.GError,))
+
+
+class InstalledRefsCache(object):
+    # Locally installed refs per installation, enumerated once and kept until
+    # flatpak marks the installation changed (it touches <path>/.changed on
+    # every deploy/uninstall).
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[tuple[int, int] | None, list[Any]]] = {}
+
+    @staticmethod
+    def _state(path: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(os.path.join(path, ".changed"))
+        except OSError:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self, installation: Any) -> list[Any]:
+        path = installation.get_path().get_path()
+        state = self._state(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and state is not None and entry[0] == state:
+                return entry[1]
+        refs = list(installation.list_installed_refs(None))
+        with self._lock:
+            self._entries[path] = (state, refs)
+        return refs
+
+
+installed_refs = InstalledRefsCache()
+
+
+def list_installation_updates(
+    installation: Any, on_error: Callable[[BaseException, int], None]
+) -> RetryResult:
+    # Nothing installed means nothing to update, don't ask any remote
+    if not installed_refs.get(installation):
+        return RetryResult([], attempts=0)
+    return FLATPAK_LIST_RETRY.run(
+        lambda: installation.list_installed_refs_for_update(None), on_error
+    )
+
+
+# Remote summaries fetched less than this many seconds ago are used as
+# cached when checking for updates
+REMOTE_SUMMARY_MAX_AGE = 15 * 60
+# Fetching one remote's summary gives up after this many seconds and
+# falls back to its cached copy
+REMOTE_FETCH_TIMEOUT = 20
+
+
+class RemoteSummaries(object):
+    # Commit of every ref a remote offers, read from its summary. A summary
+    # is fetched from the network at most once per REMOTE_SUMMARY_MAX_AGE,
+    # otherwise libflatpak's cached copy is used, and a remote that can't be
+    # reached is answered from the cache as well.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fetched: dict[tuple[str, str], float] = {}
+
+    def _list(self, installation: Any, remote: str, cached: bool) -> dict[str, str]:
+        if cached:
+            refs = installation.list_remote_refs_sync_full(
+                remote, Flatpak.QueryFlags.ONLY_CACHED, None
+            )
+            return {ref.format_ref(): ref.get_commit() for ref in refs}
+
+        cancellable = Gio.Cancellable()
+        timer = threading.Timer(REMOTE_FETCH_TIMEOUT, cancellable.cancel)
+        timer.start()
+        try:
+            refs = installation.list_remote_refs_sync_full(
+                remote, Flatpak.QueryFlags.NONE, cancellable
+            )
+        finally:
+            timer.cancel()
+        with self._lock:
+            self._fetched[(installation.get_path().get_path(), remote)] = time.monotonic()
+        return {ref.format_ref(): ref.get_commit() for ref in refs}
+
+    def commits(
+        self, installation: Any, remote: str, refresh: bool, on_error: Callable[[str], None]
+    ) -> dict[str, str] | None:
+        key = (installation.get_path().get_path(), remote)
+        with self._lock:
+            fetched = self._fetched.get(key)
+        fresh = fetched is not None and time.monotonic() - fetched < REMOTE_SUMMARY_MAX_AGE
+        # Try in order: cache if fresh, then network, then cache again
+        attempts = [True, False] if fresh and not refresh else [False, True]
+        for cached in attempts:
+            try:
+                return self._list(installation, remote, cached)
+            except gi.repository.GLib.GError as e:
+                if cached:
+                    on_error(f"No usable cached summary for Flatpak remote {remote}: {e}")
+                else:
+                    on_error(f"Could not fetch Flatpak remote {remote}: {e}")
+        return None
+
+
+remote_summaries = RemoteSummaries()
+
+
+def masked_patterns(installation: Any) -> list[list[str]]:
+    # Patterns set with "flatpak mask", split into kind/id/arch/branch. A
+    # pattern starts with the kind only if it names one (app/..., runtime/...).
+    try:
+        config = installation.get_config("masked")
+    except gi.repository.GLib.GError:
+        return []
+    patterns = []
+    for pattern in (config or "").split(";"):
+        if not pattern.strip():
+            continue
+        parts = pattern.strip().split("/")
+        if parts[0] not in ("app", "runtime"):
+            parts.insert(0, "*")
+        patterns.append(parts)
+    return patterns
+
+
+def is_masked(ref: Any, patterns: list[list[str]]) -> bool:
+    # Missing or empty parts of a pattern match anything, like in flatpak
+    parts = ref.format_ref().split("/")
+    return any(
+        all(
+            not part or fnmatch.fnmatchcase(value, part)
+            for value, part in zip(parts, pattern)
+        )
+        for pattern in patterns
+    )
+
+
+def list_cached_updates(
+    installation: Any, refresh: bool, on_error: Callable[[str], None]
+) -> list[Any]:
+    # Installed refs whose remote offers a different commit. Unlike
+    # list_installed_refs_for_update this works from cached summaries, a
+    # remote that can't be read at all is skipped. Masked refs are left out,
+    # flatpak doesn't update them either.
+    updates = []
+    masked = masked_patterns(installation)
+    installed = [ref for ref in installed_refs.get(installation) if not is_masked(ref, masked)]
+    for remote in sorted({ref.get_origin() for ref in installed}):
+        commits = remote_summaries.commits(installation, remote, refresh, on_error)
+        if commits is None:
+            continue
+        for ref in installed:
+            if ref.get_origin() != remote:
+                continue
+            commit = commits.get(ref.format_ref())
+            if commit and commit != ref.get_commit():
+                updates.append(ref)
+    return updates
+
+
 class fp_user_installation_list(object):
-    # Generates flatpak_system_updates for other functions with error handling
+    # Generates flatpak_user_updates for other functions with error handling,
+    # None if the updates could not be listed. The RetryResult is kept in
+    # self.result.
     def __init__(self, user_installation, log_queue):
         self.user_installation = user_installation
         self.log_queue = log_queue
+        self.result = None
 
 
     def __enter__(self):
-        flatpak_user_updates = None
-        error = True # No do-while in Python so init to true to run loop once
-        while error:
-            try:
-                flatpak_user_updates = self.user_installation.list_installed_refs_for_update(None)
-            except gi.repository.GLib.GError as e:
-                # Expected, see #43
-                self.log_queue.put(f"Error getting Flatpak user updates: {e}")
-            except:
-                raise
-            else:
-                error = False
-        return flatpak_user_updates
-    
+        def on_error(e, attempt):
+            self.log_queue.put(
+                f"Error getting Flatpak user updates (attempt {attempt}/{FLATPAK_LIST_RETRY.attempts}): {e}"
+            )
+
+        self.result = list_installation_updates(self.user_installation, on_error)
+        if not self.result.ok:
+            self.log_queue.put("Giving up on Flatpak user updates for now")
+            return None
+        return self.result.value
+
 
     def __exit__(self, *args):
         del self.user_installation
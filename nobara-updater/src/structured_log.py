@@ -0,0 +1,143 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+
+from nobara_updater.log_rotation import LogRotation, RotatingLogHandler
+
+# Fields a record can carry for the JSON-lines log, set with
+# logger.info(..., extra={"package": ..., "action": ...}). The phase is
+# filled in from log_phase when the record doesn't have one.
+STRUCTURED_FIELDS = ("phase", "quirk", "package", "action", "duration", "status")
+
+current_phase: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_phase", default=None
+)
+
+
+class PhaseFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "phase", None) is None:
+            record.phase = current_phase.get()
+        return True
+
+
+@contextlib.contextmanager
+def log_phase(name: str, logger: logging.Logger | None = None):
+    # Tags every record logged inside with the phase and logs how long the
+    # phase took and whether it raised. Works as a decorator as well.
+    logger = logger if logger is not None else logging.getLogger()
+    token = current_phase.set(name)
+    start = time.monotonic()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        duration = round(time.monotonic() - start, 3)
+        logger.info(
+            "Finished %s: %s (%.1fs)",
+            name,
+            status,
+            duration,
+            extra={"action": "phase", "duration": duration, "status": status},
+        )
+        current_phase.reset(token)
+
+
+def in_current_context(func):
+    # Threads, including ThreadPoolExecutor workers, start without the
+    # caller's contextvars. Wrap what is handed to one in this so its records
+    # keep the caller's phase. Each call makes its own copy, a copy can't be
+    # entered by two threads at once.
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, default=str)
+
+
+def json_file_handler(path: Path, rotation: LogRotation) -> logging.FileHandler:
+    handler = RotatingLogHandler(path, rotation)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(JsonLinesFormatter())
+    return handler
+
+
+class LogPipeline:
+    # The root logger's one and only handler is a QueueHandler, so logging
+    # from any thread just enqueues the record. A single QueueListener
+    # thread runs the real handlers (console, files, TextView). install()
+    # replaces whatever handlers the logger had, calling it again swaps the
+    # listener's handlers instead of adding to them.
+    def __init__(self) -> None:
+        self.records: queue.Queue[logging.LogRecord] = queue.Queue()
+        self.queue_handler = QueueHandler(self.records)
+        # The phase lives in the producing thread's context, read it there
+        self.queue_handler.addFilter(PhaseFilter())
+        self.listener: QueueListener | None = None
+        self._suspended = False
+        self._lock = threading.Lock()
+
+    def install(self, logger: logging.Logger, handlers: list[logging.Handler]) -> None:
+        with self._lock:
+            logger.handlers = [self.queue_handler]
+            # Records queued meanwhile stay in the queue for the new listener
+            self._stop()
+            self.listener = QueueListener(self.records, *handlers, respect_handler_level=True)
+            self.listener.start()
+
+    def _stop(self) -> None:
+        if self.listener is None:
+            return
+        # Writes out what is already queued before closing the handlers
+        if not self._suspended:
+            self.listener.stop()
+        self._suspended = False
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stop()
+
+    def suspend(self) -> None:
+        # Writes out everything queued and stops the listener but keeps its
+        # handlers, for an exec that skips atexit. resume() starts it again.
+        with self._lock:
+            if self.listener is None or self._suspended:
+                return
+            self.listener.stop()
+            self._suspended = True
+            for handler in self.listener.handlers:
+                handler.flush()
+
+    def resume(self) -> None:
+        with self._lock:
+            if self.listener is not None and self._suspended:
+                self.listener.start()
+            self._suspended = False
+
+
+log_pipeline = LogPipeline()
+atexit.register(log_pipeline.stop)